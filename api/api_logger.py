@@ -0,0 +1,205 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import QueryDict
+from django.utils import timezone
+from drf_api_logger.utils import get_client_ip, get_headers
+
+logger = logging.getLogger(__name__)
+
+# Request headers never written to the log.
+REDACTED_HEADERS = {'AUTHORIZATION', 'COOKIE'}
+
+# Fields of JSON and form bodies whose values are never written to the log: passwords, tokens and keys.
+SENSITIVE_FIELDS = {'password', 'password1', 'password2', 'old_password', 'new_password1', 'new_password2',
+                    'access', 'refresh', 'token', 'key'}
+MASK = '********'
+
+
+class APILogWriter(threading.Thread):
+    """
+    Background thread saving API log records into drf_api_logger's table with bulk_create.
+
+    Records wait in a bounded in-memory queue. When it is full, new records are
+    dropped instead of slowing down requests.
+    """
+
+    def __init__(self, max_queue_size=10000, batch_size=500, flush_interval=2):
+        super().__init__(name='api_log_writer', daemon=True)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size            # Max records saved with one INSERT.
+        self.flush_interval = flush_interval    # Max seconds record waits in queue.
+        self.dropped = 0                        # Records dropped because queue was full.
+
+    def put(self, record):
+        """
+        Queues record (dict of APILogsModel fields) without blocking.
+
+        :returns: False if record was dropped.
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        """
+        Saves records with a single INSERT.
+        """
+        from drf_api_logger.models import APILogsModel
+
+        try:
+            APILogsModel.objects.bulk_create([APILogsModel(**record) for record in batch])
+        except Exception:
+            logger.exception('Saving %d API log records failed.', len(batch))
+        finally:
+            close_old_connections()
+
+    def flush(self):
+        """
+        Saves all queued records in the calling thread. Used at interpreter exit.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(batch), self.batch_size):
+            self.write(batch[start:start + self.batch_size])
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_api_log_writer():
+    """
+    :returns: Process-wide, running APILogWriter configured with CHAT_API_LOGGER setting.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            config = settings.CHAT_API_LOGGER
+            _writer = APILogWriter(max_queue_size=config['MAX_QUEUE_SIZE'], batch_size=config['BATCH_SIZE'],
+                                   flush_interval=config['FLUSH_INTERVAL'])
+            _writer.start()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def truncate(text, length):
+    """
+    :returns: Text cut down to given length, with a marker if it was cut.
+    """
+    if len(text) <= length:
+        return text
+    return text[:length] + f'... ({len(text) - length} more characters)'
+
+
+def mask_fields(data):
+    """
+    :returns: Parsed JSON with values of SENSITIVE_FIELDS masked, at any depth.
+    """
+    if isinstance(data, dict):
+        return {key: MASK if str(key).lower() in SENSITIVE_FIELDS else mask_fields(value)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [mask_fields(item) for item in data]
+    return data
+
+
+def mask_sensitive(text, content_type):
+    """
+    Masks values of SENSITIVE_FIELDS in JSON or form body. Bodies mentioning none of them are
+    returned as they are, without parsing; other bodies that can't be parsed are not logged at all.
+
+    :returns: Body to be logged.
+    """
+    lowered = text.lower()
+    if not any(field in lowered for field in SENSITIVE_FIELDS):
+        return text
+
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        fields = QueryDict(text, mutable=True)
+        for field in list(fields):
+            if field.lower() in SENSITIVE_FIELDS:
+                fields.setlist(field, [MASK])
+        return fields.urlencode(safe='*')
+    try:
+        return json.dumps(mask_fields(json.loads(text)), ensure_ascii=False)
+    except ValueError:
+        return '** Not logged, may contain credentials **'
+
+
+class BufferedAPILoggerMiddleware:
+    """
+    Logs API requests into drf_api_logger's table, configured with CHAT_API_LOGGER setting.
+
+    Unlike drf_api_logger's own middleware, request threads never touch the database:
+    records are handed to APILogWriter thread. Requests can be sampled and excluded
+    by path prefix, bodies are truncated and stored as received, except for passwords,
+    tokens and keys, which are masked (see mask_sensitive()).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = settings.CHAT_API_LOGGER
+
+    def __call__(self, request):
+        config = self.config
+        if not config['ENABLED'] or request.path.startswith(tuple(config['EXCLUDE_PATHS'])):
+            return self.get_response(request)
+
+        # Body has to be read before the view consumes request stream.
+        sampled = random.random() < config['SAMPLE_RATE']
+        body = request.body.decode('utf-8', 'replace') if sampled else '** Not sampled **'
+
+        started = time.monotonic()
+        response = self.get_response(request)
+        execution_time = time.monotonic() - started
+
+        # Server errors are logged even if request was not sampled.
+        if not sampled and not (config['ALWAYS_LOG_ERRORS'] and response.status_code >= 500):
+            return response
+
+        if not sampled:
+            content = '** Not sampled **'
+        elif getattr(response, 'streaming', False):
+            content = '** Streaming **'
+        else:
+            content = response.content.decode('utf-8', 'replace')
+
+        headers = {name: value for name, value in get_headers(request).items() if name not in REDACTED_HEADERS}
+        get_api_log_writer().put(dict(
+            api=request.get_full_path()[:512],
+            headers=json.dumps(headers),
+            body=truncate(mask_sensitive(body, request.content_type or ''), config['MAX_BODY_LENGTH']),
+            method=request.method,
+            client_ip_address=get_client_ip(request),
+            response=truncate(mask_sensitive(content, response.get('Content-Type', '')), config['MAX_BODY_LENGTH']),
+            status_code=response.status_code,
+            execution_time=round(min(execution_time, 999.99999), 5),
+            added_on=timezone.now(),
+        ))
+        return response
@@ -0,0 +1,147 @@
+"""
+Archive of old messages, moved out of database into files (see archive_messages command).
+
+Archived messages of a room are stored in <DIRECTORY>/room_<room id>/<YYYY-MM>.jsonl.gz files,
+one per month (UTC) of message timestamp. Each line is a message serialized the same way
+MessageSerializer does (see history_cache.message_representation). Files are only appended
+to, so archiving that was interrupted and run again may repeat messages, they are skipped
+on read by id.
+"""
+import functools
+import gzip
+import itertools
+import json
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from api.history_cache import message_representation
+from api.partitions import month_start
+
+
+def item_position(item):
+    """
+    :returns: Tuple of (timestamp, id) of serialized message.
+    """
+    return parse_datetime(item['timestamp']), item['id']
+
+
+@functools.lru_cache(maxsize=16)
+def load_file(path, mtime_ns, size):
+    """
+    Reads archive file, cached until it changes.
+
+    :returns: Tuple of serialized messages, oldest first.
+    """
+    items = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            item = json.loads(line)
+            items[item['id']] = item
+    return tuple(sorted(items.values(), key=item_position))
+
+
+class RoomArchive:
+    """
+    Archived messages of a single room.
+    """
+
+    def __init__(self, directory, room_id):
+        self.directory = Path(directory) / f'room_{room_id}'
+
+    def months(self):
+        """
+        :returns: Sorted list of months with archived messages, e.g. ['2020-01', '2020-02'].
+        """
+        if not self.directory.is_dir():
+            return []
+        return sorted(path.name[:-len('.jsonl.gz')] for path in self.directory.glob('*.jsonl.gz'))
+
+    def path(self, month):
+        return self.directory / f'{month}.jsonl.gz'
+
+    def read(self, month):
+        """
+        :returns: Tuple of serialized messages of given month, oldest first.
+        """
+        path = self.path(month)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return ()
+        return load_file(str(path), stat.st_mtime_ns, stat.st_size)
+
+    def append(self, month, items):
+        """
+        Adds serialized messages to given month's file.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with gzip.open(self.path(month), 'at', encoding='utf-8') as file:
+            for item in items:
+                file.write(json.dumps(item) + '\n')
+
+    def older(self, position, limit):
+        """
+        :param position: Tuple of (timestamp, id), or None for the newest archived messages.
+        :returns: Up to limit serialized messages older than position, newest first.
+        """
+        months = self.months()
+        if position is not None:
+            months = [month for month in months if month <= f'{month_start(position[0]):%Y-%m}']
+
+        found = []
+        for month in reversed(months):
+            items = self.read(month)
+            if position is not None:
+                items = [item for item in items if item_position(item) < position]
+            found.extend(reversed(items[-(limit - len(found)):]))
+            if len(found) >= limit:
+                break
+        return found
+
+    def newer(self, position, limit):
+        """
+        :param position: Tuple of (timestamp, id).
+        :returns: Up to limit serialized messages newer than position, oldest first.
+        """
+        found = []
+        for month in self.months():
+            if month < f'{month_start(position[0]):%Y-%m}':
+                continue
+            items = [item for item in self.read(month) if item_position(item) > position]
+            found.extend(items[:limit - len(found)])
+            if len(found) >= limit:
+                break
+        return found
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_room_archive(room_id):
+    """
+    :returns: RoomArchive of given room in directory set in CHAT_ARCHIVE setting, or None if archiving is disabled.
+    """
+    directory = settings.CHAT_ARCHIVE['DIRECTORY']
+    if not directory:
+        return None
+    return RoomArchive(directory, room_id)
+
+
+def archive_messages(messages):
+    """
+    Appends Message objects to archives of their rooms. Objects should have user loaded.
+
+    :returns: Number of archived messages.
+    """
+    def group(message):
+        return message.room_id, f'{month_start(message.timestamp):%Y-%m}'
+
+    count = 0
+    for (room_id, month), room_messages in itertools.groupby(sorted(messages, key=group), key=group):
+        items = [message_representation(message) for message in room_messages]
+        get_room_archive(room_id).append(month, items)
+        count += len(items)
+    return count
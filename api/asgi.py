@@ -1,18 +1,21 @@
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import api.routing
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "src.settings")
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings.dev")
+# Set up Django before importing consumers, which import models.
+django_asgi_application = get_asgi_application()
+
+import api.routing  # noqa: E402
+from api.auth import JWTAuthMiddlewareStack  # noqa: E402
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_application,
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(
             api.routing.websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
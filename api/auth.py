@@ -0,0 +1,68 @@
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+def get_raw_token(scope):
+    """
+    :returns: Access token string sent in 'token' query string parameter
+              or 'Authorization: Bearer <token>' header, None if there is none.
+    """
+    token = parse_qs(scope.get('query_string', b'').decode('latin1')).get('token')
+    if token:
+        return token[0]
+
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin1').split()
+            if len(parts) == 2 and parts[0] in api_settings.AUTH_HEADER_TYPES:
+                return parts[1]
+    return None
+
+
+def get_token_user(raw_token):
+    """
+    Validates access token signature, expiry and type, without database queries.
+
+    :returns: TokenUser backed by token claims, AnonymousUser if token is invalid.
+    """
+    try:
+        return TokenUser(AccessToken(raw_token))
+    except TokenError:
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates WebSocket connections with SimpleJWT access tokens.
+
+    Browsers can't set headers of WebSocket requests, so token is read from 'token'
+    query string parameter, or from 'Authorization' header sent by other clients.
+    Token is validated locally and scope['user'] is set to TokenUser built from its
+    claims, so connecting doesn't touch the database. Unlike REST API requests, which
+    load the user and reject inactive ones, WebSocket connections are therefore accepted
+    until the token expires (SIMPLE_JWT ACCESS_TOKEN_LIFETIME) even if user was deactivated
+    in the meantime.
+
+    Connections without token keep user set by session authentication.
+    Connections with invalid token are anonymous.
+    """
+
+    async def __call__(self, scope, receive, send):
+        raw_token = get_raw_token(scope)
+        if raw_token is not None:
+            scope = dict(scope, user=get_token_user(raw_token))
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """
+    Session authentication stack, with JWT authentication taking precedence.
+    """
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
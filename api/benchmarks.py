@@ -0,0 +1,217 @@
+"""
+Helpers shared by benchmark management commands (api/management/commands/bench_*.py).
+"""
+import asyncio
+import contextlib
+import statistics
+import threading
+import time
+
+from django.db import connection, transaction
+
+from api.models import CustomUser, Message, Room
+
+
+def percentile(values, p):
+    """
+    :returns: p-th percentile (0-100) of given values, using nearest-rank method.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """
+    :returns: Dict of latency statistics (milliseconds) for given samples (seconds).
+    """
+    ms = [sample * 1000 for sample in samples]
+    return {
+        'samples': len(ms),
+        'mean_ms': round(statistics.mean(ms), 3) if ms else 0.0,
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(max(ms), 3) if ms else 0.0,
+    }
+
+
+def measure(func, samples, warmup=1):
+    """
+    Calls func repeatedly.
+
+    :returns: List of wall clock durations (seconds) of each call, warmup calls excluded.
+    """
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def get_bench_user(username='bench_user'):
+    """
+    :returns: User object used by benchmarks, created if it does not exist yet.
+    """
+    user, _ = CustomUser.objects.get_or_create(username=username)
+    return user
+
+
+def seed_room(user, messages, name='bench room', batch_size=5000):
+    """
+    Creates a room with given user as its member and fills it with messages.
+
+    :returns: Created Room object.
+    """
+    room = Room.objects.create(name=name, creator=user)
+    room.admins.add(user)
+    room.users.add(user)
+
+    created = 0
+    while created < messages:
+        size = min(batch_size, messages - created)
+        with transaction.atomic():
+            Message.objects.bulk_create(
+                Message(room=room, user=user, text=f'Message number {created + i}.') for i in range(size)
+            )
+        created += size
+
+    Room.rebuild_activity(Room.objects.filter(pk=room.pk))
+    return room
+
+
+def add_room_members(room, count):
+    """
+    Creates given number of users and adds them to room's admins and users.
+
+    :returns: List of created users, ordered by id.
+    """
+    prefix = f'bench_member_{room.id}_'
+    CustomUser.objects.bulk_create(CustomUser(username=f'{prefix}{i}') for i in range(count))
+    users = list(CustomUser.objects.filter(username__startswith=prefix).order_by('id'))
+    with transaction.atomic():
+        for name in ('admins', 'users'):
+            through = getattr(Room, name).through
+            through.objects.bulk_create(through(room_id=room.id, customuser_id=user.id) for user in users)
+    return users
+
+
+def delete_room_members(room_ids):
+    """
+    Deletes users created with add_room_members() for given rooms.
+    """
+    for room_id in room_ids:
+        CustomUser.objects.filter(username__startswith=f'bench_member_{room_id}_').delete()
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries of its thread's connection, e.g.
+    `with connection.execute_wrapper(counter)`. Unlike query log, it is not capped.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def run_concurrently(func, clients, requests):
+    """
+    Calls func(client) requests times from each of clients threads, all started at once.
+    Each thread uses its own database connection, closed once it's done.
+
+    :returns: Tuple of (list of (seconds, queries) of successful calls, number of failed calls, total seconds).
+    """
+    results = []
+    errors = []
+    barrier = threading.Barrier(clients + 1)
+
+    def run(client):
+        try:
+            barrier.wait()
+            for _ in range(requests):
+                counter = QueryCounter()
+                started = time.perf_counter()
+                try:
+                    with connection.execute_wrapper(counter):
+                        func(client)
+                except Exception as error:
+                    errors.append(error)
+                    continue
+                results.append((time.perf_counter() - started, counter.count))
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return results, len(errors), time.perf_counter() - started
+
+
+async def run_websocket_clients(tokens, messages, interval=0.0, timeout=10):
+    """
+    Connects a ChatConsumer client for each of given tokens to its room, lets each of them
+    send messages and read messages of its room. Message text is its send time, so
+    fan-out latency is measured from sending a message to receiving it by each room member.
+
+    :param tokens: Dict of room id -> list of access tokens of room members.
+    :returns: Tuple of (messages sent, frames received, list of fan-out latencies, total seconds).
+    """
+    from channels.testing import WebsocketCommunicator
+
+    from api.asgi import application
+
+    communicators = []
+    for room_id, room_tokens in tokens.items():
+        for token in room_tokens:
+            communicator = WebsocketCommunicator(application, f'ws/{room_id}/?token={token}')
+            connected, _ = await communicator.connect()
+            assert connected, 'Client could not join the room.'
+            communicators.append((communicator, len(room_tokens) * messages))
+
+    latencies = []
+
+    async def read(communicator, expected):
+        received = 0
+        while received < expected:
+            try:
+                frame = await communicator.receive_json_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            # Presence frames are not counted.
+            if frame['type'] != 'message':
+                continue
+            latencies.append(time.perf_counter() - float(frame['message']))
+            received += 1
+        return received
+
+    async def write(communicator):
+        for _ in range(messages):
+            await communicator.send_json_to({'message': repr(time.perf_counter())})
+            if interval:
+                await asyncio.sleep(interval)
+        return messages
+
+    started = time.perf_counter()
+    readers = [asyncio.ensure_future(read(communicator, expected)) for communicator, expected in communicators]
+    sent = sum(await asyncio.gather(*(write(communicator) for communicator, _ in communicators)))
+    received = sum(await asyncio.gather(*readers))
+    elapsed = time.perf_counter() - started
+
+    for communicator, _ in communicators:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await communicator.disconnect()
+    return sent, received, latencies, elapsed
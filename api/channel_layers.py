@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import logging
+import time
+
+import channels_redis
+from channels_redis.core import RedisChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# Key added to group messages sent through Redis by HybridChannelLayer, holding group name.
+GROUP_KEY = '__hybrid_group__'
+
+# Versions of channels_redis whose internals HybridChannelLayer relies on: receive buffers of local
+# channels, reading them in receive() and mapping group members to Redis connections in group_send().
+SUPPORTED_CHANNELS_REDIS_VERSIONS = ('3.2.',)
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer delivering messages to channels of the same process directly.
+
+    Channels of this process are kept out of Redis groups. Instead, a group has a
+    single Redis member per process: the process channel, joined when the first
+    channel of the process joins the group and left when the last one leaves.
+    Group messages are put straight into receive buffers of local members and sent
+    through Redis only to process channels of other processes, which hand them out
+    to their own local members. Messages sent to a single local channel skip Redis too.
+
+    Only the process channel reads from Redis. It shares Redis list with local
+    channels, so messages other processes send to them directly are still received.
+
+    Messages sent directly to local channels nobody receives on anymore, e.g. of closed
+    connections, are dropped, so their receive buffers don't pile up.
+
+    All processes sharing the Redis server have to use this layer, as process
+    channels understand only group messages sent by HybridChannelLayer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if not channels_redis.__version__.startswith(SUPPORTED_CHANNELS_REDIS_VERSIONS):
+            raise ImproperlyConfigured(
+                f'HybridChannelLayer relies on internals of channels_redis {SUPPORTED_CHANNELS_REDIS_VERSIONS}, '
+                f'{channels_redis.__version__} is installed. Use channels_redis.core.RedisChannelLayer instead.'
+            )
+        super().__init__(*args, **kwargs)
+        self.process_channel = None
+        self.local_channels = set()                         # Local channels created or received on, not closed.
+        self.local_groups = collections.defaultdict(set)    # Group name -> local channel names.
+        self.group_refreshed = {}                           # Group name -> time process channel joined it.
+        self.local_loop = None                              # Event loop local state belongs to.
+        self.listener = None                                # Task handing out group messages from Redis.
+
+    def is_local(self, channel):
+        """
+        :returns: True if channel was created by this layer instance.
+        """
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    async def ensure_listener(self):
+        """
+        Creates process channel and starts reading it, once per event loop.
+        Local group members of a previous event loop are forgotten, as their consumers are gone.
+        """
+        loop = asyncio.get_event_loop()
+        if self.local_loop is loop and self.listener is not None and not self.listener.done():
+            return
+        self.local_loop = loop
+        self.local_groups.clear()
+        self.group_refreshed.clear()
+        self.process_channel = await self.new_channel()
+        self.listener = loop.create_task(self.listen())
+
+    async def listen(self):
+        while True:
+            try:
+                # Messages for local channels are put into their receive buffers on the way.
+                message = await super().receive(self.process_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Receiving group message for local channels failed.')
+                await asyncio.sleep(1)
+                continue
+
+            group = message.pop(GROUP_KEY, None)
+            if group is None:
+                logger.warning('Process channel got a message without group, dropped.')
+                continue
+            self.deliver_local(group, message)
+
+    def deliver_local(self, group, message):
+        """
+        Puts message into receive buffers of local group members.
+        As with Redis, when member's buffer is full, its oldest message is dropped.
+        """
+        for channel in self.local_groups.get(group, ()):
+            if channel in self.local_channels:
+                self.receive_buffer[channel].put_nowait(dict(message))
+
+    async def new_channel(self, prefix='specific.'):
+        channel = await super().new_channel(prefix)
+        self.local_channels.add(channel)
+        return channel
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+
+        # Messages are put into receive buffer directly or by the listener.
+        await self.ensure_listener()
+        self.local_channels.add(channel)
+        buffer = self.receive_buffer[channel]
+        try:
+            message = await buffer.get()
+        except asyncio.CancelledError:
+            # Consumers stop receiving only when they are closed, forget the channel and its buffer.
+            self.local_channels.discard(channel)
+            if self.receive_buffer.get(channel) is buffer:
+                del self.receive_buffer[channel]
+            raise
+        if buffer.empty() and self.receive_buffer.get(channel) is buffer:
+            del self.receive_buffer[channel]
+        return message
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            assert isinstance(message, dict), 'message is not a dict'
+            # Nobody receives on the channel anymore, e.g. its connection is closed, so the message is dropped.
+            if channel in self.local_channels:
+                self.receive_buffer[channel].put_nowait(dict(message))
+            return
+        await super().send(channel, message)
+
+    async def group_add(self, group, channel):
+        if not self.is_local(channel):
+            return await super().group_add(group, channel)
+
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self.ensure_listener()
+        self.local_groups[group].add(channel)
+
+        # Join group with process channel when first local channel joins it,
+        # and again before Redis membership expires.
+        refreshed = self.group_refreshed.get(group)
+        if refreshed is None or time.time() - refreshed > self.group_expiry / 2:
+            self.group_refreshed[group] = time.time()
+            await super().group_add(group, self.process_channel)
+
+    async def group_discard(self, group, channel):
+        if not self.is_local(channel):
+            return await super().group_discard(group, channel)
+
+        members = self.local_groups.get(group)
+        if not members:
+            return
+        members.discard(channel)
+
+        # Leave group with process channel when last local channel leaves it.
+        if not members:
+            del self.local_groups[group]
+            del self.group_refreshed[group]
+            await super().group_discard(group, self.process_channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        self.deliver_local(group, message)
+        await super().group_send(group, dict(message, **{GROUP_KEY: group}))
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Local group members already got the message directly.
+        channel_names = [channel for channel in channel_names if not self.is_local(channel)]
+        return super()._map_channel_keys_to_connection(channel_names, message)
+
+    async def flush(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        self.listener = None
+        self.local_groups.clear()
+        self.group_refreshed.clear()
+        self.local_channels.clear()
+        await super().flush()
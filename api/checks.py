@@ -0,0 +1,45 @@
+"""
+System checks of database state, run with `manage.py check --database default` and before migrate.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+from django.db import DatabaseError
+from django.utils import timezone
+
+from api.partitions import default_partition_has_rows, is_partitioned, message_partitions
+
+
+@register(Tags.database)
+def check_message_partitions(app_configs, databases=None, **kwargs):
+    """
+    Warns when partitions of message table run out soon, or already ran out and messages
+    are saved in default partition, i.e. create_message_partitions command doesn't run regularly.
+    """
+    if not databases or 'default' not in databases:
+        return []
+    try:
+        if not is_partitioned():
+            return []
+        partitions = message_partitions()
+        spilled = default_partition_has_rows()
+    except DatabaseError:
+        return []   # Database is not migrated yet.
+
+    errors = []
+    until = partitions[-1].end if partitions else None
+    min_until = timezone.now() + datetime.timedelta(days=settings.CHAT_MESSAGE_PARTITIONS['MIN_DAYS_AHEAD'])
+    if until is not None and until < min_until:
+        errors.append(Warning(
+            f'Partitions of message table end at {until}.',
+            hint='Run create_message_partitions command regularly, e.g. daily from cron.',
+            id='api.W001',
+        ))
+    if spilled:
+        errors.append(Warning(
+            'Messages are saved in default partition of message table, as partitions of their months are missing.',
+            hint='Run create_message_partitions command, it moves them to their partitions.',
+            id='api.W002',
+        ))
+    return errors
@@ -1,20 +1,147 @@
 import json
+import logging
+from urllib.parse import parse_qs
 
+from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.models import TokenUser
 
-from api.models import Message, Room, CustomUser
+from api import metrics
+from api.frames import control_frame
+from api.membership import get_room_member_ids
+from api.models import CustomUser, Message, RoomReadCursor
+from api.outbox import CLOSE_CODE_OVERFLOW, Outbox
+from api.persistence import ENQUEUE, get_message_writer
+from api.presence import get_presence_tracker
+from api.resume import missed_messages
+from api.services import create_message, group_send_duration, message_event, room_group_name
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to clients of a room which was deleted.
+CLOSE_CODE_ROOM_DELETED = 4004
+
+open_connections = metrics.gauge('chat_websocket_connections_open', 'Open WebSocket connections.')
+room_connections = metrics.gauge('chat_websocket_room_connections',
+                                 'Open WebSocket connections per room, multiplexed ones counted in each room.',
+                                 ['room'], drop_zero=True)
+save_duration = metrics.histogram('chat_message_save_seconds',
+                                  'Time WebSocket message takes to be saved, or queued in enqueue durability mode.',
+                                  ['mode'])
+
+
+def buffered_messages():
+    """
+    :returns: Number of messages received by channel layer of this process and not yet taken by consumers.
+    """
+    layer = get_channel_layer()
+    buffers = getattr(layer, 'receive_buffer', None) or getattr(layer, 'channels', None) or {}
+    return sum(buffer.qsize() for buffer in list(buffers.values()))
+
+
+metrics.gauge('chat_channel_layer_buffered_messages', 'Messages waiting in channel layer buffers of consumers.',
+              function=buffered_messages)
+
+
+def connection_user(user):
+    """
+    :returns: CustomUser object to save messages with. For users authenticated with
+              access token, it is built from token claims instead of loaded from database.
+    """
+    if not isinstance(user, TokenUser):
+        return user
+    if not user.username:
+        # Token issued before it carried 'username' claim.
+        return CustomUser.objects.only('id', 'username').get(pk=user.pk)
+    return CustomUser(id=user.pk, username=user.username)
+
+
+def parse_frame(text_data):
+    """
+    :returns: Dict of client's JSON frame, None if it is not a JSON object.
+    """
+    try:
+        frame = json.loads(text_data or '')
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) else None
+
+
+def frame_id(value):
+    """
+    :returns: Id passed in client's frame, as number or string of digits, as int. None if it is not an id.
+    """
+    return int(value) if str(value).isdecimal() else None
+
+
+def close_room_connections(room_id):
+    """
+    Tells connections of the room that it was deleted. Single room connections are closed,
+    multiplexed ones are unsubscribed from the room.
+    """
+    async_to_sync(get_channel_layer().group_send)(room_group_name(room_id), {
+        'type': 'room_deleted',
+        'room_id': room_id,
+    })
+
+
+async def publish_presence(room_id, frame):
+    """
+    Sends presence frame to connections of the room.
+    """
+    await get_channel_layer().group_send(room_group_name(room_id), {
+        'type': 'room_presence',
+        'frame': frame,
+    })
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room_group_name = ''
-        self.room_id = ''
+        self.room_id = None     # Primary key of the room, resolved on connect.
+        self.user = None        # Connected user object, resolved on connect.
+        self.username = ''      # Username of connected user, resolved on connect.
+        self.outbox = None      # Frames waiting to be sent to client, created on accept.
+        self.replayed = {}      # Room id -> ids of messages replayed on resume, not to be sent again.
+        self.presence = None    # Presence tracker of the process, None if presence is disabled.
+        self.present_in = set()  # Ids of rooms user is marked online in by this connection.
+        self.counted_in = set()  # Ids of rooms this connection is counted in by room_connections metric.
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Stop sending frames also when application is cancelled by the server, without disconnect().
+            self.close_outbox()
+            for room_id in list(self.present_in):
+                self.leave_presence(room_id)
+            for room_id in list(self.counted_in):
+                self.uncount_room(room_id)
+
+    def count_room(self, room_id):
+        if room_id not in self.counted_in:
+            self.counted_in.add(room_id)
+            room_connections.inc(room=room_id)
+
+    def uncount_room(self, room_id):
+        if room_id in self.counted_in:
+            self.counted_in.discard(room_id)
+            room_connections.dec(room=room_id)
 
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'room_{self.room_id}'
+        # Reject unknown or inactive rooms and users who are not room members, before joining room group.
+        room_id = self.scope['url_route']['kwargs']['room_id']
+        if not await self.authorize(room_id):
+            await self.close()
+            return
+
+        self.room_id = int(room_id)
+        self.room_group_name = room_group_name(self.room_id)
 
         # Join room group.
         await self.channel_layer.group_add(
@@ -23,51 +150,349 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
         await self.accept()
+        self.open_outbox()
+        self.count_room(self.room_id)
+        await self.join_presence(self.room_id)
+
+        # Reconnecting client passes id of the last message it got, e.g. 'ws/1/?last_message_id=2'.
+        last_message_id = parse_qs(self.scope.get('query_string', b'').decode('latin1')).get('last_message_id')
+        if last_message_id:
+            await self.resume(self.room_id, last_message_id[0])
 
     async def disconnect(self, close_code):
+        # Connection was rejected, nothing to clean up.
+        if not self.room_group_name:
+            return
+
+        self.close_outbox()
+        self.leave_presence(self.room_id)
+        self.uncount_room(self.room_id)
+
         # Leave room group.
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
+        await self.flush_messages()
+
     # Receive message from WebSocket.
     async def receive(self, text_data=None, bytes_data=None):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        username = text_data_json['username']
-
-        # Save message to database.
-        await self.save_message(username, message)
-
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                'type': 'room_message',
-                'message': message,
-                'username': username
-            }
-        )
+        text_data_json = parse_frame(text_data)
+        if text_data_json is None:
+            await self.send(text_data=control_frame('error', self.room_id, error='bad_frame'))
+            return
+
+        # Client read messages up to given one.
+        if text_data_json.get('type') == 'read':
+            await self.read_frame(self.room_id, text_data_json)
+            return
+
+        # Client started or stopped typing, e.g. {"type": "typing", "typing": false}.
+        if text_data_json.get('type') == 'typing':
+            self.set_typing(self.room_id, text_data_json.get('typing', True))
+            return
+
+        await self.message_frame(self.room_id, text_data_json)
+
+    # Mark messages read, rejecting frames without message id.
+    async def read_frame(self, room_id, frame):
+        message_id = frame_id(frame.get('message_id'))
+        if message_id is None:
+            await self.send(text_data=control_frame('error', room_id, error='bad_frame'))
+            return
+        await self.mark_read(room_id, message_id)
+
+    # Post message, rejecting frames without message text.
+    async def message_frame(self, room_id, frame):
+        message = frame.get('message')
+        if not isinstance(message, str):
+            await self.send(text_data=control_frame('error', room_id, error='bad_frame'))
+            return
+        await self.post_message(room_id, message)
 
     # Receive message from room group.
     async def room_message(self, event):
-        message = event['message']
-        username = event['username']
+        # Message was already sent on resume.
+        if event.get('message_id') in self.replayed.get(event.get('room_id'), ()):
+            return
+
+        # Send message to WebSocket, as built by the sender, without waiting for slow clients.
+        if self.outbox is None:
+            await self.send(text_data=event['frame'])
+        else:
+            self.outbox.put(event['frame'], event.get('room_id'), event.get('message_id'))
+
+    # Receive presence changes from room group.
+    async def room_presence(self, event):
+        if self.outbox is None:
+            await self.send(text_data=event['frame'])
+        else:
+            self.outbox.put(event['frame'])
+
+    # Room was deleted, tell client and close connection.
+    async def room_deleted(self, event):
+        self.close_outbox()
+        await self.send(text_data=control_frame('room_deleted', event['room_id']))
+        await self.close(code=CLOSE_CODE_ROOM_DELETED)
+
+    # Send messages of the room client missed since the last one it got.
+    async def resume(self, room_id, last_message_id):
+        """
+        Queues missed messages ahead of live ones. Live messages are not handled until
+        this returns, so every missed message is sent once, in order. When too many
+        were missed, client is sent a 'gap' frame and fetches them from REST API.
+        """
+        last_message_id = frame_id(last_message_id)
+        missed = None
+        if last_message_id is not None:
+            missed = await database_sync_to_async(missed_messages)(
+                room_id, last_message_id, settings.CHAT_RESUME['MAX_MESSAGES'])
+
+        if missed is None:
+            self.outbox.put(control_frame('gap', room_id, after=last_message_id))
+            return
+
+        self.replayed[room_id] = {message_id for _, message_id in missed}
+        for frame, message_id in missed:
+            self.outbox.put(frame, room_id, message_id)
+        self.outbox.put(control_frame('resumed', room_id, count=len(missed)))
+
+    # Create queue of frames waiting to be sent to client.
+    def open_outbox(self):
+        config = settings.CHAT_OUTBOX
+        self.outbox = Outbox(self.send_frame, self.close_overflowed,
+                             max_frames=config['MAX_FRAMES'], policy=config['POLICY'])
+        self.outbox.start()
+        open_connections.inc()
+
+    def close_outbox(self):
+        if self.outbox is not None and not self.outbox.closed:
+            self.outbox.stop()
+            open_connections.dec()
+
+    async def send_frame(self, frame):
+        await self.send(text_data=frame)
+
+    # Close connection of a client which can't keep up with its rooms.
+    async def close_overflowed(self, resume):
+        # Client reconnects and resumes from ids of the last messages it got.
+        await self.send(text_data=control_frame('overflow', self.room_id, resume=resume))
+        await self.close(code=CLOSE_CODE_OVERFLOW)
 
-        # Save message to database.
-        # await self.save_message(message)
+    # Mark user online in the room and send users already online and typing there.
+    async def join_presence(self, room_id):
+        self.presence = get_presence_tracker(publish_presence)
+        if self.presence is None or room_id in self.present_in:
+            return
 
-        # Send message to WebSocket.
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username
-        }))
+        self.present_in.add(room_id)
+        self.presence.join(room_id, self.username)
+        snapshot = await self.presence.snapshot(room_id)
+        self.outbox.put(control_frame('presence', room_id, **snapshot))
 
-    # Create message object in database.
+    def leave_presence(self, room_id):
+        if room_id in self.present_in:
+            self.present_in.discard(room_id)
+            self.presence.leave(room_id, self.username)
+
+    def set_typing(self, room_id, typing=True):
+        if room_id in self.present_in:
+            self.presence.typing(room_id, self.username, bool(typing))
+
+    # Save message and send it to everyone in the room.
+    async def post_message(self, room_id, message):
+        self.set_typing(room_id, False)
+
+        # Save message to database. If it fails, sender is told and connection stays open.
+        try:
+            if settings.CHAT_MESSAGE_PIPELINE['WRITE_BEHIND']:
+                with save_duration.timer(mode='write_behind'):
+                    saved = await self.queue_message(room_id, message)
+            else:
+                with save_duration.timer(mode='direct'):
+                    saved = await self.save_message(room_id, message)
+        except Exception:
+            logger.exception('Saving message to room %s failed.', room_id)
+            await self.send(text_data=control_frame('error', room_id, error='not_saved'))
+            return
+
+        # Send message to room group, already serialized to its final wire frame.
+        with group_send_duration.timer():
+            await self.channel_layer.group_send(room_group_name(room_id), message_event(saved, self.username))
+
+    # Make sure queued messages are saved before connection is gone (e.g. on server shutdown).
+    async def flush_messages(self):
+        if settings.CHAT_MESSAGE_PIPELINE['WRITE_BEHIND']:
+            await get_message_writer().flush()
+
+    # Check room membership, resolving user once for the whole connection.
+    @database_sync_to_async
+    def authorize(self, room_id):
+        """
+        Caches authenticated user object and username.
+        Membership is checked against cached ids of room users, so joining usually takes no queries.
+
+        :returns: True if room exists, is active and user is its member.
+        """
+        user = self.scope['user']
+        if not user.is_authenticated or not str(room_id).isdigit():
+            return False
+
+        if user.pk not in get_room_member_ids(int(room_id)):
+            return False
+
+        if self.user is None:
+            self.user = connection_user(user)
+            self.username = self.user.username
+        return True
+
+    # Advance user's read cursor in the room.
     @database_sync_to_async
-    def save_message(self, username, message):
-        Message.objects.create(
-            room=Room.objects.get(id=self.room_id),  # Room object.
-            user=CustomUser.objects.get(username=username),  # User object.
+    def mark_read(self, room_id, message_id):
+        RoomReadCursor.advance(self.user.pk, room_id, message_id)
+
+    # Queue message object to be saved in a batch.
+    async def queue_message(self, room_id, message):
+        """
+        :returns: Saved Message object in 'persist' durability mode, queued one with reserved id otherwise.
+        """
+        writer = get_message_writer()
+        durable = settings.CHAT_MESSAGE_PIPELINE['DURABILITY'] != ENQUEUE or not writer.can_reserve_ids()
+        obj = Message(
+            room_id=room_id,  # Room id.
+            user=self.user,  # User object.
             text=message,  # Message text content.
-        )
\ No newline at end of file
+            timestamp=timezone.now(),  # Queue time, replaced with save time once saved.
+        )
+        # Queued message is broadcast with its id, so clients can resume after it and mark it read.
+        if not durable:
+            obj.id = await writer.next_id()
+        saved = writer.submit(obj, wait=durable)
+
+        # In 'persist' durability mode, wait until batch with this message is saved.
+        if durable:
+            return await saved
+        return obj
+
+    # Create message object in database. It is sent to room group by post_message(), right from event loop.
+    @database_sync_to_async
+    def save_message(self, room_id, message):
+        return create_message(room_id, self.user, message, publish=False)
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    Single connection subscribed to any number of rooms user is member of,
+    instead of a connection per room.
+
+    Client controls subscriptions with frames:
+        {"type": "subscribe", "room_id": 1}     - replied with 'subscribed' or 'error' frame,
+                                                  may carry "last_message_id" to resume room,
+        {"type": "unsubscribe", "room_id": 1}   - replied with 'unsubscribed' frame,
+    and talks to subscribed rooms with frames:
+        {"type": "message", "room_id": 1, "message": "Hi!"},
+        {"type": "read", "room_id": 1, "message_id": 2},
+        {"type": "typing", "room_id": 1, "typing": true}.
+    Frames which are not JSON objects or lack required fields are replied with
+    'error' frame with 'bad_frame' error.
+    Messages are sent to client the same way as to single room connections,
+    tagged with room id.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_ids = set()   # Primary keys of subscribed rooms.
+
+    async def connect(self):
+        # Rooms are authorized one by one on subscription.
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+
+        await self.accept()
+        self.open_outbox()
+
+    async def disconnect(self, close_code):
+        self.close_outbox()
+
+        # Leave groups of all subscribed rooms.
+        for room_id in self.room_ids:
+            self.leave_presence(room_id)
+            self.uncount_room(room_id)
+            await self.channel_layer.group_discard(
+                room_group_name(room_id),
+                self.channel_name
+            )
+        self.room_ids.clear()
+
+        await self.flush_messages()
+
+    # Receive control frame or message from WebSocket.
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = parse_frame(text_data)
+        if text_data_json is None:
+            await self.send(text_data=control_frame('error', None, error='bad_frame'))
+            return
+
+        frame_type = text_data_json.get('type', 'message')
+        room_id = frame_id(text_data_json.get('room_id'))
+
+        if frame_type == 'subscribe':
+            await self.subscribe(room_id, text_data_json.get('last_message_id'))
+        elif frame_type == 'unsubscribe':
+            await self.unsubscribe(room_id)
+        elif room_id not in self.room_ids:
+            await self.send(text_data=control_frame('error', room_id, error='not_subscribed'))
+        elif frame_type == 'read':
+            await self.read_frame(room_id, text_data_json)
+        elif frame_type == 'typing':
+            self.set_typing(room_id, text_data_json.get('typing', True))
+        elif frame_type == 'message':
+            await self.message_frame(room_id, text_data_json)
+        else:
+            await self.send(text_data=control_frame('error', room_id, error='unknown_type'))
+
+    async def subscribe(self, room_id, last_message_id=None):
+        if room_id not in self.room_ids:
+            if len(self.room_ids) >= settings.CHAT_MULTIPLEX['MAX_ROOMS']:
+                await self.send(text_data=control_frame('error', room_id, error='too_many_rooms'))
+                return
+
+            # Reject unknown or inactive rooms and rooms user is not member of.
+            if room_id is None or not await self.authorize(room_id):
+                await self.send(text_data=control_frame('error', room_id, error='not_allowed'))
+                return
+
+            self.room_ids.add(room_id)
+            self.count_room(room_id)
+            await self.channel_layer.group_add(
+                room_group_name(room_id),
+                self.channel_name
+            )
+
+        await self.send(text_data=control_frame('subscribed', room_id))
+        await self.join_presence(room_id)
+        if last_message_id is not None:
+            await self.resume(room_id, last_message_id)
+
+    # Room was deleted, unsubscribe from it and tell client.
+    async def room_deleted(self, event):
+        room_id = event['room_id']
+        if room_id in self.room_ids:
+            await self.unsubscribe(room_id, reply=False)
+            self.outbox.put(control_frame('room_deleted', room_id))
+
+    async def unsubscribe(self, room_id, reply=True):
+        if room_id in self.room_ids:
+            self.room_ids.discard(room_id)
+            self.replayed.pop(room_id, None)
+            self.leave_presence(room_id)
+            self.uncount_room(room_id)
+            await self.channel_layer.group_discard(
+                room_group_name(room_id),
+                self.channel_name
+            )
+
+        if reply:
+            await self.send(text_data=control_frame('unsubscribed', room_id))
@@ -0,0 +1,68 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Formats timestamps the same way REST API does.
+timestamp_field = serializers.DateTimeField()
+
+
+def encode_json(data):
+    """
+    :returns: JSON text of given data, encoded with encoder set in CHAT_FRAME_ENCODER setting.
+    """
+    if settings.CHAT_FRAME_ENCODER == 'orjson':
+        if orjson is None:
+            raise ImproperlyConfigured("CHAT_FRAME_ENCODER is 'orjson', but orjson package is not installed.")
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data)
+
+
+def message_frame(message, username):
+    """
+    Builds wire frame of a message, as sent to every room member.
+    It is built once by the sender and forwarded unchanged by recipients.
+    Frame is tagged with room id, so that connections subscribed to many rooms can tell rooms apart.
+
+    :returns: JSON text of given Message object.
+    """
+    return encode_json({
+        'type': 'message',
+        'room_id': message.room_id,
+        'id': message.id,
+        'message': message.text,
+        'username': username,
+        'timestamp': timestamp_field.to_representation(message.timestamp),
+    })
+
+
+def cached_message_frame(item):
+    """
+    Builds the same wire frame as message_frame(), from message representation
+    stored in recent messages cache (history_cache.message_representation).
+
+    :returns: JSON text of the message.
+    """
+    return encode_json({
+        'type': 'message',
+        'room_id': item['room'],
+        'id': item['id'],
+        'message': item['text'],
+        'username': item['user'],
+        'timestamp': item['timestamp'],
+    })
+
+
+def control_frame(frame_type, room_id, **fields):
+    """
+    Builds wire frame of a reply to client's control frame, e.g. 'subscribe'.
+
+    :returns: JSON text of the frame.
+    """
+    return encode_json({'type': frame_type, 'room_id': room_id, **fields})
@@ -0,0 +1,235 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from api.frames import timestamp_field
+
+
+def message_representation(message):
+    """
+    :returns: Message object serialized the same way MessageSerializer does.
+    """
+    return OrderedDict([
+        ('id', message.id),
+        ('room', message.room_id),
+        ('user', message.user.username if message.user_id else None),
+        ('text', message.text),
+        ('timestamp', timestamp_field.to_representation(message.timestamp)),
+    ])
+
+
+class LocMemHistoryCache:
+    """
+    In-process store of the most recent serialized messages of each room.
+
+    Rooms are evicted in least recently used order once estimated size of all
+    stored messages exceeds max_bytes. Only messages saved by this process are
+    appended, so it is meant for single process deployments.
+    """
+
+    def __init__(self, size=50, ttl=300, max_bytes=64 * 1024 * 1024):
+        self.size = size                # Max messages stored per room.
+        self.ttl = ttl                  # Seconds room is stored for.
+        self.max_bytes = max_bytes      # Max estimated size of all stored messages.
+        self.bytes = 0                  # Estimated size of all stored messages.
+        self.rooms = OrderedDict()      # Room id -> dict with stored messages, least recently used first.
+        self.filling = {}               # Room id -> token of fills in progress.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate(item):
+        """
+        :returns: Rough memory footprint of serialized message in bytes.
+        """
+        return len(json.dumps(item)) + 256
+
+    def get(self, room_id):
+        """
+        :returns: Tuple of (room message count, list of recent messages newest first), or None on miss.
+        """
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            if room['expires'] < time.monotonic():
+                self.drop(room_id)
+                return None
+            self.rooms.move_to_end(room_id)
+            return room['count'], list(room['items'])
+
+    def begin_fill(self, room_id):
+        """
+        Marks that recent messages of the room are about to be read from database.
+
+        :returns: Token to be passed to fill().
+        """
+        with self.lock:
+            return self.filling.setdefault(room_id, object())
+
+    def fill(self, room_id, count, items, token):
+        """
+        Stores recent messages read from database, unless room was written to since begin_fill().
+        """
+        with self.lock:
+            if self.filling.get(room_id) is not token:
+                return
+            del self.filling[room_id]
+
+            self.drop(room_id)
+            items = items[:self.size]
+            self.rooms[room_id] = {
+                'count': count,
+                'items': items,
+                'sizes': [self.estimate(item) for item in items],
+                'expires': time.monotonic() + self.ttl,
+            }
+            self.bytes += sum(self.rooms[room_id]['sizes'])
+            self.evict()
+
+    def append(self, message):
+        """
+        Adds newly saved Message object to its room, if room is stored.
+        """
+        item = message_representation(message)
+        with self.lock:
+            room = self.rooms.get(message.room_id)
+            if room is None:
+                # Fill in progress may have read database before this message was saved.
+                if message.room_id in self.filling:
+                    self.filling[message.room_id] = object()
+                return
+
+            size = self.estimate(item)
+            room['count'] += 1
+            room['items'].insert(0, item)
+            room['sizes'].insert(0, size)
+            self.bytes += size
+            if len(room['items']) > self.size:
+                room['items'].pop()
+                self.bytes -= room['sizes'].pop()
+            self.evict()
+
+    def invalidate(self, room_id):
+        """
+        Forgets stored messages of the room.
+        """
+        with self.lock:
+            self.drop(room_id)
+            if room_id in self.filling:
+                self.filling[room_id] = object()
+
+    def drop(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is not None:
+            self.bytes -= sum(room['sizes'])
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.rooms:
+            self.drop(next(iter(self.rooms)))
+
+
+class RedisHistoryCache:
+    """
+    Redis store of the most recent serialized messages of each room, shared by all processes.
+
+    Each room is a list of JSON encoded messages plus a message count and a write
+    generation counter, all expiring after ttl seconds. Memory is capped by Redis
+    itself, set its 'maxmemory-policy' to 'allkeys-lru' or 'volatile-lru'.
+    """
+
+    # Pushes message to the list only if room is stored. Always bumps generation.
+    APPEND_SCRIPT = """
+        redis.call('INCR', KEYS[3])
+        redis.call('EXPIRE', KEYS[3], ARGV[3])
+        if redis.call('EXISTS', KEYS[2]) == 0 then
+            return 0
+        end
+        redis.call('LPUSH', KEYS[1], ARGV[1])
+        redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+        redis.call('INCR', KEYS[2])
+        return 1
+    """
+
+    # Replaces stored room only if generation did not change since ARGV[1] was read.
+    FILL_SCRIPT = """
+        if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+            return 0
+        end
+        redis.call('DEL', KEYS[1])
+        if #ARGV > 3 then
+            redis.call('RPUSH', KEYS[1], unpack(ARGV, 4))
+            redis.call('EXPIRE', KEYS[1], ARGV[3])
+        end
+        redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+        return 1
+    """
+
+    def __init__(self, size=50, ttl=300, location='redis://localhost:6379/0', prefix='chat:history'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisHistoryCache requires redis package.')
+
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(location)
+        self.append_script = self.client.register_script(self.APPEND_SCRIPT)
+        self.fill_script = self.client.register_script(self.FILL_SCRIPT)
+
+    def keys(self, room_id):
+        """
+        :returns: List of keys holding messages, message count and generation of the room.
+        """
+        return [f'{self.prefix}:{room_id}', f'{self.prefix}:{room_id}:count', f'{self.prefix}:{room_id}:gen']
+
+    def get(self, room_id):
+        items_key, count_key, _ = self.keys(room_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(count_key)
+        pipe.lrange(items_key, 0, self.size - 1)
+        count, items = pipe.execute()
+        if count is None:
+            return None
+        return int(count), [json.loads(item) for item in items]
+
+    def begin_fill(self, room_id):
+        return (self.client.get(self.keys(room_id)[2]) or b'0').decode('ascii')
+
+    def fill(self, room_id, count, items, token):
+        args = [token, count, self.ttl] + [json.dumps(item) for item in items[:self.size]]
+        self.fill_script(keys=self.keys(room_id), args=args)
+
+    def append(self, message):
+        args = [json.dumps(message_representation(message)), self.size, self.ttl]
+        self.append_script(keys=self.keys(message.room_id), args=args)
+
+    def invalidate(self, room_id):
+        items_key, count_key, gen_key = self.keys(room_id)
+        pipe = self.client.pipeline()
+        pipe.delete(items_key, count_key)
+        pipe.incr(gen_key)
+        pipe.expire(gen_key, self.ttl)
+        pipe.execute()
+
+
+_history_cache = None
+
+
+def get_history_cache():
+    """
+    :returns: Process-wide recent messages store configured with CHAT_HISTORY_CACHE setting, or None if disabled.
+    """
+    global _history_cache
+    config = settings.CHAT_HISTORY_CACHE
+    if not config.get('BACKEND'):
+        return None
+    if _history_cache is None:
+        options = {key.lower(): value for key, value in config.items() if key != 'BACKEND'}
+        _history_cache = import_string(config['BACKEND'])(**options)
+    return _history_cache
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from api.models import RoomInviteKey, get_invite_key_string, get_inivite_key_expire_date
+
+
+class UnknownInviteKeys:
+    """
+    In-process cache of invite key strings that were looked up and don't exist or expired,
+    so that guessed keys and stale links are rejected without database queries.
+
+    Keys are forgotten after ttl seconds, or in least recently added order once there are
+    more than size of them. New keys are random, so they are practically never cached before
+    they are created; keys created by this process are forgotten at once anyway.
+    """
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size                # Max cached keys.
+        self.ttl = ttl                  # Seconds key is cached for.
+        self.keys = OrderedDict()       # Key string -> expiry time, oldest first.
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.keys.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.keys[key]
+                return False
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+            self.keys[key] = time.monotonic() + self.ttl
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+
+_unknown_invite_keys = None
+
+
+def get_unknown_invite_keys():
+    """
+    :returns: UnknownInviteKeys of this process, configured by CHAT_INVITE_KEYS setting.
+    """
+    global _unknown_invite_keys
+    if _unknown_invite_keys is None:
+        config = settings.CHAT_INVITE_KEYS
+        _unknown_invite_keys = UnknownInviteKeys(size=config['UNKNOWN_CACHE_SIZE'], ttl=config['UNKNOWN_CACHE_TTL'])
+    return _unknown_invite_keys
+
+
+def create_invite_keys(room, creator, users, give_admin=False, attempts=3):
+    """
+    Creates invite keys of the room with a single INSERT, one for each of given users.
+    Keys are random, so they are practically never taken; if one of them is, all of them are generated again.
+
+    :returns: List of created RoomInviteKey objects.
+    """
+    valid_due = get_inivite_key_expire_date()
+    for attempt in range(attempts):
+        keys = set()
+        while len(keys) < len(users):
+            keys.add(get_invite_key_string())
+
+        invite_keys = [
+            RoomInviteKey(key=key, room=room, creator=creator, only_for_this_user=user, valid_due=valid_due,
+                          give_admin=give_admin)
+            for key, user in zip(keys, users)
+        ]
+        try:
+            with transaction.atomic():
+                RoomInviteKey.objects.bulk_create(invite_keys)
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+            continue
+
+        unknown_keys = get_unknown_invite_keys()
+        for key in keys:
+            unknown_keys.discard(key)
+        return invite_keys
@@ -0,0 +1,92 @@
+import itertools
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api.archive import archive_messages
+from api.history_cache import get_history_cache
+from api.models import Message, Room
+from api.partitions import drop_partition, is_partitioned, message_partitions
+
+
+class Command(BaseCommand):
+    help = ('Moves messages older than CHAT_ARCHIVE AFTER_DAYS from database to per-room archive files. '
+            'On partitioned message table, whole monthly partitions are archived and dropped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE['AFTER_DAYS'],
+                            help='Archive messages older than this many days.')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE['BATCH_SIZE'],
+                            help='Messages archived at once.')
+
+    def handle(self, *args, **options):
+        if not settings.CHAT_ARCHIVE['DIRECTORY']:
+            raise CommandError('Archiving is disabled, set CHAT_ARCHIVE DIRECTORY setting.')
+
+        cutoff = timezone.now() - timezone.timedelta(days=options['days'])
+        self.rooms = set()  # Ids of rooms messages were archived from.
+        try:
+            if is_partitioned():
+                archived = self.archive_partitions(cutoff, options['batch_size'])
+            else:
+                archived = self.archive_rows(cutoff, options['batch_size'])
+        finally:
+            # Archived messages no longer count, activity counters and cached history of rooms are rebuilt
+            # once, after all batches, also if archiving stopped half way.
+            Room.rebuild_activity(Room.all_objects.filter(id__in=self.rooms))
+            cache = get_history_cache()
+            if cache is not None:
+                for room_id in self.rooms:
+                    cache.invalidate(room_id)
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} messages older than {cutoff}.'))
+
+    def archive_partitions(self, cutoff, batch_size):
+        """
+        Archives partitions holding only messages older than cutoff, then drops them,
+        which is instant and leaves nothing to vacuum.
+
+        :returns: Number of archived messages.
+        """
+        archived = 0
+        for partition in message_partitions():
+            if partition.end is None or partition.end > cutoff:
+                continue
+
+            messages = Message.objects.filter(timestamp__lt=partition.end)
+            if partition.start is not None:
+                messages = messages.filter(timestamp__gte=partition.start)
+            messages = messages.select_related('user').order_by().iterator(chunk_size=batch_size)
+
+            with transaction.atomic():
+                while True:
+                    batch = list(itertools.islice(messages, batch_size))
+                    if not batch:
+                        break
+                    archived += archive_messages(batch)
+                    self.rooms.update(message.room_id for message in batch)
+                drop_partition(partition.name)
+            self.stdout.write(f'Archived and dropped partition {partition.name}, {archived} messages so far...')
+        return archived
+
+    def archive_rows(self, cutoff, batch_size):
+        """
+        Archives messages older than cutoff in batches, deleting each batch once it is archived.
+
+        :returns: Number of archived messages.
+        """
+        old = Message.objects.filter(timestamp__lt=cutoff)
+
+        archived = 0
+        while True:
+            # Oldest messages have the lowest ids, so each batch is read from the start of primary key index.
+            batch = list(old.select_related('user').order_by('id')[:batch_size])
+            if not batch:
+                break
+            archive_messages(batch)
+            Message.objects.filter(id__in=[message.id for message in batch]).delete()
+            self.rooms.update(message.room_id for message in batch)
+            archived += len(batch)
+            self.stdout.write(f'Archived {archived} messages...')
+        return archived
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from api.benchmarks import get_bench_user, measure, seed_room, summarize
+
+LOGGERS = {
+    'none': None,
+    'drf_api_logger': 'drf_api_logger.middleware.api_logger_middleware.APILoggerMiddleware',
+    'buffered': 'api.api_logger.BufferedAPILoggerMiddleware',
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures latency API access logging middleware adds to message history requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Measured requests per logger.')
+        parser.add_argument('--limit', type=int, default=50, help='Messages per response.')
+
+    def handle(self, *args, **options):
+        user = get_bench_user()
+        room = seed_room(user, options['limit'], name='bench api logger')
+        path = f"/api/messages/?room_id={room.id}&limit={options['limit']}&offset=1"
+
+        base_middleware = [m for m in settings.MIDDLEWARE if m not in LOGGERS.values()]
+        results = {}
+        self.stdout.write(f"{'logger':>15} {'p50 ms':>10} {'p99 ms':>10} {'p50 overhead':>13} {'p99 overhead':>13}")
+        for name, middleware in LOGGERS.items():
+            with override_settings(MIDDLEWARE=base_middleware + ([middleware] if middleware else []),
+                                   CHAT_HISTORY_CACHE={'BACKEND': None}):
+                client = APIClient(SERVER_NAME='localhost')
+                client.force_authenticate(user)
+                results[name] = stats = summarize(measure(lambda: client.get(path), options['requests'], warmup=10))
+
+            self.stdout.write(
+                f"{name:>15} {stats['p50_ms']:>10} {stats['p99_ms']:>10} "
+                f"{round(stats['p50_ms'] - results['none']['p50_ms'], 3):>13} "
+                f"{round(stats['p99_ms'] - results['none']['p99_ms'], 3):>13}"
+            )
+
+        room.delete()
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+
+from api import metrics
+from api.consumers import ChatConsumer
+from api.frames import message_frame
+from api.models import Message
+from api.outbox import POLICIES
+
+
+class Command(BaseCommand):
+    help = ('Delivers room messages to fast clients and clients which stopped reading, '
+            'with each outbox policy and without outbox. Reports how fast fast clients get messages '
+            'and what happens to queues of stalled ones.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fast', type=int, default=100, help='Clients reading as fast as possible.')
+        parser.add_argument('--stalled', type=int, default=5, help='Clients which stopped reading.')
+        parser.add_argument('--messages', type=int, default=5000, help='Messages sent to the room.')
+        parser.add_argument('--max-frames', type=int, default=1000, help='Outbox size.')
+        parser.add_argument('--timeout', type=float, default=5, help='Max seconds spent on each mode.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'mode':>12} {'delivered':>10} {'msg/s':>10} {'stalled depth':>14} {'dropped':>8}")
+        for policy in (None,) + POLICIES:
+            config = dict(settings.CHAT_OUTBOX, POLICY=policy or settings.CHAT_OUTBOX['POLICY'],
+                          MAX_FRAMES=options['max_frames'])
+            with override_settings(CHAT_OUTBOX=config):
+                delivered, elapsed, depth = asyncio.run(self.deliver(policy is not None, options))
+
+            dropped = sum(value for labels, value in metrics.snapshot()['chat_outbox_frames_dropped_total']
+                          if labels['policy'] == policy)
+            self.stdout.write(
+                f"{policy or 'no outbox':>12} {delivered:>10} {round(delivered / elapsed):>10} "
+                f"{depth:>14} {int(dropped):>8}"
+            )
+
+    async def deliver(self, use_outbox, options):
+        """
+        :returns: Tuple of (messages delivered to every fast client, seconds, max outbox depth of stalled clients).
+        """
+        stalled_forever = asyncio.Event()
+
+        async def discard(message):
+            pass
+
+        async def stall(message):
+            await stalled_forever.wait()
+
+        consumers = []
+        for send in [discard] * options['fast'] + [stall] * options['stalled']:
+            consumer = ChatConsumer()
+            consumer.base_send = send
+            consumer.room_id = 1
+            if use_outbox:
+                consumer.open_outbox()
+            consumers.append(consumer)
+
+        message = Message(room_id=1, user_id=1, text='Lorem ipsum dolor sit amet.', timestamp=timezone.now())
+        delivered = 0
+        started = time.perf_counter()
+        try:
+            for message_id in range(1, options['messages'] + 1):
+                message.id = message_id
+                event = {'type': 'room_message', 'frame': message_frame(message, 'bench_user'),
+                         'room_id': 1, 'message_id': message_id}
+                remaining = options['timeout'] - (time.perf_counter() - started)
+                await asyncio.wait_for(asyncio.gather(*(c.room_message(event) for c in consumers)), remaining)
+                # Let outbox tasks send frames.
+                await asyncio.sleep(0)
+                delivered += 1
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+
+        depth = max((len(c.outbox) for c in consumers if c.outbox is not None and c.base_send is stall), default=0)
+        for consumer in consumers:
+            consumer.close_outbox()
+        return delivered, elapsed, depth
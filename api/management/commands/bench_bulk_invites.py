@@ -0,0 +1,79 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import get_bench_user, seed_room
+from api.models import CustomUser, Room, RoomInviteKey
+from api.views import JoinRoomView, RoomInviteKeyViewSet, RoomViewSet
+
+
+class Command(BaseCommand):
+    help = ('Measures onboarding a cohort of users into a room: an invite key request and a join request '
+            'per user, against one bulk invite key request and one bulk members request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cohorts', default='100,1000,5000', help='Comma separated numbers of onboarded users.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms and users afterwards.')
+
+    def handle(self, *args, **options):
+        creator = get_bench_user()
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        key_create = RoomInviteKeyViewSet.as_view({'post': 'create'})
+        key_bulk = RoomInviteKeyViewSet.as_view({'post': 'bulk'})
+        members = RoomViewSet.as_view({'post': 'members'})
+        join = JoinRoomView.as_view()
+        rooms = []
+
+        def post(view, user, data=None, **kwargs):
+            request = factory.post('/', data, format='json')
+            force_authenticate(request, user=user)
+            response = view(request, **kwargs)
+            response.render()
+            assert response.status_code in (200, 201), response.data
+            return response.data
+
+        def per_item(room, users):
+            for user in users:
+                key = post(key_create, creator, {'room': room.pk, 'only_for_this_user': user.username})['key']
+                post(join, user, invite_key=key)
+
+        def bulk(room, users):
+            usernames = [user.username for user in users]
+            post(key_bulk, creator, {'room': room.pk, 'only_for_users': usernames})
+            post(members, creator, {'users': usernames}, pk=room.pk)
+
+        self.stdout.write(f"{'cohort':>8} {'path':>10} {'queries':>8} {'seconds':>10} {'users/s':>10}")
+        for cohort in [int(count) for count in options['cohorts'].split(',')]:
+            prefix = f'bench_cohort_{cohort}_'
+            CustomUser.objects.filter(username__startswith=prefix).delete()
+            CustomUser.objects.bulk_create(CustomUser(username=f'{prefix}{i}') for i in range(cohort))
+            users = list(CustomUser.objects.filter(username__startswith=prefix).order_by('id'))
+
+            for name, onboard in (('per item', per_item), ('bulk', bulk)):
+                room = seed_room(creator, 0, name='bench bulk invites')
+                rooms.append(room)
+                # Queries are counted by a wrapper, query log only keeps the last 9000 of them.
+                queries = []
+
+                def count_query(execute, sql, *args):
+                    queries.append(sql)
+                    return execute(sql, *args)
+
+                started = time.perf_counter()
+                with connection.execute_wrapper(count_query):
+                    onboard(room, users)
+                elapsed = time.perf_counter() - started
+                assert room.users.filter(username__startswith=prefix).count() == cohort
+                self.stdout.write(
+                    f"{cohort:>8} {name:>10} {len(queries):>8} {elapsed:>10.3f} {round(cohort / elapsed):>10}"
+                )
+
+            if not options['keep']:
+                CustomUser.objects.filter(username__startswith=prefix).delete()
+
+        if not options['keep']:
+            room_ids = [room.id for room in rooms]
+            RoomInviteKey.objects.filter(room_id__in=room_ids).delete()
+            Room.objects.filter(id__in=room_ids).delete()
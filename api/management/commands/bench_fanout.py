@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+
+from api.benchmarks import measure, summarize
+from api.consumers import ChatConsumer
+from api.frames import message_frame, orjson
+from api.models import Message
+
+
+async def discard(message):
+    """
+    Stands in for ASGI server's send, so only consumer-side cost is measured.
+    """
+
+
+class Command(BaseCommand):
+    help = 'Measures CPU cost of delivering one room message to all room members on a single worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,2000,5000', help='Comma separated room sizes.')
+        parser.add_argument('--samples', type=int, default=20, help='Messages per measured room size.')
+
+    def handle(self, *args, **options):
+        message = Message(id=1, room_id=1, user_id=1, text='Lorem ipsum dolor sit amet. ' * 4,
+                          timestamp=timezone.now())
+        username = 'bench_user'
+
+        async def legacy_room_message(consumer, event):
+            # Every recipient serialized the event on its own.
+            await consumer.send(text_data=json.dumps({
+                'id': event['id'],
+                'message': event['message'],
+                'username': event['username'],
+                'timestamp': event['timestamp']
+            }))
+
+        legacy_event = json.loads(message_frame(message, username))
+
+        async def per_recipient(consumers):
+            event = dict(legacy_event, type='room_message')
+            for consumer in consumers:
+                await legacy_room_message(consumer, event)
+
+        async def precomputed(consumers):
+            event = {'type': 'room_message', 'frame': message_frame(message, username)}
+            for consumer in consumers:
+                await consumer.room_message(event)
+
+        encoders = ['json'] + (['orjson'] if orjson is not None else [])
+        modes = [('per-recipient', 'json', per_recipient)] + [('precomputed', e, precomputed) for e in encoders]
+
+        self.stdout.write(f"{'room size':>10} {'mode':>14} {'encoder':>8} {'p50 ms/msg':>12} {'us/recipient':>13}")
+        loop = asyncio.new_event_loop()
+        for size in (int(size) for size in options['sizes'].split(',')):
+            consumers = [ChatConsumer() for _ in range(size)]
+            for consumer in consumers:
+                consumer.base_send = discard
+
+            for mode, encoder, deliver in modes:
+                with override_settings(CHAT_FRAME_ENCODER=encoder):
+                    stats = summarize(measure(lambda: loop.run_until_complete(deliver(consumers)), options['samples']))
+                self.stdout.write(
+                    f"{size:>10} {mode:>14} {encoder:>8} {stats['p50_ms']:>12} "
+                    f"{round(stats['p50_ms'] * 1000 / size, 3):>13}"
+                )
+        loop.close()
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import get_bench_user, measure, seed_room, summarize
+from api.models import Message, Room
+from api.views import MessageViewSet
+
+
+class Command(BaseCommand):
+    help = 'Seeds a large room and compares offset and cursor message history page latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000, help='Number of messages to seed.')
+        parser.add_argument('--room', type=int, help='Use existing room instead of seeding a new one.')
+        parser.add_argument('--limit', type=int, default=50, help='Page size.')
+        parser.add_argument('--samples', type=int, default=20, help='Requests per measured page.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded room afterwards.')
+
+    def handle(self, *args, **options):
+        user = get_bench_user()
+        if options['room']:
+            room = Room.objects.get(id=options['room'])
+            room.users.add(user)
+        else:
+            self.stdout.write(f"Seeding room with {options['messages']} messages...")
+            room = seed_room(user, options['messages'], name='bench history')
+
+        total = Message.objects.filter(room=room).count()
+        limit = options['limit']
+        view = MessageViewSet.as_view({'get': 'list'})
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+
+        def fetch(params):
+            request = factory.get('/api/messages/', dict(params, room_id=room.id, limit=limit))
+            force_authenticate(request, user=user)
+            response = view(request)
+            response.render()
+            assert response.status_code == 200, response.data
+
+        self.stdout.write(f'Room {room.id}: {total} messages, page size {limit}.')
+        self.stdout.write(f"{'depth':>10} {'mode':>8} {'p50 ms':>10} {'p95 ms':>10} {'mean ms':>10}")
+
+        history = Message.objects.filter(room=room).order_by('-timestamp', '-id')
+        for depth in sorted({0, total // 10, total // 2, max(total - limit, 0)}):
+            # Message just above requested depth is used as cursor anchor (not timed).
+            anchor = history.values_list('id', flat=True)[depth - 1] if depth else None
+
+            modes = [('offset', {'offset': depth})]
+            modes.append(('cursor', {'before': anchor} if anchor else {'cursor': ''}))
+
+            for mode, params in modes:
+                stats = summarize(measure(lambda: fetch(params), options['samples']))
+                self.stdout.write(
+                    f"{depth:>10} {mode:>8} {stats['p50_ms']:>10} {stats['p95_ms']:>10} {stats['mean_ms']:>10}"
+                )
+
+        if not options['room'] and not options['keep']:
+            room.delete()
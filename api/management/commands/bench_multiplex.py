@@ -0,0 +1,69 @@
+import asyncio
+import time
+import tracemalloc
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.asgi import application
+from api.benchmarks import get_bench_user, seed_room
+from api.models import Room
+from api.serializers import ChatTokenObtainPairSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compares a user joining many rooms with a connection per room (ws/<room_id>/) '
+            'against a single multiplexed connection (ws/) subscribed to all of them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=40, help='Number of rooms the user is in.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms afterwards.')
+
+    def handle(self, *args, **options):
+        user = get_bench_user()
+        rooms = [seed_room(user, 0, name='bench multiplex') for _ in range(options['rooms'])]
+        room_ids = [room.id for room in rooms]
+        token = str(ChatTokenObtainPairSerializer.get_token(user).access_token)
+
+        self.stdout.write(f"{'mode':>12} {'connections':>12} {'join ms':>10} {'memory KiB':>11}")
+        for mode, join in (('per room', self.join_per_room), ('multiplexed', self.join_multiplexed)):
+            tracemalloc.start()
+            started = time.perf_counter()
+            connections = asyncio.run(join(room_ids, token))
+            elapsed = time.perf_counter() - started
+            memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stdout.write(f"{mode:>12} {connections:>12} {round(elapsed * 1000, 3):>10} {memory // 1024:>11}")
+
+        if not options['keep']:
+            Room.objects.filter(id__in=room_ids).delete()
+
+    async def join_per_room(self, room_ids, token):
+        """
+        :returns: Number of connections needed to join all rooms.
+        """
+        communicators = [WebsocketCommunicator(application, f'ws/{room_id}/?token={token}') for room_id in room_ids]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected
+        for communicator in communicators:
+            await communicator.disconnect()
+        return len(communicators)
+
+    async def join_multiplexed(self, room_ids, token):
+        """
+        :returns: Number of connections needed to join all rooms.
+        """
+        communicator = WebsocketCommunicator(application, f'ws/?token={token}')
+        connected, _ = await communicator.connect()
+        assert connected
+        for room_id in room_ids:
+            await communicator.send_json_to({'type': 'subscribe', 'room_id': room_id})
+            reply = await communicator.receive_json_from()
+            assert reply['type'] == 'subscribed', reply
+            if settings.CHAT_PRESENCE['BACKEND']:
+                # Users online in the room.
+                await communicator.receive_json_from()
+        await communicator.disconnect()
+        return 1
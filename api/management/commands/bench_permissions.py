@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import add_room_members, delete_room_members, get_bench_user, measure, seed_room, summarize
+from api.membership import RoomMembership
+from api.models import Room, RoomInviteKey
+from api.views import RoomInviteKeyViewSet, RoomViewSet
+
+
+class Command(BaseCommand):
+    help = ('Measures room admin checks in rooms with thousands of admins and users: '
+            'loading the whole admin list against a single EXISTS query, '
+            'and room retrieve and invite key create requests using the latter.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', default='10,1000,5000', help='Comma separated numbers of room admins/users.')
+        parser.add_argument('--samples', type=int, default=50, help='Measured checks/requests per room size.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms and users afterwards.')
+
+    def handle(self, *args, **options):
+        creator = get_bench_user()
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        room_detail = RoomViewSet.as_view({'get': 'retrieve'})
+        key_list = RoomInviteKeyViewSet.as_view({'post': 'create'})
+        rooms = []
+
+        self.stdout.write(f"{'members':>8} {'check':>22} {'queries':>8} {'p50 ms':>10} {'p95 ms':>10}")
+        for members in [int(count) for count in options['members'].split(',')]:
+            room = seed_room(creator, 0, name='bench permissions')
+            rooms.append(room)
+            # Last added user is the last one found when scanning admin list.
+            user = add_room_members(room, members)[-1]
+
+            def admin_list_check():
+                # Check done by permission classes before: every admin row is loaded.
+                return user in Room.objects.get(pk=room.pk).admins.all()
+
+            def exists_check():
+                return RoomMembership(user).is_admin(room.pk)
+
+            def retrieve_request():
+                request = factory.get('/', {'fields': 'id,name'})
+                force_authenticate(request, user=user)
+                response = room_detail(request, pk=room.pk)
+                response.render()
+                assert response.status_code == 200, response.data
+
+            def invite_key_request():
+                request = factory.post('/', {'room': room.pk}, format='json')
+                force_authenticate(request, user=user)
+                response = key_list(request)
+                response.render()
+                assert response.status_code == 201, response.data
+
+            for name, check in (('admin list', admin_list_check), ('exists', exists_check),
+                                ('room retrieve', retrieve_request), ('invite key create', invite_key_request)):
+                with CaptureQueriesContext(connection) as queries:
+                    check()
+                stats = summarize(measure(check, options['samples'], warmup=0))
+                self.stdout.write(
+                    f"{members:>8} {name:>22} {len(queries):>8} {stats['p50_ms']:>10} {stats['p95_ms']:>10}"
+                )
+
+        if not options['keep']:
+            room_ids = [room.id for room in rooms]
+            RoomInviteKey.objects.filter(room_id__in=room_ids).delete()
+            delete_room_members(room_ids)
+            Room.objects.filter(id__in=room_ids).delete()
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import get_bench_user, measure, seed_room, summarize
+from api.models import Message, Room, RoomReadCursor
+from api.views import MessageViewSet, RoomViewSet
+
+
+class Command(BaseCommand):
+    help = ('Compares drawing a sidebar of a user in many rooms with one room list request '
+            'plus one message request per room, against a single room summary request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=500, help='Number of rooms the user is in.')
+        parser.add_argument('--messages', type=int, default=20, help='Number of messages in each room.')
+        parser.add_argument('--samples', type=int, default=5, help='Measured sidebar loads.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms afterwards.')
+
+    def handle(self, *args, **options):
+        user = get_bench_user('bench_summary_user')
+        sender = get_bench_user()
+
+        self.stdout.write(f"Seeding {options['rooms']} rooms with {options['messages']} messages each...")
+        rooms = [seed_room(sender, options['messages'], name='bench summary') for _ in range(options['rooms'])]
+        for room in rooms:
+            room.users.add(user)
+        # User has read half of the messages in half of the rooms.
+        for room in rooms[::2]:
+            middle = Message.objects.filter(room=room).order_by('id').values_list('id', flat=True)[
+                options['messages'] // 2]
+            RoomReadCursor.advance(user.pk, room.id, middle)
+
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        room_list = RoomViewSet.as_view({'get': 'list'})
+        message_list = MessageViewSet.as_view({'get': 'list'})
+
+        def get(view, params):
+            request = factory.get('/', params)
+            force_authenticate(request, user=user)
+            response = view(request)
+            response.render()
+            assert response.status_code == 200, response.data
+            return response.data
+
+        def per_room_requests():
+            for room in get(room_list, {'fields': 'id,name'}):
+                get(message_list, {'room_id': room['id'], 'limit': 1})
+
+        def summary_request():
+            get(room_list, {'fields': 'id,name,last_message,message_count,unread_count', 'summary': 'true'})
+
+        self.stdout.write(f"{'mode':>18} {'requests':>9} {'queries':>8} {'p50 ms':>10} {'p95 ms':>10}")
+        with override_settings(CHAT_HISTORY_CACHE={'BACKEND': None}):
+            for mode, requests, load in (('request per room', len(rooms) + 1, per_room_requests),
+                                         ('summary', 1, summary_request)):
+                with CaptureQueriesContext(connection) as queries:
+                    load()
+                stats = summarize(measure(load, options['samples'], warmup=0))
+                self.stdout.write(
+                    f"{mode:>18} {requests:>9} {len(queries):>8} {stats['p50_ms']:>10} {stats['p95_ms']:>10}"
+                )
+
+        if not options['keep']:
+            Room.objects.filter(id__in=[room.id for room in rooms]).delete()
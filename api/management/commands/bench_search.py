@@ -0,0 +1,118 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import get_bench_user, measure, summarize
+from api.models import Message, Room
+from api.search import is_full_text_supported
+from api.views import MessageViewSet
+
+# Messages are made of words 'w0'...'w<VOCABULARY - 1>', lower numbers being far more common.
+VOCABULARY = 100000
+WORDS_PER_MESSAGE = 6
+
+# Searched texts, from very common words to rare ones.
+QUERIES = ['w1', 'w50', 'w2000', 'w90000', 'w3 w20', '"w1 w2"', 'w5 -w1']
+
+
+def random_word():
+    return f'w{int(random.random() ** 3 * VOCABULARY)}'
+
+
+class Command(BaseCommand):
+    help = ('Seeds rooms with messages of random words and measures latency of message search '
+            'requests, for words of different frequency. Use --messages in tens of millions on PostgreSQL.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000, help='Number of messages to seed.')
+        parser.add_argument('--rooms', type=int, default=100, help='Rooms messages are spread over.')
+        parser.add_argument('--batch-size', type=int, default=1000000, help='Messages inserted with one query.')
+        parser.add_argument('--no-seed', action='store_true', help='Search rooms seeded by a previous run.')
+        parser.add_argument('--limit', type=int, default=20, help='Page size.')
+        parser.add_argument('--samples', type=int, default=20, help='Requests per query.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms afterwards.')
+
+    def handle(self, *args, **options):
+        user = get_bench_user()
+        if options['no_seed']:
+            rooms = list(Room.objects.filter(name='bench search', creator=user))
+        else:
+            self.stdout.write(f"Seeding {options['rooms']} rooms with {options['messages']} messages...")
+            rooms = self.seed(user, options)
+
+        room_ids = [room.id for room in rooms]
+        total = Message.objects.filter(room_id__in=room_ids).count()
+        mode = 'full-text (GIN)' if is_full_text_supported() else 'icontains fallback'
+        self.stdout.write(f'{len(rooms)} rooms, {total} messages, search mode: {mode}.')
+
+        view = MessageViewSet.as_view({'get': 'search'}, **MessageViewSet.search.kwargs)
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+
+        def fetch(params):
+            request = factory.get('/api/messages/search/', dict(params, limit=options['limit']))
+            force_authenticate(request, user=user)
+            response = view(request)
+            response.render()
+            assert response.status_code == 200, response.data
+            return response.data
+
+        self.stdout.write(f"{'query':>12} {'scope':>6} {'results':>8} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}")
+        for text in QUERIES:
+            scopes = [('all', {'q': text})]
+            if room_ids:
+                scopes.append(('room', {'q': text, 'room_id': room_ids[0]}))
+            for scope, params in scopes:
+                results = len(fetch(params)['results'])
+                stats = summarize(measure(lambda: fetch(params), options['samples']))
+                self.stdout.write(f"{text:>12} {scope:>6} {results:>8} {stats['p50_ms']:>10} "
+                                  f"{stats['p95_ms']:>10} {stats['max_ms']:>10}")
+
+        if not options['keep']:
+            Room.objects.filter(id__in=room_ids).delete()
+
+    def seed(self, user, options):
+        """
+        :returns: List of created rooms, user is member of all of them.
+        """
+        rooms = [Room.objects.create(name='bench search', creator=user) for _ in range(options['rooms'])]
+        Room.users.through.objects.bulk_create(Room.users.through(room_id=room.id, customuser_id=user.id)
+                                               for room in rooms)
+        room_ids = [room.id for room in rooms]
+
+        created = 0
+        while created < options['messages']:
+            size = min(options['batch_size'], options['messages'] - created)
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    self.insert_series(room_ids, user.id, created, size)
+                else:
+                    Message.objects.bulk_create(
+                        (Message(room_id=room_ids[(created + i) % len(room_ids)], user=user,
+                                 text=' '.join(random_word() for _ in range(WORDS_PER_MESSAGE)))
+                         for i in range(size)),
+                        batch_size=5000,
+                    )
+            created += size
+            self.stdout.write(f'{created} messages seeded.')
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE api_message')
+        Room.rebuild_activity(Room.objects.filter(id__in=room_ids))
+        return rooms
+
+    @staticmethod
+    def insert_series(room_ids, user_id, start, size):
+        """
+        Inserts messages generated by PostgreSQL itself, search vectors are set by trigger.
+        """
+        word = f"'w' || floor(power(random(), 3) * {VOCABULARY})::int"
+        text = " || ' ' || ".join([word] * WORDS_PER_MESSAGE)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO api_message (room_id, user_id, timestamp, text)
+                SELECT (%s::bigint[])[1 + i %% %s], %s, now() - make_interval(secs => %s - i), {text}
+                FROM generate_series(%s, %s) AS i
+            """, [room_ids, len(room_ids), user_id, start + size, start, start + size - 1])
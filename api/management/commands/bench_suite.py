@@ -0,0 +1,203 @@
+import asyncio
+import json
+import platform
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+
+from api.benchmarks import (add_room_members, delete_room_members, get_bench_user, run_concurrently,
+                            run_websocket_clients, seed_room, summarize)
+from api.history_cache import get_history_cache
+from api.models import Message, Room
+from api.serializers import ChatTokenObtainPairSerializer
+
+# Metrics compared with --baseline, True if higher is better.
+COMPARED_METRICS = {
+    'throughput_per_s': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'queries_mean': False,
+}
+
+
+class Command(BaseCommand):
+    help = ('Seeds rooms, members and messages, then drives concurrent REST clients through message and room '
+            'endpoints and concurrent WebSocket clients through ChatConsumer. Reports throughput, latency '
+            'percentiles and queries per request as JSON, which can be compared with results of another release. '
+            'Meant for src.settings.benchmark (SQLite or a throwaway PostgreSQL database, in-memory channel layer).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=4, help='Number of seeded rooms.')
+        parser.add_argument('--members', type=int, default=10, help='Members of each room.')
+        parser.add_argument('--messages', type=int, default=5000, help='Messages seeded in each room.')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent REST clients.')
+        parser.add_argument('--requests', type=int, default=25, help='Requests of each REST client per scenario.')
+        parser.add_argument('--ws-clients', type=int, default=10, help='WebSocket clients connected to each room.')
+        parser.add_argument('--ws-messages', type=int, default=10, help='Messages sent by each WebSocket client.')
+        parser.add_argument('--layer', choices=list(settings.CHAT_CHANNEL_LAYERS), default='memory',
+                            help='Channel layer of WebSocket clients.')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds WebSocket client waits for message.')
+        parser.add_argument('--output', help='File results are written to, printed if not given.')
+        parser.add_argument('--baseline', help='File with results of an earlier run to compare with.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms and users afterwards.')
+
+    def handle(self, *args, **options):
+        creator = get_bench_user()
+        rooms = []
+        try:
+            self.stderr.write(f"Seeding {options['rooms']} rooms with {options['messages']} messages each...")
+            for i in range(options['rooms']):
+                room = seed_room(creator, options['messages'], name=f'bench suite {i}')
+                members = add_room_members(room, max(options['members'], options['ws_clients']))
+                rooms.append((room, members))
+
+            overrides = {'CHANNEL_LAYERS': {'default': settings.CHAT_CHANNEL_LAYERS[options['layer']]}}
+            with override_settings(**overrides):
+                results = {
+                    'environment': self.environment(options),
+                    'rest': self.run_rest(rooms, options),
+                    'websocket': self.run_websocket(rooms, options),
+                }
+        finally:
+            if not options['keep']:
+                room_ids = [room.id for room, _ in rooms]
+                delete_room_members(room_ids)
+                Room.objects.filter(id__in=room_ids).delete()
+                cache = get_history_cache()
+                if cache is not None:
+                    for room_id in room_ids:
+                        cache.invalidate(room_id)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                self.compare(json.load(file), results)
+
+    def environment(self, options):
+        """
+        :returns: Dict describing where and at what scale benchmarks run, so results are compared like with like.
+        """
+        return {
+            'database': connection.vendor,
+            'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'history_cache': settings.CHAT_HISTORY_CACHE['BACKEND'],
+            'write_behind': settings.CHAT_MESSAGE_PIPELINE['WRITE_BEHIND'],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'scale': {name: options[name] for name in ('rooms', 'members', 'messages', 'clients', 'requests',
+                                                        'ws_clients', 'ws_messages')},
+        }
+
+    def run_rest(self, rooms, options):
+        """
+        Runs each REST scenario with all clients at once. Client n is a member of room n modulo number of rooms.
+        Requests go through the whole Django stack: middleware, JWT authentication, views and serializers.
+
+        :returns: Dict of scenario name -> its results.
+        """
+        clients = []
+        for n in range(options['clients']):
+            room, members = rooms[n % len(rooms)]
+            user = members[n // len(rooms) % len(members)]
+            token = ChatTokenObtainPairSerializer.get_token(user).access_token
+            middle = Message.objects.filter(room=room).order_by('id').values_list('id', flat=True)[
+                options['messages'] // 2] if options['messages'] else 0
+            clients.append({'room': room.id, 'middle': middle, 'client': Client(
+                HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'Bearer {token}')})
+
+        scenarios = {
+            'rooms.list': lambda c: c['client'].get('/api/rooms/'),
+            'rooms.summary': lambda c: c['client'].get('/api/rooms/', {'summary': 'true',
+                                                                       'ordering': '-last_message_at'}),
+            'rooms.retrieve': lambda c: c['client'].get(f"/api/rooms/{c['room']}/"),
+            'messages.newest': lambda c: c['client'].get('/api/messages/', {'room_id': c['room'], 'cursor': ''}),
+            'messages.before': lambda c: c['client'].get('/api/messages/', {'room_id': c['room'],
+                                                                            'before': c['middle']}),
+            'messages.offset': lambda c: c['client'].get('/api/messages/', {'room_id': c['room'], 'limit': 50,
+                                                                            'offset': options['messages'] // 2}),
+            'messages.search': lambda c: c['client'].get('/api/messages/search/', {'room_id': c['room'],
+                                                                                   'q': 'number'}),
+            'messages.create': lambda c: c['client'].post('/api/messages/', {'room': c['room'],
+                                                                              'text': 'Benchmark message.'},
+                                                          content_type='application/json'),
+        }
+
+        results = {}
+        for name, request in scenarios.items():
+            def call(n):
+                response = request(clients[n])
+                assert response.status_code < 400, f'{name}: status {response.status_code}'
+
+            # Warm up connections, caches and lazily built views first.
+            run_concurrently(call, options['clients'], 1)
+            samples, errors, elapsed = run_concurrently(call, options['clients'], options['requests'])
+            queries = [count for _, count in samples]
+            results[name] = dict(
+                summarize([duration for duration, _ in samples]),
+                errors=errors,
+                seconds=round(elapsed, 3),
+                throughput_per_s=round(len(samples) / elapsed, 1),
+                queries_mean=round(sum(queries) / len(queries), 2) if queries else 0.0,
+                queries_max=max(queries, default=0),
+            )
+            self.stderr.write(f"{name:>16}: {results[name]['throughput_per_s']:>8}/s, "
+                              f"p95 {results[name]['p95_ms']} ms, {results[name]['queries_mean']} queries")
+        return results
+
+    def run_websocket(self, rooms, options):
+        """
+        Connects ws_clients to each room; each of them sends ws_messages and reads messages of its room.
+
+        :returns: Dict of results, latency is fan-out latency of delivered messages.
+        """
+        tokens = {
+            room.id: [str(ChatTokenObtainPairSerializer.get_token(user).access_token)
+                      for user in members[:options['ws_clients']]]
+            for room, members in rooms
+        }
+        sent, received, latencies, elapsed = asyncio.run(run_websocket_clients(
+            tokens, options['ws_messages'], timeout=options['timeout']))
+
+        results = dict(
+            summarize(latencies),
+            clients=len(rooms) * options['ws_clients'],
+            messages_sent=sent,
+            frames_expected=sent * options['ws_clients'],
+            frames_delivered=received,
+            seconds=round(elapsed, 3),
+            throughput_per_s=round(sent / elapsed, 1),
+            delivered_per_s=round(received / elapsed, 1),
+        )
+        self.stderr.write(f"{'websocket':>16}: {results['throughput_per_s']:>8}/s, "
+                          f"p95 {results['p95_ms']} ms, {received} of {results['frames_expected']} delivered")
+        return results
+
+    def compare(self, baseline, results):
+        """
+        Prints changes of compared metrics against baseline results, flagging changes for the worse over 10%.
+        """
+        if baseline.get('environment') != results['environment']:
+            self.stderr.write(self.style.WARNING('Baseline was run in different environment or at different scale.'))
+
+        scenarios = dict(results['rest'], websocket=results['websocket'])
+        previous = dict(baseline.get('rest', {}), websocket=baseline.get('websocket', {}))
+        self.stderr.write(f"{'scenario':>16} {'metric':>18} {'baseline':>10} {'current':>10} {'change':>8}")
+        for name, metrics in scenarios.items():
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                before, after = previous.get(name, {}).get(metric), metrics.get(metric)
+                if before is None or after is None:
+                    continue
+                change = (after - before) / before * 100 if before else 0.0
+                line = f'{name:>16} {metric:>18} {before:>10} {after:>10} {change:>+7.1f}%'
+                worse = -change if higher_is_better else change
+                self.stderr.write(self.style.ERROR(line) if worse > 10 else line)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from api.asgi import application
+from api.benchmarks import add_room_members, delete_room_members, get_bench_user, seed_room, summarize
+from api.membership import invalidate_room_members
+from api.models import Room
+from api.serializers import ChatTokenObtainPairSerializer
+
+
+class Command(BaseCommand):
+    help = ('Simulates a reconnect storm: many WebSocket connections authenticated with access tokens '
+            'joining one room at once, with room members cache cold for every join and warm.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=1000, help='Connections joining the room.')
+        parser.add_argument('--concurrency', type=int, default=100, help='Connections joining at the same time.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded room and users afterwards.')
+
+    def handle(self, *args, **options):
+        room = seed_room(get_bench_user(), 0, name='bench ws joins')
+        users = add_room_members(room, options['connections'])
+        tokens = [str(ChatTokenObtainPairSerializer.get_token(user).access_token) for user in users]
+
+        self.stdout.write(f"{'cache':>6} {'joins/s':>9} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+        for mode in ('cold', 'warm'):
+            invalidate_room_members(room.id)
+            durations, elapsed = asyncio.run(self.storm(room.id, tokens, options['concurrency'], mode == 'cold'))
+            stats = summarize(durations)
+            self.stdout.write(
+                f"{mode:>6} {round(len(tokens) / elapsed):>9} "
+                f"{stats['p50_ms']:>10} {stats['p95_ms']:>10} {stats['p99_ms']:>10}"
+            )
+
+        if not options['keep']:
+            delete_room_members([room.id])
+            Room.objects.filter(id=room.id).delete()
+
+    async def storm(self, room_id, tokens, concurrency, cold):
+        """
+        Connects with every token, at most given number of connections at a time.
+
+        :returns: Tuple of (list of durations of each join, total seconds).
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        durations = []
+
+        async def join(token):
+            async with semaphore:
+                if cold:
+                    # Every join misses the cache, as if there was no cache.
+                    await database_sync_to_async(invalidate_room_members)(room_id)
+                communicator = WebsocketCommunicator(application, f'ws/{room_id}/?token={token}')
+                started = time.perf_counter()
+                connected, _ = await communicator.connect()
+                durations.append(time.perf_counter() - started)
+                assert connected
+                await communicator.disconnect()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(join(token) for token in tokens))
+        return durations, time.perf_counter() - started
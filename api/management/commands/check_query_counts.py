@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.benchmarks import get_bench_user, seed_room
+from api.models import CustomUser
+from api.views import MessageViewSet, RoomViewSet
+
+
+class Rollback(Exception):
+    """
+    Raised to roll back data seeded by the check.
+    """
+
+
+class Command(BaseCommand):
+    help = ('Checks that listing rooms and messages takes the same number of queries '
+            'regardless of how many rows are returned. Exits with error otherwise.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100', help='Comma separated numbers of rooms/messages to list.')
+
+    def handle(self, *args, **options):
+        self.factory = APIRequestFactory(SERVER_NAME='localhost')
+        self.failures = []
+        try:
+            with transaction.atomic(), override_settings(CHAT_HISTORY_CACHE={'BACKEND': None}):
+                self.check_counts([int(size) for size in options['sizes'].split(',')])
+                raise Rollback
+        except Rollback:
+            pass
+
+        if self.failures:
+            raise CommandError('Query count depends on number of results: ' + '; '.join(self.failures))
+        self.stdout.write(self.style.SUCCESS('Query counts are constant.'))
+
+    def count_queries(self, view, user, params):
+        """
+        :returns: Number of queries executed while handling GET request with given parameters.
+        """
+        request = self.factory.get('/', params)
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+            response.render()
+        assert response.status_code == 200, response.data
+        return len(queries)
+
+    def expect_constant(self, name, counts):
+        self.stdout.write(f'{name}: {counts}')
+        if len(set(counts.values())) > 1:
+            self.failures.append(f'{name} {counts}')
+
+    def check_counts(self, sizes):
+        room_list = RoomViewSet.as_view({'get': 'list'})
+        message_list = MessageViewSet.as_view({'get': 'list'})
+        members = [CustomUser.objects.create(username=f'query_count_member_{i}') for i in range(3)]
+
+        for fields, summary in ((None, False), ('id,name', False), ('id,creator,admins,users', False),
+                                (None, True)):
+            counts = {}
+            for size in sizes:
+                user = CustomUser.objects.create(username=f'query_count_{size}_{fields}_{summary}')
+                for _ in range(size):
+                    room = seed_room(user, 2)
+                    room.users.add(*members)
+                    room.admins.add(*members)
+                params = {'fields': fields} if fields else {}
+                if summary:
+                    params['summary'] = 'true'
+                counts[size] = self.count_queries(room_list, user, params)
+            self.expect_constant(f'rooms list fields={fields} summary={summary}', counts)
+
+        user = get_bench_user()
+        for mode in ({}, {'cursor': ''}):
+            counts = {}
+            for size in sizes:
+                room = seed_room(user, size)
+                counts[size] = self.count_queries(message_list, user, dict(mode, room_id=room.id, limit=max(sizes)))
+            self.expect_constant(f'messages list {mode}', counts)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api.partitions import create_partitions, is_partitioned, message_partitions
+
+
+class Command(BaseCommand):
+    help = ('Creates monthly partitions of message table for upcoming months (PostgreSQL only). '
+            'Run it regularly, e.g. daily. Messages without partition for their month are saved in default '
+            'partition (see migration 0015), which is slower to query; they are moved to partition of their month '
+            'when it is created, which locks the default partition while rows are moved.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.CHAT_MESSAGE_PARTITIONS['MONTHS_AHEAD'],
+                            help='Create partitions up to this many months ahead.')
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            raise CommandError('Message table is not partitioned (PostgreSQL only, see migration 0012).')
+
+        until = timezone.now() + timezone.timedelta(days=31 * options['months'])
+        with transaction.atomic():
+            created = create_partitions(until)
+
+        for name in created:
+            self.stdout.write(f'Created partition {name}.')
+        newest = message_partitions()[-1]
+        self.stdout.write(self.style.SUCCESS(f'Monthly partitions cover messages until {newest.end}.'))
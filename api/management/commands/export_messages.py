@@ -0,0 +1,38 @@
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Message, Room
+from api.transfer import export_chunks
+
+
+class Command(BaseCommand):
+    help = 'Exports messages of a room as JSON lines, oldest first, read with a server-side cursor.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room', type=int, help='Id of exported room.')
+        parser.add_argument('--output', default='-', help='File messages are written to, stdout by default.')
+        parser.add_argument('--chunk-size', type=int, default=settings.CHAT_MESSAGE_TRANSFER['EXPORT_CHUNK_SIZE'],
+                            help='Messages fetched from database at once.')
+
+    def handle(self, *args, **options):
+        if not Room.objects.filter(pk=options['room']).exists():
+            raise CommandError(f"Room {options['room']} does not exist.")
+
+        messages = Message.objects.filter(room_id=options['room'])
+        started = time.monotonic()
+        exported = 0
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in export_chunks(messages, options['chunk_size']):
+                output.write(chunk)
+                exported += chunk.count(b'\n')
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+
+        rate = exported / max(time.monotonic() - started, 1e-9)
+        self.stderr.write(self.style.SUCCESS(f"Exported {exported} messages of room {options['room']} "
+                                             f"({round(rate)}/s)."))
@@ -0,0 +1,59 @@
+import gzip
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.history_cache import get_history_cache
+from api.models import Room
+from api.transfer import MessageImporter
+
+
+class Command(BaseCommand):
+    help = ('Imports messages from JSON lines, as written by export_messages command or archive_messages '
+            '(.gz files), with bulk inserts. Messages get new ids and keep their timestamps. '
+            'Users are matched by username.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="File messages are read from, '-' for stdin.")
+        parser.add_argument('--room', type=int,
+                            help='Id of room all messages are saved in. By default they keep their room ids.')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_MESSAGE_TRANSFER['IMPORT_BATCH_SIZE'],
+                            help='Messages saved with one INSERT.')
+
+    def handle(self, *args, **options):
+        if options['room'] is not None and not Room.objects.filter(pk=options['room']).exists():
+            raise CommandError(f"Room {options['room']} does not exist.")
+
+        if options['input'] == '-':
+            lines = sys.stdin
+        elif options['input'].endswith('.gz'):
+            lines = gzip.open(options['input'], 'rt', encoding='utf-8')
+        else:
+            lines = open(options['input'], encoding='utf-8')
+
+        importer = MessageImporter(options['batch_size'], room_id=options['room'])
+        started = time.monotonic()
+        try:
+            for saved in importer.run(lines):
+                rate = saved / (time.monotonic() - started)
+                self.stdout.write(f'Imported {saved} messages ({round(rate)}/s)...')
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+        # Activity counters and cached history of rooms are rebuilt once, after all batches.
+        Room.rebuild_activity(Room.objects.filter(id__in=importer.rooms))
+        cache = get_history_cache()
+        if cache is not None:
+            for room_id in importer.rooms:
+                cache.invalidate(room_id)
+
+        if importer.skipped:
+            self.stdout.write(self.style.WARNING(f'Skipped {importer.skipped} messages of rooms that do not exist.'))
+        if importer.without_user:
+            self.stdout.write(self.style.WARNING(f'Saved {importer.without_user} messages without user, '
+                                                 f'their users do not exist.'))
+        self.stdout.write(self.style.SUCCESS(f'Imported {importer.saved} messages '
+                                             f'into {len(importer.rooms)} rooms.'))
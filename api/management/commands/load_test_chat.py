@@ -0,0 +1,57 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from api.benchmarks import (add_room_members, delete_room_members, get_bench_user, run_websocket_clients, seed_room,
+                            summarize)
+from api.models import Room
+from api.serializers import ChatTokenObtainPairSerializer
+
+
+class Command(BaseCommand):
+    help = ('Load-tests ChatConsumer with many simulated clients connected to several rooms, '
+            'each sending messages to its room. Reports message throughput and fan-out latency, '
+            'i.e. time from sending a message to receiving it by each room member.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5, help='Number of rooms.')
+        parser.add_argument('--clients', type=int, default=20, help='Clients connected to each room.')
+        parser.add_argument('--messages', type=int, default=10, help='Messages sent by each client.')
+        parser.add_argument('--interval', type=float, default=0.0, help='Seconds client waits between messages.')
+        parser.add_argument('--layer', choices=list(settings.CHAT_CHANNEL_LAYERS),
+                            help='Channel layer to use instead of the configured one.')
+        parser.add_argument('--write-behind', action='store_true', help='Save messages in batches.')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds client waits for next message.')
+        parser.add_argument('--keep', action='store_true', help='Do not delete seeded rooms and users afterwards.')
+
+    def handle(self, *args, **options):
+        rooms = [seed_room(get_bench_user(), 0, name='load test') for _ in range(options['rooms'])]
+        tokens = {
+            room.id: [str(ChatTokenObtainPairSerializer.get_token(user).access_token)
+                      for user in add_room_members(room, options['clients'])]
+            for room in rooms
+        }
+
+        overrides = {'CHAT_MESSAGE_PIPELINE': dict(settings.CHAT_MESSAGE_PIPELINE,
+                                                   WRITE_BEHIND=options['write_behind'])}
+        if options['layer']:
+            overrides['CHANNEL_LAYERS'] = {'default': settings.CHAT_CHANNEL_LAYERS[options['layer']]}
+        with override_settings(**overrides):
+            sent, received, latencies, elapsed = asyncio.run(run_websocket_clients(
+                tokens, options['messages'], options['interval'], options['timeout']))
+
+        expected = sent * options['clients']
+        stats = summarize(latencies)
+        self.stdout.write(f"layer: {options['layer'] or settings.CHANNEL_LAYERS['default']['BACKEND']}")
+        self.stdout.write(f"clients: {options['rooms'] * options['clients']}, seconds: {round(elapsed, 3)}")
+        self.stdout.write(f'messages sent: {sent} ({round(sent / elapsed, 1)}/s)')
+        self.stdout.write(f'frames delivered: {received} of {expected} ({round(received / elapsed, 1)}/s)')
+        self.stdout.write(f"fan-out latency ms: p50 {stats['p50_ms']}, p95 {stats['p95_ms']}, "
+                          f"p99 {stats['p99_ms']}, max {stats['max_ms']}")
+
+        if not options['keep']:
+            room_ids = [room.id for room in rooms]
+            delete_room_members(room_ids)
+            Room.objects.filter(id__in=room_ids).delete()
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from drf_api_logger.models import APILogsModel
+
+
+class Command(BaseCommand):
+    help = 'Deletes API log records older than retention period, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_API_LOGGER['RETENTION_DAYS'],
+                            help='Delete records older than this many days.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Records deleted with one DELETE.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timezone.timedelta(days=options['days'])
+        old = APILogsModel.objects.filter(added_on__lt=cutoff)
+
+        deleted = 0
+        while True:
+            # Oldest records have the lowest ids, so each batch is read from the start of primary key index.
+            ids = list(old.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += APILogsModel.objects.filter(id__in=ids).delete()[0]
+            self.stdout.write(f'Deleted {deleted} records...')
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} API log records older than {cutoff}.'))
@@ -0,0 +1,91 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from api.archive import get_room_archive
+from api.history_cache import get_history_cache
+from api.membership import invalidate_room_members
+from api.models import Message, Room
+
+
+def delete_message_chunk(room_id, size):
+    """
+    Deletes up to size oldest messages of the room with a single range DELETE,
+    bounded by (timestamp, id) of the last message of the chunk, read from room history index.
+
+    :returns: Number of deleted messages.
+    """
+    table = connection.ops.quote_name(Message._meta.db_table)
+    timestamp = connection.ops.quote_name('timestamp')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {timestamp}, id FROM {table} WHERE room_id = %s ORDER BY {timestamp}, id LIMIT 1 OFFSET %s',
+            [room_id, size - 1],
+        )
+        last = cursor.fetchone()
+        if last is None:
+            cursor.execute(f'DELETE FROM {table} WHERE room_id = %s', [room_id])
+        else:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE room_id = %s AND ({timestamp} < %s OR ({timestamp} = %s AND id <= %s))',
+                [room_id, last[0], last[0], last[1]],
+            )
+        return cursor.rowcount
+
+
+class Command(BaseCommand):
+    help = ('Deletes rooms marked deleted, with their messages deleted in chunks. '
+            'Interrupted purge continues where it stopped when run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.CHAT_ROOM_PURGE['CHUNK_SIZE'],
+                            help='Max messages deleted with one DELETE.')
+        parser.add_argument('--pause', type=float, default=settings.CHAT_ROOM_PURGE['PAUSE'],
+                            help='Seconds between chunks.')
+        parser.add_argument('--watch', type=float, default=0,
+                            help='Keep running, checking for deleted rooms every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            rooms = list(Room.all_objects.filter(deleted_at__isnull=False).order_by('deleted_at', 'id'))
+            for room in rooms:
+                self.purge(room, options)
+
+            if not options['watch']:
+                break
+            time.sleep(options['watch'])
+
+    def purge(self, room, options):
+        self.stdout.write(f'Purging room {room.id}, about {room.message_count} messages left...')
+        deleted = 0
+        started = time.monotonic()
+        while True:
+            # Room's message count is kept as the number of messages left, so progress survives a crash.
+            with transaction.atomic():
+                count = delete_message_chunk(room.id, options['chunk_size'])
+                Room.all_objects.filter(pk=room.pk).update(message_count=Greatest(F('message_count') - count, 0))
+            deleted += count
+            if count < options['chunk_size']:
+                break
+
+            left = max(room.message_count - deleted, 0)
+            rate = deleted / (time.monotonic() - started)
+            self.stdout.write(f'Room {room.id}: deleted {deleted} messages ({round(rate)}/s), about {left} left.')
+            time.sleep(options['pause'])
+
+        # Only small relations are left: memberships, read cursors and messages saved meanwhile.
+        room_id = room.id
+        with transaction.atomic():
+            room.delete()
+        invalidate_room_members(room_id)
+        cache = get_history_cache()
+        if cache is not None:
+            cache.invalidate(room_id)
+        archive = get_room_archive(room_id)
+        if archive is not None:
+            archive.delete()
+        self.stdout.write(self.style.SUCCESS(f'Room {room_id} purged, {deleted} messages deleted.'))
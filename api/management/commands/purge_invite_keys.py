@@ -0,0 +1,39 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import RoomInviteKey
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired room invite keys, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_INVITE_KEYS['PURGE_BATCH_SIZE'],
+                            help='Keys deleted with one DELETE.')
+        parser.add_argument('--watch', type=float, default=0,
+                            help='Keep running, deleting expired keys every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            self.purge(options['batch_size'])
+            if not options['watch']:
+                break
+            time.sleep(options['watch'])
+
+    def purge(self, batch_size):
+        cutoff = timezone.now()
+        expired = RoomInviteKey.objects.filter(valid_due__lt=cutoff)
+
+        deleted = 0
+        while True:
+            # Keys that expired first are read from the start of valid_due index.
+            ids = list(expired.order_by('valid_due').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted += RoomInviteKey.objects.filter(id__in=ids).delete()[0]
+            self.stdout.write(f'Deleted {deleted} keys...')
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} invite keys expired before {cutoff}.'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Recomputes message_count, last_message_at and last_message_id of rooms from their messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rooms updated with one UPDATE.')
+        parser.add_argument('--room', type=int, action='append', help='Only rebuild given room (repeatable).')
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.all()
+        if options['room']:
+            rooms = rooms.filter(id__in=options['room'])
+
+        updated = 0
+        last_id = 0
+        while True:
+            # Walk rooms in primary key ranges, so each UPDATE touches a bounded number of rows.
+            ids = list(rooms.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            updated += Room.rebuild_activity(Room.objects.filter(id__gte=ids[0], id__lte=ids[-1]))
+            last_id = ids[-1]
+            self.stdout.write(f'Rebuilt {updated} rooms...')
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt activity counters of {updated} rooms.'))
@@ -0,0 +1,157 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Exists, OuterRef
+
+from api.models import Room
+
+# Room roles, named after Room's many-to-many fields.
+ADMINS = 'admins'
+USERS = 'users'
+
+
+class RoomMembership:
+    """
+    Per-request cache of user's room memberships.
+
+    Each membership is checked with a single EXISTS query on the many-to-many
+    table's unique (room, user) index and remembered for the rest of the request,
+    so permission classes and serializers don't repeat the check.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.known = {}  # (role, room id) -> bool
+
+    @staticmethod
+    def through(role):
+        """
+        :returns: Tuple of (through model, room field name, user field name) of given role's many-to-many table.
+        """
+        field = Room._meta.get_field(role)
+        return field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+
+    def has_role(self, role, room_id):
+        """
+        :returns: True if user has given role in the room.
+        """
+        key = (role, int(room_id))
+        if key not in self.known:
+            if not self.user.is_authenticated:
+                self.known[key] = False
+            else:
+                through, room_field, user_field = self.through(role)
+                self.known[key] = through.objects.filter(**{
+                    f'{room_field}_id': room_id,
+                    f'{user_field}_id': self.user.pk,
+                }).exists()
+        return self.known[key]
+
+    def cached(self, role, room_id):
+        """
+        :returns: True or False if user's role in the room is already known, None otherwise.
+        """
+        try:
+            return self.known.get((role, int(room_id)))
+        except (TypeError, ValueError):
+            return None
+
+    def remember(self, role, room_id, value=True):
+        """
+        Stores membership learnt elsewhere, e.g. from a query filtered by rooms().
+        """
+        self.known[(role, int(room_id))] = value
+
+    def is_admin(self, room_id):
+        return self.has_role(ADMINS, room_id)
+
+    def is_user(self, room_id):
+        return self.has_role(USERS, room_id)
+
+    def rooms(self, role):
+        """
+        :returns: Queryset of rooms user has given role in, filtered with EXISTS subquery.
+        """
+        through, room_field, user_field = self.through(role)
+        return Room.objects.filter(Exists(through.objects.filter(**{
+            f'{room_field}_id': OuterRef('pk'),
+            f'{user_field}_id': self.user.pk,
+        })))
+
+
+def get_membership(request):
+    """
+    :returns: RoomMembership cache of request user, created once per request.
+    """
+    membership = getattr(request, '_room_membership', None)
+    if membership is None or membership.user is not request.user:
+        membership = RoomMembership(request.user)
+        request._room_membership = membership
+    return membership
+
+
+def room_members_key(room_id):
+    return f"{settings.CHAT_ROOM_MEMBERS_CACHE['KEY_PREFIX']}{room_id}"
+
+
+def get_room_member_ids(room_id):
+    """
+    Reads ids of room users from cache, loading them with a single query on cache miss.
+    Ids are cached for CHAT_ROOM_MEMBERS_CACHE['TTL'] seconds, so that a burst of
+    connections to the same room (e.g. reconnecting after a deploy) doesn't query
+    the database for each of them.
+
+    :returns: Frozenset of ids of room users, empty if room is inactive or doesn't exist.
+    """
+    config = settings.CHAT_ROOM_MEMBERS_CACHE
+    cache = caches[config['CACHE']]
+    key = room_members_key(room_id)
+
+    member_ids = cache.get(key)
+    if member_ids is None:
+        through, room_field, user_field = RoomMembership.through(USERS)
+        member_ids = frozenset(through.objects.filter(**{
+            f'{room_field}_id': room_id,
+            f'{room_field}__active': True,
+        }).values_list(f'{user_field}_id', flat=True))
+        cache.set(key, member_ids, config['TTL'])
+    return member_ids
+
+
+def invalidate_room_members(*room_ids):
+    """
+    Drops cached ids of users of given rooms. Called whenever room users or room's active flag change.
+    """
+    caches[settings.CHAT_ROOM_MEMBERS_CACHE['CACHE']].delete_many([room_members_key(room_id) for room_id in room_ids])
+
+
+def add_room_members(room_id, role, user_ids):
+    """
+    Gives users the role in the room with a single INSERT into role's many-to-many table.
+    Users who already have the role are skipped. Cached room users should be invalidated
+    once the transaction commits.
+
+    :returns: Number of users given the role.
+    """
+    through, room_field, user_field = RoomMembership.through(role)
+    existing = set(through.objects.filter(**{
+        f'{room_field}_id': room_id,
+        f'{user_field}_id__in': user_ids,
+    }).values_list(f'{user_field}_id', flat=True))
+    added = [through(**{f'{room_field}_id': room_id, f'{user_field}_id': user_id})
+             for user_id in dict.fromkeys(user_ids) if user_id not in existing]
+    through.objects.bulk_create(added, ignore_conflicts=True)
+    return len(added)
+
+
+def remove_room_members(room_id, role, user_ids):
+    """
+    Takes the role in the room from users with a single DELETE from role's many-to-many table.
+    Cached room users should be invalidated once the transaction commits.
+
+    :returns: Number of users the role was taken from.
+    """
+    through, room_field, user_field = RoomMembership.through(role)
+    return through.objects.filter(**{
+        f'{room_field}_id': room_id,
+        f'{user_field}_id__in': user_ids,
+    }).delete()[0]
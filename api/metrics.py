@@ -0,0 +1,404 @@
+"""
+In-process registry of worker metrics: counters, gauges and histograms with optional labels.
+
+Metrics of all processes are served together by /metrics endpoint in Prometheus text format.
+Each process publishes its metrics to the store set in CHAT_METRICS setting, and the process
+serving the endpoint merges metrics of all processes found there.
+"""
+import collections
+import contextlib
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# How gauges of many processes are merged.
+SUM = 'sum'
+MAX = 'max'
+
+# Upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Identifies metrics published by this process.
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Metric:
+    """
+    Named metric holding a value for each combination of label values.
+    """
+
+    def __init__(self, name, documentation, kind, labelnames=(), function=None, aggregate=SUM):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.function = function    # Callable returning current value, instead of stored values.
+        self.aggregate = aggregate  # How values of many processes are merged, SUM or MAX.
+        self.values = collections.OrderedDict()   # Tuple of label values -> value.
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        assert set(labels) == set(self.labelnames), f'{self.name} takes labels {self.labelnames}'
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """
+        :returns: List of (dict of labels, value) tuples.
+        """
+        if self.function is not None:
+            return [({}, self.function())]
+        with self.lock:
+            if not self.labelnames and not self.values:
+                return [({}, 0)]
+            return [(dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, COUNTER, labelnames)
+
+
+class Gauge(Metric):
+    def __init__(self, name, documentation, labelnames=(), function=None, aggregate=SUM, drop_zero=False):
+        super().__init__(name, documentation, GAUGE, labelnames, function, aggregate)
+        self.drop_zero = drop_zero  # Forget label values once their value drops to zero.
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            value = self.values.get(key, 0) - amount
+            if value == 0 and self.drop_zero:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Metric counting observed values in buckets, e.g. durations of requests.
+    Value of each label combination is a list of counts of values in each bucket
+    (the last one unbounded), followed by sum and count of all values.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, HISTOGRAM, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, **labels):
+        """
+        Observes number of seconds the block takes.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            return [(dict(zip(self.labelnames, key)), list(value)) for key, value in self.values.items()]
+
+
+registry = collections.OrderedDict()    # Metric name -> Metric object.
+registry_lock = threading.Lock()
+
+
+def register(metric):
+    """
+    Adds metric to registry, unless one with the same name is registered already.
+
+    :returns: Registered metric of given name.
+    """
+    with registry_lock:
+        return registry.setdefault(metric.name, metric)
+
+
+def counter(name, documentation, labelnames=()):
+    return register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None, aggregate=SUM, drop_zero=False):
+    return register(Gauge(name, documentation, labelnames, function, aggregate, drop_zero))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, documentation, labelnames, buckets))
+
+
+def snapshot():
+    """
+    :returns: Dict of metric name -> list of (dict of labels, value) tuples.
+    """
+    with registry_lock:
+        metrics = list(registry.values())
+    return {metric.name: metric.samples() for metric in metrics}
+
+
+def collect():
+    """
+    :returns: List of dicts describing metrics of this process with their samples, serializable to JSON.
+    """
+    with registry_lock:
+        metrics = list(registry.values())
+    return [{
+        'name': metric.name,
+        'documentation': metric.documentation,
+        'kind': metric.kind,
+        'aggregate': metric.aggregate,
+        'buckets': list(getattr(metric, 'buckets', ())),
+        'samples': metric.samples(),
+    } for metric in metrics]
+
+
+def merge(processes):
+    """
+    Merges metrics of many processes, as returned by collect(). Counters and histograms
+    are summed, and so are gauges, unless their values are merged with MAX.
+
+    :returns: List of merged metrics, in the same form.
+    """
+    merged = collections.OrderedDict()   # Metric name -> (metric, dict of label items -> (labels, value)).
+    for metrics in processes:
+        for metric in metrics:
+            if metric['name'] not in merged:
+                merged[metric['name']] = (dict(metric, samples=[]), collections.OrderedDict())
+            kept, values = merged[metric['name']]
+            for labels, value in metric['samples']:
+                key = tuple(sorted(labels.items()))
+                if key not in values:
+                    values[key] = (labels, value)
+                elif kept['kind'] == HISTOGRAM:
+                    values[key] = (labels, [a + b for a, b in zip(values[key][1], value)])
+                elif kept['aggregate'] == MAX:
+                    values[key] = (labels, max(values[key][1], value))
+                else:
+                    values[key] = (labels, values[key][1] + value)
+
+    result = []
+    for metric, values in merged.values():
+        metric['samples'] = list(values.values())
+        result.append(metric)
+    return result
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def render(metrics):
+    """
+    :returns: Given metrics, as returned by collect() or merge(), in Prometheus text exposition format.
+    """
+    lines = []
+    for metric in metrics:
+        name = metric['name']
+        lines.append(f"# HELP {name} {metric['documentation']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for labels, value in metric['samples']:
+            if metric['kind'] != HISTOGRAM:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + [math.inf], value[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(dict(labels, le=format_value(float(bound))))} {cumulative}")
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(value[-2])}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+class LocMemMetricsStore:
+    """
+    Store of metrics of this process only, for single process deployments.
+    """
+    shared = False
+
+    def __init__(self):
+        self.processes = {}
+
+    def publish(self, worker_id, metrics):
+        self.processes[worker_id] = metrics
+
+    def collect(self):
+        """
+        :returns: List of metrics of each process, as returned by collect().
+        """
+        return list(self.processes.values())
+
+
+class RedisMetricsStore:
+    """
+    Redis store of metrics of all processes. Each process stores its metrics under its own key,
+    which expires if the process stops publishing, e.g. after it exited.
+    """
+    shared = True
+
+    def __init__(self, ttl=30, location='redis://localhost:6379/0', prefix='chat:metrics'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisMetricsStore requires redis package.')
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(location)
+
+    def publish(self, worker_id, metrics):
+        self.client.set(f'{self.prefix}:{worker_id}', json.dumps(metrics), ex=self.ttl)
+
+    def collect(self):
+        """
+        :returns: List of metrics of each process, as returned by collect().
+        """
+        keys = list(self.client.scan_iter(match=f'{self.prefix}:*', count=1000))
+        if not keys:
+            return []
+        return [json.loads(value) for value in self.client.mget(keys) if value is not None]
+
+
+class MetricsPublisher(threading.Thread):
+    """
+    Background thread publishing metrics of this process to shared store every interval seconds.
+    """
+
+    def __init__(self, store, interval):
+        super().__init__(name='metrics-publisher', daemon=True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        while True:
+            try:
+                self.store.publish(WORKER_ID, collect())
+            except Exception:
+                logger.exception('Publishing metrics failed.')
+            time.sleep(self.interval)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metrics_store():
+    """
+    :returns: Process-wide metrics store configured with CHAT_METRICS setting. Metrics of this
+              process are published to shared stores in the background from the first call on.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            config = settings.CHAT_METRICS
+            options = {key.lower(): value for key, value in config.items()
+                       if key not in ('BACKEND', 'INTERVAL', 'TOKEN')}
+            _store = import_string(config['BACKEND'])(**options)
+            if _store.shared:
+                MetricsPublisher(_store, config['INTERVAL']).start()
+    return _store
+
+
+def render_all():
+    """
+    :returns: Metrics of all processes, merged, in Prometheus text exposition format.
+    """
+    store = get_metrics_store()
+    store.publish(WORKER_ID, collect())
+    return render(merge(store.collect()))
+
+
+http_request_duration = histogram('chat_http_request_duration_seconds', 'Duration of HTTP requests.',
+                                  ['view', 'action', 'status'])
+http_request_queries = histogram('chat_http_request_queries', 'Database queries made by HTTP requests.',
+                                 ['view', 'action'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+
+
+def request_view_labels(request):
+    """
+    :returns: Tuple of (view name, action) of request resolved by MetricsMiddleware, ('', '') if unresolved.
+    """
+    view = getattr(request, '_metrics_view', None)
+    if view is None:
+        return '', ''
+    method = request.method.lower()
+    actions = getattr(view, 'actions', None) or {}
+    return getattr(view, 'cls', view).__name__, actions.get(method, method)
+
+
+class MetricsMiddleware:
+    """
+    Records duration and number of database queries of HTTP requests, per view and action
+    (viewset action, or HTTP method of other views).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        get_metrics_store()     # Start publishing metrics of this process.
+
+    def __call__(self, request):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        view, action = request_view_labels(request)
+        http_request_duration.observe(duration, view=view, action=action, status=f'{response.status_code // 100}xx')
+        http_request_queries.observe(queries, view=view, action=action)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_func
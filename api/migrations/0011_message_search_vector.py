@@ -0,0 +1,50 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:48
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Trigger keeping search_vector current and GIN index searched by api.search, PostgreSQL only.
+# Trigger also fires when search_vector itself is written, as saving Message object writes it as NULL.
+# Text search configuration has to match api.search.SEARCH_CONFIG.
+CREATE_SEARCH_SQL = [
+    """
+    CREATE TRIGGER api_message_search_vector_trg
+    BEFORE INSERT OR UPDATE OF text, search_vector ON api_message
+    FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.simple', text)
+    """,
+    "UPDATE api_message SET search_vector = to_tsvector('pg_catalog.simple', text)",
+    "CREATE INDEX api_message_search_idx ON api_message USING gin (search_vector)",
+]
+
+DROP_SEARCH_SQL = [
+    "DROP INDEX IF EXISTS api_message_search_idx",
+    "DROP TRIGGER IF EXISTS api_message_search_vector_trg ON api_message",
+]
+
+
+def create_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in CREATE_SEARCH_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in DROP_SEARCH_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_auto_20261018_2225'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search, drop_search),
+    ]
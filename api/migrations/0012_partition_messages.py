@@ -0,0 +1,100 @@
+import datetime
+
+from django.db import NotSupportedError, migrations
+
+# Months of partitions created ahead, the rest is created by create_message_partitions command.
+MONTHS_AHEAD = 3
+
+SEARCH_TRIGGER_SQL = """
+    CREATE TRIGGER api_message_search_vector_trg
+    BEFORE INSERT OR UPDATE OF text, search_vector ON api_message
+    FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.simple', text)
+"""
+
+
+def legacy_name(name):
+    return f'legacy_{name}'[:63]
+
+
+def next_month(start):
+    return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def partition_messages(apps, schema_editor):
+    """
+    Turns message table into a table partitioned by month of message timestamp (PostgreSQL 13+ only).
+
+    Existing table becomes partition api_message_p_legacy, holding all messages saved until
+    the end of current month, so no rows are copied. Its indexes, foreign keys and search
+    trigger are recreated on partitioned table under their original names, and so are
+    created on all future partitions. Primary key becomes (id, timestamp), as it has
+    to contain partition key; ids are still unique, taken from the same sequence.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # Row triggers on partitioned tables, as search trigger is, need PostgreSQL 13.
+    if schema_editor.connection.pg_version < 130000:
+        raise NotSupportedError(f'Partitioning message table requires PostgreSQL 13 or later, '
+                                f'server is version {schema_editor.connection.pg_version}.')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = 'api_message' AND indexname <> 'api_message_pkey'
+        """)
+        indexes = cursor.fetchall()
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = 'api_message'::regclass AND contype = 'f'
+        """)
+        foreign_keys = cursor.fetchall()
+        cursor.execute("SELECT pg_get_serial_sequence('api_message', 'id')")
+        sequence = cursor.fetchone()[0]
+        cursor.execute("SELECT date_trunc('month', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'")
+        month = cursor.fetchone()[0]
+
+    # Keep existing table with its rows as legacy partition, freeing names of its indexes and constraints.
+    schema_editor.execute('ALTER TABLE api_message RENAME TO api_message_p_legacy')
+    for name, _ in indexes:
+        schema_editor.execute(f'ALTER INDEX {name} RENAME TO {legacy_name(name)}')
+    for name, _ in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE api_message_p_legacy RENAME CONSTRAINT {name} TO {legacy_name(name)}')
+    schema_editor.execute('DROP TRIGGER IF EXISTS api_message_search_vector_trg ON api_message_p_legacy')
+    schema_editor.execute('ALTER TABLE api_message_p_legacy DROP CONSTRAINT api_message_pkey')
+    schema_editor.execute('ALTER TABLE api_message_p_legacy ADD CONSTRAINT legacy_api_message_pkey '
+                          'PRIMARY KEY (id, timestamp)')
+
+    schema_editor.execute('CREATE TABLE api_message (LIKE api_message_p_legacy INCLUDING DEFAULTS) '
+                          'PARTITION BY RANGE (timestamp)')
+    schema_editor.execute(f'ALTER SEQUENCE {sequence} OWNED BY api_message.id')
+
+    boundary = next_month(month)
+    schema_editor.execute('ALTER TABLE api_message ATTACH PARTITION api_message_p_legacy '
+                          'FOR VALUES FROM (MINVALUE) TO (%s)', [boundary])
+
+    # Matching indexes and constraints of legacy partition are attached instead of built again.
+    schema_editor.execute('ALTER TABLE api_message ADD CONSTRAINT api_message_pkey PRIMARY KEY (id, timestamp)')
+    for _, definition in indexes:
+        schema_editor.execute(definition)
+    for name, definition in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE api_message ADD CONSTRAINT {name} {definition}')
+    schema_editor.execute(SEARCH_TRIGGER_SQL)
+
+    start = boundary
+    for _ in range(MONTHS_AHEAD):
+        end = next_month(start)
+        schema_editor.execute(f"CREATE TABLE api_message_p{start:%Y%m} PARTITION OF api_message "
+                              f"FOR VALUES FROM (%s) TO (%s)", [start, end])
+        start = end
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_message_search_vector'),
+    ]
+
+    operations = [
+        # Not reversible on PostgreSQL: table stays partitioned when migrating back.
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+    ]
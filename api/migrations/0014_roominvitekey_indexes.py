@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_room_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='roominvitekey',
+            index=models.Index(fields=['valid_due'], name='api_roominvitekey_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='roominvitekey',
+            index=models.Index(fields=['room', 'valid_due'], name='api_roominvitekey_room_due_idx'),
+        ),
+    ]
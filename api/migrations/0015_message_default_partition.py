@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+def create_default_partition(apps, schema_editor):
+    """
+    Adds default partition to partitioned message table (see migration 0012), so that messages
+    are still saved when partition of their month wasn't created in time by create_message_partitions
+    command. The command moves them to their partition once it creates it.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'api_message'::regclass")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute('CREATE TABLE IF NOT EXISTS api_message_p_default PARTITION OF api_message DEFAULT')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_roominvitekey_indexes'),
+    ]
+
+    operations = [
+        # Not reversible: dropping default partition would drop messages saved in it.
+        migrations.RunPython(create_default_partition, migrations.RunPython.noop),
+    ]
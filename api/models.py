@@ -3,7 +3,9 @@ import string
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 
@@ -14,10 +16,22 @@ class CustomUser(AbstractUser):
     foo = models.CharField(blank=True, max_length=120)
 
 
+class RoomManager(models.Manager):
+    """
+    Manager of rooms which are not deleted. Deleted rooms wait for purge_deleted_rooms
+    command, which reaches them with Room.all_objects.
+    """
+
+    def get_queryset(self):
+        return super(RoomManager, self).get_queryset().filter(deleted_at__isnull=True)
+
+
 class Room(models.Model):
     """
     Room model that holds associated messages and users.
     """
+    objects = RoomManager()
+    all_objects = models.Manager()
 
     # Unique room name.
     name = models.TextField(max_length=50)
@@ -37,16 +51,79 @@ class Room(models.Model):
     # Normal room users who will be sending messages.
     users = models.ManyToManyField(settings.AUTH_USER_MODEL, default=None, related_name='room_users')
 
+    # Activity counters, updated whenever messages are saved (see record_messages()).
+    message_count = models.BigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+
+    # Time room was deleted. Deleted room is hidden at once, its data is purged later (see soft_delete()).
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
     def __str__(self):
         return f'Room | id: {self.id},  name:{self.name}'
 
+    def soft_delete(self):
+        """
+        Hides and deactivates the room and deletes its invite keys, with a few small queries.
+        Its messages and the room itself are deleted later, in chunks, by purge_deleted_rooms command.
+        """
+        self.active = False
+        self.deleted_at = timezone.now()
+        Room.all_objects.filter(pk=self.pk).update(active=self.active, deleted_at=self.deleted_at)
+        RoomInviteKey.objects.filter(room_id=self.pk).delete()
+
+    @classmethod
+    def record_messages(cls, room_id, count, last_message):
+        """
+        Updates activity counters of the room after messages were saved, with a single UPDATE.
+        Should run in the same transaction that saved the messages.
+        Last message only moves forward, so concurrent writers can't move it back.
+
+        :param count: Number of saved messages.
+        :param last_message: The newest of saved messages.
+        """
+        newer = models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lt=last_message.timestamp) | \
+            models.Q(last_message_at=last_message.timestamp, last_message_id__lt=last_message.id)
+        cls.objects.filter(pk=room_id).update(
+            message_count=models.F('message_count') + count,
+            last_message_at=models.Case(models.When(newer, then=models.Value(last_message.timestamp)),
+                                        default=models.F('last_message_at'), output_field=models.DateTimeField()),
+            last_message_id=models.Case(models.When(newer, then=models.Value(last_message.id)),
+                                        default=models.F('last_message_id'), output_field=models.BigIntegerField()),
+        )
+
+    @classmethod
+    def rebuild_activity(cls, queryset):
+        """
+        Recomputes activity counters of rooms in given queryset from their messages, with a single UPDATE.
+        """
+        room_messages = Message.objects.filter(room=models.OuterRef('pk')).order_by()
+        newest = room_messages.order_by('-timestamp', '-id')
+        return queryset.update(
+            message_count=count_subquery(room_messages),
+            last_message_at=models.Subquery(newest.values('timestamp')[:1]),
+            last_message_id=models.Subquery(newest.values('id')[:1]),
+        )
+
+
+def count_subquery(queryset):
+    """
+    :returns: Expression counting rows of given single room messages queryset, to be used in annotations.
+    """
+    counts = queryset.order_by().values('room').annotate(count=models.Count('id')).values('count')
+    return Coalesce(models.Subquery(counts), 0)
+
 
 class Message(models.Model):
     """
     Message model that holds user messages.
     """
     class Meta:
-        ordering = ['-timestamp']
+        ordering = ['-timestamp', '-id']
+        indexes = [
+            # Room history is read newest first, page by page (see api.pagination).
+            models.Index(fields=['room', '-timestamp', '-id'], name='api_message_room_ts_id_idx'),
+        ]
 
     # Room the message is in.
     room = models.ForeignKey(Room, on_delete=models.CASCADE, default=None, related_name='messages')
@@ -60,10 +137,62 @@ class Message(models.Model):
     # Message text content.
     text = models.TextField(null=False)
 
+    # Words of message text for full-text search (see api.search).
+    # On PostgreSQL, set by database trigger on every insert and update, and GIN-indexed.
+    search_vector = SearchVectorField(null=True, editable=False)
+
     def __str__(self):
         return f'Message | id:{self.id} text:{self.text}'
 
 
+class RoomReadCursor(models.Model):
+    """
+    Read cursor model that holds the last message a user has read in a room.
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='api_roomreadcursor_user_room_uniq'),
+        ]
+
+    # User who read the messages.
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='read_cursors')
+
+    # Room the messages are in.
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_cursors')
+
+    # Last read message id and time it was sent. Messages after it are unread.
+    last_read_message_id = models.BigIntegerField()
+    last_read_timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return f'Read cursor | user: {self.user_id}, room: {self.room_id}, message: {self.last_read_message_id}'
+
+    @classmethod
+    def advance(cls, user_id, room_id, message_id):
+        """
+        Moves user's read cursor in the room forward to given message. Never moves it back.
+
+        :returns: True if cursor moved.
+        """
+        message = Message.objects.filter(id=message_id, room_id=room_id).values('id', 'timestamp').first()
+        if message is None:
+            return False
+
+        cursor, created = cls.objects.get_or_create(user_id=user_id, room_id=room_id, defaults={
+            'last_read_message_id': message['id'],
+            'last_read_timestamp': message['timestamp'],
+        })
+        if created:
+            return True
+
+        behind = models.Q(last_read_timestamp__lt=message['timestamp']) | models.Q(
+            last_read_timestamp=message['timestamp'], last_read_message_id__lt=message['id'])
+        return cls.objects.filter(behind, pk=cursor.pk).update(
+            last_read_message_id=message['id'],
+            last_read_timestamp=message['timestamp'],
+        ) > 0
+
+
 def get_invite_key_string():
     """
     :returns: Random and unique string of random characters.
@@ -75,9 +204,6 @@ def get_inivite_key_expire_date():
     """
     :returns: Room invite key expire date.
     """
-    print(timezone.now())
-    print(timezone.timedelta(hours=2))
-    print(timezone.now() + timezone.timedelta(hours=2))
     return timezone.now() + timezone.timedelta(hours=2)  # Valid for 2 hours.
 
 
@@ -85,6 +211,13 @@ class RoomInviteKey(models.Model):
     """
     Room invite key model that holds access keys for rooms.
     """
+    class Meta:
+        indexes = [
+            # Expired keys are found and deleted in order of expiry (see purge_invite_keys command).
+            models.Index(fields=['valid_due'], name='api_roominvitekey_due_idx'),
+            # Keys of a room are listed without reading keys of other rooms.
+            models.Index(fields=['room', 'valid_due'], name='api_roominvitekey_room_due_idx'),
+        ]
 
     # Invite key string.
     key = models.TextField(null=False, unique=True, default=get_invite_key_string)
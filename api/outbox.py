@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import logging
+import weakref
+
+from api import metrics
+from api.frames import control_frame
+
+logger = logging.getLogger(__name__)
+
+# What happens when outbound queue of a connection is full.
+DROP_OLDEST = 'drop_oldest'     # Oldest queued frame is dropped.
+COALESCE = 'coalesce'           # Queued messages are replaced with one 'gap' frame per room.
+DISCONNECT = 'disconnect'       # Connection is closed, client is told where to resume from.
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# Close code sent to clients disconnected for reading too slowly.
+CLOSE_CODE_OVERFLOW = 4008
+
+frames_dropped = metrics.counter('chat_outbox_frames_dropped_total',
+                                 'Frames dropped from full outbound queues.', ['policy'])
+overflows = metrics.counter('chat_outbox_overflows_total',
+                            'Times a frame was queued to a full outbound queue.', ['policy'])
+
+
+class Outbox:
+    """
+    Bounded queue of frames waiting to be sent to one WebSocket connection.
+
+    Frames are queued without waiting and sent by a separate task. A client reading
+    slowly holds up only its own queue, instead of the consumer that receives
+    messages from channel layer, where they would pile up and get dropped silently.
+
+    Message frames carry room id and message id, so that clients can be told which
+    messages they missed: 'gap' frame sent after messages of a room were dropped, or
+    'overflow' frame sent before closing connection (disconnect policy), carry id of
+    the last message of the room sent to the client. Client fetches messages after it
+    from REST API ('after' parameter) and drops ones it already has by id.
+    """
+
+    instances = weakref.WeakSet()   # All open outboxes of the process, read by metrics.
+
+    def __init__(self, send, close, max_frames=1000, policy=DROP_OLDEST):
+        assert policy in POLICIES, f'Unknown outbox policy {policy}'
+        self.send = send                    # Coroutine function sending frame text to client.
+        self.close = close                  # Coroutine function closing connection, called with resume cursor.
+        self.max_frames = max_frames
+        self.policy = policy
+        self.frames = collections.deque()   # Tuples of (frame text, room id, message id, sequence number).
+        self.sequence = 0                   # Sequence number of the last queued frame.
+        self.sent_ids = {}                  # Room id -> id of the last message sent to client.
+        self.missed = {}                    # Rooms with dropped messages, client is yet to be told about.
+        self.gap_sequences = {}             # Room id -> sequence number of the last frame queued before 'gap' was sent.
+        self.ready = asyncio.Event()
+        self.task = None
+        self.closed = False
+        Outbox.instances.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.closed = True
+        self.frames.clear()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def put(self, frame, room_id=None, message_id=None):
+        """
+        Queues frame without waiting. Message frames have to give their room id.
+        """
+        if self.closed:
+            return
+        if len(self.frames) >= self.max_frames:
+            self.overflow()
+            if self.closed:
+                return
+        self.sequence += 1
+        self.frames.append((frame, room_id, message_id, self.sequence))
+        self.ready.set()
+
+    def overflow(self):
+        overflows.inc(policy=self.policy)
+
+        if self.policy == DISCONNECT:
+            frames_dropped.inc(len(self.frames), policy=self.policy)
+            self.stop()
+            asyncio.ensure_future(self.close(self.resume_cursor()))
+            return
+
+        if self.policy == COALESCE:
+            # Keep control frames only, client fetches messages of their rooms from history.
+            kept = collections.deque(item for item in self.frames if item[1] is None)
+            if len(kept) < len(self.frames):
+                for _, room_id, _, sequence in self.frames:
+                    self.drop(room_id, sequence)
+                frames_dropped.inc(len(self.frames) - len(kept), policy=self.policy)
+                self.frames = kept
+                return
+
+        # Drop oldest, also when there were no messages to coalesce.
+        _, room_id, _, sequence = self.frames.popleft()
+        frames_dropped.inc(policy=self.policy)
+        self.drop(room_id, sequence)
+
+    def drop(self, room_id, sequence):
+        """
+        Remembers that client missed a message of the room, unless it was saved
+        before client was told to fetch room's messages ('gap' frame was sent).
+        """
+        if room_id is not None and sequence > self.gap_sequences.get(room_id, 0):
+            self.missed[room_id] = True
+
+    def resume_cursor(self):
+        """
+        :returns: Dict of room id -> id of the last message sent to client.
+        """
+        return dict(self.sent_ids)
+
+    def next_frame(self):
+        """
+        :returns: Next tuple of (frame text, room id, message id) to send. Client learns about
+                  missed messages before any frame queued after they were dropped.
+        """
+        if self.missed:
+            room_id = next(iter(self.missed))
+            del self.missed[room_id]
+            self.gap_sequences[room_id] = self.sequence
+            return control_frame('gap', room_id, after=self.sent_ids.get(room_id)), None, None
+        return self.frames.popleft()[:3]
+
+    async def run(self):
+        while not self.closed:
+            if not self.frames and not self.missed:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            frame, room_id, message_id = self.next_frame()
+            try:
+                await self.send(frame)
+            except Exception:
+                logger.exception('Sending frame to client failed, outbox stopped.')
+                self.stop()
+                return
+            if room_id is not None and message_id is not None:
+                self.sent_ids[room_id] = message_id
+
+
+metrics.gauge('chat_outbox_frames', 'Frames waiting in outbound queues of all connections.',
+              function=lambda: sum(len(outbox) for outbox in list(Outbox.instances)))
+metrics.gauge('chat_outbox_max_frames', 'Frames waiting in the fullest outbound queue.',
+              function=lambda: max((len(outbox) for outbox in list(Outbox.instances)), default=0),
+              aggregate=metrics.MAX)
@@ -0,0 +1,299 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+# Cursor directions.
+OLDER = 'b'
+NEWER = 'a'
+
+
+def encode_cursor(direction, timestamp, pk):
+    """
+    :returns: Opaque cursor string pointing at given (timestamp, id) position.
+    """
+    raw = f'{direction}|{timestamp.isoformat()}|{pk}'
+    return b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :returns: Tuple of (direction, timestamp, id) decoded from opaque cursor string.
+    :raises ValueError: If cursor is malformed.
+    """
+    direction, timestamp, pk = b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+    timestamp = parse_datetime(timestamp)
+    if direction not in (OLDER, NEWER) or timestamp is None:
+        raise ValueError('Invalid cursor.')
+    return direction, timestamp, int(pk)
+
+
+def encode_search_cursor(rank, pk):
+    """
+    :returns: Opaque cursor string pointing at given (rank, id) position in search results.
+    """
+    raw = f'{rank!r}|{pk}'
+    return b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_search_cursor(cursor):
+    """
+    :returns: Tuple of (rank, id) decoded from opaque cursor string.
+    :raises ValueError: If cursor is malformed.
+    """
+    rank, pk = b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+    return float(rank), int(pk)
+
+
+def older_than(timestamp, pk):
+    """
+    :returns: Filter matching messages placed after (timestamp, id) in '-timestamp, -id' order.
+    """
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+
+
+def newer_than(timestamp, pk):
+    """
+    :returns: Filter matching messages placed before (timestamp, id) in '-timestamp, -id' order.
+    """
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+
+
+class MessageHistoryPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination with an additional keyset (cursor) mode for room history.
+
+    Keyset mode is used when any of 'cursor', 'before' or 'after' parameters is passed:
+        ?room_id=1&cursor=            newest page,
+        ?room_id=1&before=<id>        page of messages older than message <id>,
+        ?room_id=1&after=<id>         page of messages newer than message <id>,
+        ?room_id=1&cursor=<cursor>    page pointed by 'next' or 'previous' link.
+
+    Keyset pages are filtered on the (room, timestamp, id) index instead of
+    skipping rows with OFFSET, so each page costs the same regardless of depth.
+    Results are always ordered from newest to oldest. 'next' points to older
+    messages, 'previous' points to newer ones.
+
+    When room_archive is set (see api.archive), keyset pages going past the oldest
+    message in database continue with archived messages, which are older than any
+    message in database. Cursors pointing at archived messages work the same way.
+    """
+    cursor_query_param = 'cursor'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    keyset = False
+    room_archive = None     # RoomArchive of the paginated room, set by view.
+
+    def is_keyset_request(self, request):
+        """
+        :returns: True if request asks for keyset pagination.
+        """
+        params = request.query_params
+        return any(param in params for param in (
+            self.cursor_query_param, self.before_query_param, self.after_query_param
+        ))
+
+    def get_position(self, request, queryset):
+        """
+        :returns: Tuple of (direction, timestamp, id) or None for the newest page.
+        """
+        params = request.query_params
+
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                return decode_cursor(cursor)
+            except (TypeError, ValueError, UnicodeError):
+                raise NotFound('Invalid cursor.')
+
+        for direction, param in ((OLDER, self.before_query_param), (NEWER, self.after_query_param)):
+            pk = params.get(param)
+            if pk:
+                # Single primary key lookup to get message's place in history.
+                try:
+                    timestamp = queryset.filter(pk=int(pk)).values_list('timestamp', flat=True).get()
+                except (ValueError, queryset.model.DoesNotExist):
+                    raise NotFound(f"Message '{pk}' not found in this room.")
+                return direction, timestamp, int(pk)
+
+        return None
+
+    def is_newest_page_request(self, request):
+        """
+        :returns: True if request asks for the newest page of history.
+        """
+        if self.is_keyset_request(request):
+            params = request.query_params
+            return not any(params.get(param) for param in (
+                self.cursor_query_param, self.before_query_param, self.after_query_param
+            ))
+        return self.get_offset(request) == 0
+
+    def paginate_recent(self, count, recent, request):
+        """
+        Paginates the newest page out of already serialized recent messages (see api.history_cache).
+
+        :param count: Number of all messages in the room.
+        :param recent: List of serialized most recent messages of the room, newest first.
+        :returns: Page of serialized messages, or None if there is not enough of them to fill the page.
+        """
+        self.keyset = self.is_keyset_request(request)
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None or (self.limit > len(recent) and count > len(recent)):
+            return None
+
+        self.page = recent[:self.limit]
+        if self.keyset:
+            self.position = None
+            self.has_older = count > len(self.page)
+            self.has_newer = False
+        else:
+            self.count = count
+            self.offset = 0
+        return self.page
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.is_keyset_request(request)
+        if not self.keyset:
+            return super(MessageHistoryPagination, self).paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.position = self.get_position(request, queryset)
+
+        if self.position is None:
+            direction = OLDER
+            page = queryset.order_by('-timestamp', '-id')
+        else:
+            direction, timestamp, pk = self.position
+            if direction == OLDER:
+                page = queryset.filter(older_than(timestamp, pk)).order_by('-timestamp', '-id')
+            else:
+                page = queryset.filter(newer_than(timestamp, pk)).order_by('timestamp', 'id')
+
+        # Fetch one extra row to know whether there is anything left in that direction.
+        if direction == NEWER and self.room_archive is not None:
+            # Archived messages newer than cursor come before any message in database.
+            archived = self.room_archive.newer(self.position[1:], self.limit + 1)
+            page = archived + list(page[:self.limit + 1 - len(archived)])
+        else:
+            page = list(page[:self.limit + 1])
+            if direction == OLDER and len(page) <= self.limit and self.room_archive is not None:
+                # Database has no more older messages, continue with archived ones.
+                position = self.get_item_position(page[-1]) if page else (self.position and self.position[1:])
+                page += self.room_archive.older(position, self.limit + 1 - len(page))
+        has_more = len(page) > self.limit
+        page = page[:self.limit]
+
+        if direction == NEWER:
+            page.reverse()
+            self.has_older = True
+            self.has_newer = has_more
+        else:
+            self.has_older = has_more
+            self.has_newer = self.position is not None
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(MessageHistoryPagination, self).get_paginated_response(data)
+
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    @staticmethod
+    def get_item_position(item):
+        """
+        :returns: Tuple of (timestamp, id) of Message object or serialized message.
+        """
+        if isinstance(item, dict):
+            return parse_datetime(item['timestamp']), item['id']
+        return item.timestamp, item.id
+
+    def get_cursor_link(self, direction, item):
+        """
+        :returns: Absolute URL pointing at page next to given message in given direction.
+        """
+        timestamp, pk = self.get_item_position(item)
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        url = remove_query_param(url, self.offset_query_param)
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(direction, timestamp, pk))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(MessageHistoryPagination, self).get_next_link()
+
+        if not self.page or not self.has_older:
+            return None
+        return self.get_cursor_link(OLDER, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super(MessageHistoryPagination, self).get_previous_link()
+
+        if not self.page or not self.has_newer:
+            return None
+        return self.get_cursor_link(NEWER, self.page[0])
+
+
+class MessageSearchPagination(LimitOffsetPagination):
+    """
+    Keyset pagination of message search results, ordered by '-rank', '-id' (see api.search):
+        ?q=<text>                     best matches,
+        ?q=<text>&cursor=<cursor>     page pointed by 'next' link.
+
+    Cursor holds rank and id of the last message of a page, so pages are filtered
+    instead of skipping rows with OFFSET, and deep pages cost the same as the first one.
+    """
+    cursor_query_param = 'cursor'
+    max_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                rank, pk = decode_search_cursor(cursor)
+            except (TypeError, ValueError, UnicodeError):
+                raise NotFound('Invalid cursor.')
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+        # Fetch one extra row to know whether there are more results.
+        page = list(queryset[:self.limit + 1])
+        self.has_more = len(page) > self.limit
+        self.page = page[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.page or not self.has_more:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, encode_search_cursor(last.rank, last.id))
+
+    def get_previous_link(self):
+        return None
@@ -0,0 +1,129 @@
+"""
+Monthly range partitions of message table on PostgreSQL (see migration 0012).
+
+Partition api_message_pYYYYMM holds messages with timestamp in that month (UTC).
+Messages saved before the table was partitioned are in api_message_p_legacy.
+Partitions are created ahead with create_message_partitions command, which has to run
+regularly, e.g. daily from cron. Messages of months without partition are saved in
+default partition api_message_p_default, and moved to their partitions once they are
+created. Stale partitions are reported by a system check (see api.checks).
+"""
+import collections
+import datetime
+import re
+
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+
+MESSAGE_TABLE = 'api_message'
+DEFAULT_PARTITION = f'{MESSAGE_TABLE}_p_default'
+
+Partition = collections.namedtuple('Partition', ['name', 'start', 'end'])   # Range [start, end), None if unbounded.
+
+# Partition bound as shown by pg_get_expr(), e.g. "FOR VALUES FROM ('2026-10-01 00:00:00+00') TO (MAXVALUE)".
+BOUND_RE = re.compile(r"FROM \((?:'(?P<start>[^']+)'|MINVALUE)\) TO \((?:'(?P<end>[^']+)'|MAXVALUE)\)")
+
+
+def month_start(value):
+    """
+    :returns: Start of the month (UTC) given datetime is in.
+    """
+    value = value.astimezone(datetime.timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value):
+    """
+    :returns: Start of the month following the month starting at given datetime.
+    """
+    return (value + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start):
+    return f'{MESSAGE_TABLE}_p{start:%Y%m}'
+
+
+def parse_bound(value):
+    return parse_datetime(value) if value else None
+
+
+def is_partitioned():
+    """
+    :returns: True if message table is partitioned.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [MESSAGE_TABLE])
+        return cursor.fetchone() is not None
+
+
+def message_partitions():
+    """
+    :returns: List of Partition tuples of message table, oldest first, default partition excluded.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+        """, [MESSAGE_TABLE])
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_RE.search(bound)
+        if match is not None:
+            partitions.append(Partition(name, parse_bound(match.group('start')), parse_bound(match.group('end'))))
+    return sorted(partitions, key=lambda partition: partition.start or datetime.datetime.min.replace(
+        tzinfo=datetime.timezone.utc))
+
+
+def default_partition_has_rows():
+    """
+    :returns: True if any message is saved in default partition, i.e. partitions were not created in time.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION})')
+        return cursor.fetchone()[0]
+
+
+def create_partitions(until):
+    """
+    Creates monthly partitions following the newest one, until the one containing given time.
+    Messages of their months saved meanwhile in default partition are moved into them.
+    Should run in a transaction, so that moved messages are never missing.
+
+    :returns: List of names of created partitions.
+    """
+    partitions = message_partitions()
+    start = partitions[-1].end if partitions else month_start(until)
+    if start is None:
+        return []
+
+    created = []
+    with connection.cursor() as cursor:
+        while start <= until:
+            end = next_month(start)
+            name = partition_name(start)
+            # Partition can't be attached while default partition holds rows of its range, they are moved first.
+            cursor.execute(f'CREATE TABLE {name} (LIKE {MESSAGE_TABLE} INCLUDING DEFAULTS)')
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s '
+                f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                [start, end],
+            )
+            cursor.execute(f'ALTER TABLE {MESSAGE_TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                           [start, end])
+            created.append(name)
+            start = end
+    return created
+
+
+def drop_partition(name):
+    """
+    Detaches partition from message table and drops it, without deleting its rows one by one.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {MESSAGE_TABLE} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
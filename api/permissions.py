@@ -1,5 +1,7 @@
 from rest_framework import permissions
 
+from .membership import get_membership
+
 
 class RejectAll(permissions.BasePermission):
     """
@@ -14,11 +16,22 @@ class ActionBasedPermission(permissions.AllowAny):
     Grant or deny access to a view, based on a request
     type mapping in view.action_permissions.
     """
-    def has_permission(self, request, view):
+    def get_action_permission(self, view):
+        """
+        :returns: Permission object mapped to view's action, or None.
+        """
         for cls, actions in getattr(view, 'action_permissions', {}).items():
             if view.action in actions:
-                return cls().has_permission(request, view)
-        return False
+                return cls()
+        return None
+
+    def has_permission(self, request, view):
+        permission = self.get_action_permission(view)
+        return permission is not None and permission.has_permission(request, view)
+
+    def has_object_permission(self, request, view, obj):
+        permission = self.get_action_permission(view)
+        return permission is not None and permission.has_object_permission(request, view, obj)
 
 
 class IsRoomAdminOrStaff(permissions.IsAuthenticated):
@@ -32,7 +45,7 @@ class IsRoomAdminOrStaff(permissions.IsAuthenticated):
             return True
 
         # Check if user is room admin and if so, allow.
-        return request.user in obj.admins.all()
+        return get_membership(request).is_admin(obj.pk)
 
 
 class IsInviteKeyCreatorOrRoomAdminOrStaff(permissions.IsAuthenticated):
@@ -46,9 +59,9 @@ class IsInviteKeyCreatorOrRoomAdminOrStaff(permissions.IsAuthenticated):
         if request.user.is_staff:
             return True
 
-        # Check if user is room admin and if so, allow.
-        if request.user in obj.room.admins.all():
+        # Check if user is key creator and if so, allow.
+        if obj.creator_id == request.user.pk:
             return True
 
-        # Check if user is key creator and if so, allow.
-        return request.user in obj.room.creator
\ No newline at end of file
+        # Check if user is room admin and if so, allow.
+        return get_membership(request).is_admin(obj.room_id)
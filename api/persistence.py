@@ -0,0 +1,194 @@
+import asyncio
+import atexit
+import collections
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+
+from api.history_cache import get_history_cache
+from api.services import messages_saved
+from api.models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+# Durability modes.
+PERSIST = 'persist'  # Sender is acknowledged (message is broadcast) after its batch is saved.
+ENQUEUE = 'enqueue'  # Sender is acknowledged (message is broadcast) right after it is queued, with reserved id.
+
+
+class MessageWriter:
+    """
+    Write-behind buffer of Message objects.
+
+    Messages are queued in memory and a background task saves them with
+    bulk_create in micro-batches, bounded by size and by time.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.02, id_block_size=100):
+        self.batch_size = batch_size            # Max messages saved with one INSERT.
+        self.flush_interval = flush_interval    # Max seconds a message waits in queue.
+        self.id_block_size = id_block_size      # Message ids reserved with one query.
+        self.reserved_ids = collections.deque()  # Reserved message ids not given to messages yet.
+        self.pending = []                       # List of (message, future) tuples waiting for flush.
+        self.task = None                        # Background flushing task.
+        self.has_pending = None                 # Set when queue is not empty.
+        self.batch_full = None                  # Set when queue holds a full batch.
+        self.lock = None                        # Prevents concurrent flushes.
+
+    def start(self):
+        """
+        Starts background flushing task in running event loop, unless it is running already.
+        """
+        if self.task is not None and not self.task.done():
+            return
+        self.has_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    @staticmethod
+    def can_reserve_ids():
+        """
+        :returns: True if ids of messages can be reserved before they are saved, i.e. database has sequences.
+        """
+        return connection.vendor == 'postgresql'
+
+    def reserve_ids(self):
+        """
+        Reserves a block of ids from message id sequence, with a single query.
+        Ids reserved and never used, e.g. when process stops, are just left out, as with rolled back inserts.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [Message._meta.db_table, self.id_block_size])
+            self.reserved_ids.extend(row[0] for row in cursor.fetchall())
+
+    async def next_id(self):
+        """
+        :returns: Id for a message to be queued, so that it can be broadcast with its id before it's saved.
+        """
+        if not self.reserved_ids:
+            await database_sync_to_async(self.reserve_ids)()
+        return self.reserved_ids.popleft()
+
+    def submit(self, message, wait=True):
+        """
+        Queues unsaved Message object.
+
+        :returns: Future resolved with saved message, or None if wait is False.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.pending.append((message, future))
+
+        self.has_pending.set()
+        if len(self.pending) >= self.batch_size:
+            self.batch_full.set()
+        return future
+
+    async def run(self):
+        """
+        Background task. Flushes queue whenever it has a full batch or its oldest message waited long enough.
+        """
+        while True:
+            await self.has_pending.wait()
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        """
+        Saves all queued messages.
+        """
+        async with self.lock:
+            while self.pending:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                if not self.pending:
+                    self.has_pending.clear()
+                if len(self.pending) < self.batch_size:
+                    self.batch_full.clear()
+
+                try:
+                    saved = await database_sync_to_async(self.write)([message for message, _ in batch])
+                except Exception as e:
+                    logger.exception('Saving batch of %d messages failed.', len(batch))
+                    for _, future in batch:
+                        if future is not None and not future.done():
+                            future.set_exception(e)
+                    continue
+
+                saved = {id(message) for message in saved}
+                for message, future in batch:
+                    if future is None or future.done():
+                        continue
+                    if id(message) in saved:
+                        future.set_result(message)
+                    else:
+                        future.set_exception(Room.DoesNotExist(f'Room {message.room_id} does not exist.'))
+
+    def write(self, messages):
+        """
+        Saves messages with a single INSERT, skipping those whose room no longer exists.
+
+        :returns: List of saved messages.
+        """
+        room_ids = set(Room.objects.filter(id__in={m.room_id for m in messages}).values_list('id', flat=True))
+        messages = [m for m in messages if m.room_id in room_ids]
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            self.record(messages)
+        messages_saved.inc(len(messages), path='batch')
+
+        cache = get_history_cache()
+        if cache is not None:
+            for message in messages:
+                # Some databases (SQLite) do not return primary keys of bulk inserted rows.
+                if message.pk is None:
+                    cache.invalidate(message.room_id)
+                else:
+                    cache.append(message)
+        return messages
+
+    @staticmethod
+    def record(messages):
+        """
+        Updates activity counters of rooms of saved messages, with one UPDATE per room.
+        """
+        rooms = {}
+        for message in messages:
+            rooms.setdefault(message.room_id, []).append(message)
+
+        for room_id, room_messages in rooms.items():
+            last = room_messages[-1]
+            # Some databases (SQLite) do not return primary keys of bulk inserted rows.
+            if last.pk is None:
+                last = Message.objects.filter(room_id=room_id).only('id', 'timestamp').latest('timestamp', 'id')
+            Room.record_messages(room_id, len(room_messages), last)
+
+    def flush_sync(self):
+        """
+        Saves queued messages from outside of event loop. Used at interpreter exit.
+        """
+        batch, self.pending = self.pending, []
+        if batch:
+            self.write([message for message, _ in batch])
+
+
+_writer = None
+
+
+def get_message_writer():
+    """
+    :returns: Process-wide MessageWriter configured with CHAT_MESSAGE_PIPELINE setting.
+    """
+    global _writer
+    if _writer is None:
+        config = settings.CHAT_MESSAGE_PIPELINE
+        _writer = MessageWriter(batch_size=config['BATCH_SIZE'], flush_interval=config['FLUSH_INTERVAL'],
+                                id_block_size=config['ID_BLOCK_SIZE'])
+        atexit.register(_writer.flush_sync)
+    return _writer
@@ -0,0 +1,397 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from api import metrics
+from api.frames import control_frame
+
+logger = logging.getLogger(__name__)
+
+# Kinds of presence state of a user in a room.
+ONLINE = 'o'
+TYPING = 't'
+
+frames_published = metrics.counter('chat_presence_frames_total', 'Presence diff frames sent to rooms.')
+
+
+def presence_diff(changes):
+    """
+    :param changes: Iterable of (kind, username, active) tuples, the latest state of each changed user.
+    :returns: Dict of lists of usernames which 'joined', 'left', started 'typing' and 'stopped_typing',
+              empty lists left out.
+    """
+    diff = collections.OrderedDict((key, []) for key in ('joined', 'left', 'typing', 'stopped_typing'))
+    for kind, username, active in changes:
+        if kind == ONLINE:
+            diff['joined' if active else 'left'].append(username)
+        else:
+            diff['typing' if active else 'stopped_typing'].append(username)
+    return collections.OrderedDict((key, usernames) for key, usernames in diff.items() if usernames)
+
+
+class LocMemPresenceStore:
+    """
+    In-process store of users online and typing in each room, for single process deployments only.
+
+    Each user is kept with time its state expires, unless refreshed. Changes of users'
+    state since the last flush are kept per room, the latest one per user.
+    """
+
+    def __init__(self, ttl=45, typing_ttl=5, interval=0.5):
+        self.ttl = ttl                  # Seconds user stays online without being refreshed.
+        self.typing_ttl = typing_ttl    # Seconds user stays typing without being refreshed.
+        self.interval = interval        # Min seconds between flushes of a room.
+        self.states = {ONLINE: collections.defaultdict(dict), TYPING: collections.defaultdict(dict)}
+        self.pending = collections.defaultdict(collections.OrderedDict)   # Room id -> (kind, username) -> active.
+        self.flushed = {}               # Room id -> time room was last flushed.
+        self.lock = threading.Lock()
+
+    def update(self, changes):
+        """
+        Applies changes of users' state and expires users which were not refreshed.
+        Only actual changes are recorded to be flushed, refreshing a user records nothing.
+
+        :param changes: Dict of room id -> dict of (kind, username) -> active.
+        """
+        now = time.monotonic()
+        ttls = {ONLINE: self.ttl, TYPING: self.typing_ttl}
+        with self.lock:
+            for room_id, room_changes in changes.items():
+                self.expire(room_id, now)
+                for (kind, username), active in room_changes.items():
+                    if active:
+                        self.set(room_id, kind, username, now + ttls[kind])
+                    else:
+                        self.remove(room_id, kind, username)
+                        if kind == ONLINE:
+                            self.remove(room_id, TYPING, username)
+
+    def set(self, room_id, kind, username, expires):
+        users = self.states[kind][room_id]
+        if username not in users:
+            self.pending[room_id][(kind, username)] = True
+        users[username] = expires
+
+    def remove(self, room_id, kind, username):
+        users = self.states[kind].get(room_id)
+        if users and users.pop(username, None) is not None:
+            self.pending[room_id][(kind, username)] = False
+            if not users:
+                del self.states[kind][room_id]
+
+    def expire(self, room_id, now):
+        for kind in (ONLINE, TYPING):
+            users = self.states[kind].get(room_id, {})
+            for username in [username for username, expires in users.items() if expires <= now]:
+                self.remove(room_id, kind, username)
+
+    def flush(self, room_ids):
+        """
+        Takes changes recorded in rooms, unless a room was flushed less than interval ago.
+
+        :returns: Dict of room id -> presence diff of the room, or None if it was flushed too recently.
+        """
+        now = time.monotonic()
+        diffs = {}
+        with self.lock:
+            for room_id in room_ids:
+                pending = self.pending.get(room_id)
+                if not pending:
+                    diffs[room_id] = {}
+                elif now - self.flushed.get(room_id, -self.interval) < self.interval:
+                    diffs[room_id] = None
+                else:
+                    self.flushed[room_id] = now
+                    del self.pending[room_id]
+                    diffs[room_id] = presence_diff((kind, username, active)
+                                                   for (kind, username), active in pending.items())
+        return diffs
+
+    def snapshot(self, room_id):
+        """
+        :returns: Dict with lists of usernames 'online' and 'typing' in the room.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'online': [name for name, expires in self.states[ONLINE].get(room_id, {}).items() if expires > now],
+                'typing': [name for name, expires in self.states[TYPING].get(room_id, {}).items() if expires > now],
+            }
+
+
+class RedisPresenceStore:
+    """
+    Redis store of users online and typing in each room, shared by all processes.
+
+    Each room is two sorted sets of usernames, online and typing ones, scored with
+    time their state expires, plus a hash of changes not yet flushed. Room is flushed
+    by whichever process gets to it first, at most once per interval.
+    """
+
+    # Expires users, then applies changes given as (op, username) pairs, recording actual changes.
+    # Ops: 'o' - online, 'f' - offline, 't' - typing, 's' - stopped typing.
+    UPDATE_SCRIPT = """
+        local function expire(key, kind)
+            for _, name in ipairs(redis.call('ZRANGEBYSCORE', key, '-inf', ARGV[1])) do
+                redis.call('HSET', KEYS[3], kind .. name, '0')
+            end
+            redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+        end
+        local function set(key, kind, expires, name)
+            if redis.call('ZADD', key, expires, name) == 1 then
+                redis.call('HSET', KEYS[3], kind .. name, '1')
+            end
+        end
+        local function remove(key, kind, name)
+            if redis.call('ZREM', key, name) == 1 then
+                redis.call('HSET', KEYS[3], kind .. name, '0')
+            end
+        end
+
+        expire(KEYS[1], 'o:')
+        expire(KEYS[2], 't:')
+        for i = 5, #ARGV, 2 do
+            local op, name = ARGV[i], ARGV[i + 1]
+            if op == 'o' then
+                set(KEYS[1], 'o:', ARGV[2], name)
+            elseif op == 't' then
+                set(KEYS[2], 't:', ARGV[3], name)
+            else
+                if op == 'f' then
+                    remove(KEYS[1], 'o:', name)
+                end
+                remove(KEYS[2], 't:', name)
+            end
+        end
+        for _, key in ipairs(KEYS) do
+            redis.call('EXPIRE', key, ARGV[4])
+        end
+    """
+
+    # Takes recorded changes, unless room was flushed less than ARGV[1] milliseconds ago.
+    FLUSH_SCRIPT = """
+        if redis.call('HLEN', KEYS[1]) == 0 then
+            return {}
+        end
+        if not redis.call('SET', KEYS[2], '1', 'NX', 'PX', ARGV[1]) then
+            return false
+        end
+        local pending = redis.call('HGETALL', KEYS[1])
+        redis.call('DEL', KEYS[1])
+        return pending
+    """
+
+    def __init__(self, ttl=45, typing_ttl=5, interval=0.5, location='redis://localhost:6379/0',
+                 prefix='chat:presence'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisPresenceStore requires redis package.')
+
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self.interval = interval
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(location)
+        self.update_script = self.client.register_script(self.UPDATE_SCRIPT)
+        self.flush_script = self.client.register_script(self.FLUSH_SCRIPT)
+
+    def keys(self, room_id):
+        """
+        :returns: List of keys holding online users, typing users, changes and flush throttle of the room.
+        """
+        return [f'{self.prefix}:{room_id}:online', f'{self.prefix}:{room_id}:typing',
+                f'{self.prefix}:{room_id}:pending', f'{self.prefix}:{room_id}:flushed']
+
+    def update(self, changes):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for room_id, room_changes in changes.items():
+            args = [now, now + self.ttl, now + self.typing_ttl, self.ttl]
+            for (kind, username), active in room_changes.items():
+                args += [kind if active else ('f' if kind == ONLINE else 's'), username]
+            self.update_script(keys=self.keys(room_id)[:3], args=args, client=pipe)
+        pipe.execute()
+
+    def flush(self, room_ids):
+        room_ids = list(room_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for room_id in room_ids:
+            self.flush_script(keys=self.keys(room_id)[2:], args=[int(self.interval * 1000)], client=pipe)
+
+        diffs = {}
+        for room_id, pending in zip(room_ids, pipe.execute()):
+            if pending is None:
+                diffs[room_id] = None
+                continue
+            fields = [field.decode('utf-8') for field in pending[::2]]
+            diffs[room_id] = presence_diff((field[0], field[2:], value == b'1')
+                                           for field, value in zip(fields, pending[1::2]))
+        return diffs
+
+    def snapshot(self, room_id):
+        online_key, typing_key = self.keys(room_id)[:2]
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrangebyscore(online_key, f'({now}', '+inf')
+        pipe.zrangebyscore(typing_key, f'({now}', '+inf')
+        online, typing = pipe.execute()
+        return {
+            'online': [name.decode('utf-8') for name in online],
+            'typing': [name.decode('utf-8') for name in typing],
+        }
+
+
+class PresenceTracker:
+    """
+    Presence of users connected to rooms through this process.
+
+    Connections only change in-memory state here, e.g. a 'typing' frame sent on every
+    keystroke costs a dict lookup. Every interval, changes are written to the store in
+    one batch and each changed room is sent a single 'presence_diff' frame, so rooms
+    with thousands of members get at most one presence frame per interval. Online users
+    are refreshed every heartbeat, users of a crashed process expire after store's TTL.
+    """
+
+    def __init__(self, store, publish, interval=0.5, heartbeat=15):
+        self.store = store
+        self.publish = publish                  # Coroutine function sending frame to room, called with room id.
+        self.interval = interval                # Seconds between writes to the store.
+        self.heartbeat = heartbeat              # Seconds between refreshes of online users.
+        self.connections = collections.defaultdict(collections.Counter)  # Room id -> username -> connections.
+        self.typing_until = collections.defaultdict(dict)   # Room id -> username -> time user stops typing.
+        self.changes = collections.defaultdict(collections.OrderedDict)  # Room id -> (kind, username) -> active.
+        self.dirty = set()                      # Rooms with changes not flushed yet.
+        self.refreshed = 0                      # Time online users were last refreshed.
+        self.loop = None                        # Event loop local state belongs to.
+        self.task = None
+
+    def start(self):
+        """
+        Starts writing changes, once per event loop.
+        Connections of a previous event loop are forgotten, as their consumers are gone.
+        """
+        loop = asyncio.get_event_loop()
+        if self.loop is loop and self.task is not None and not self.task.done():
+            return
+        if self.loop is not loop:
+            self.connections.clear()
+            self.typing_until.clear()
+            self.changes.clear()
+            self.dirty.clear()
+        self.loop = loop
+        self.task = loop.create_task(self.run())
+
+    def change(self, room_id, kind, username, active):
+        self.changes[room_id][(kind, username)] = active
+
+    def join(self, room_id, username):
+        self.start()
+        users = self.connections[room_id]
+        users[username] += 1
+        if users[username] == 1:
+            self.change(room_id, ONLINE, username, True)
+
+    def leave(self, room_id, username):
+        users = self.connections.get(room_id)
+        if not users or not users[username]:
+            return
+        users[username] -= 1
+        if users[username]:
+            return
+
+        del users[username]
+        if not users:
+            del self.connections[room_id]
+        self.typing_until.get(room_id, {}).pop(username, None)
+        self.changes.get(room_id, {}).pop((TYPING, username), None)
+        self.change(room_id, ONLINE, username, False)
+
+    def typing(self, room_id, username, active=True):
+        if username not in self.connections.get(room_id, ()):
+            return
+        if active:
+            self.typing_until[room_id][username] = time.monotonic() + self.store.typing_ttl
+            self.change(room_id, TYPING, username, True)
+        elif self.typing_until[room_id].pop(username, None) is not None:
+            self.change(room_id, TYPING, username, False)
+
+    async def snapshot(self, room_id):
+        """
+        :returns: Dict with lists of usernames 'online' and 'typing' in the room.
+        """
+        return await sync_to_async(self.store.snapshot, thread_sensitive=False)(room_id)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('Updating presence failed.')
+
+    async def tick(self):
+        now = time.monotonic()
+
+        # Users who stopped sending 'typing' frames.
+        for room_id, users in self.typing_until.items():
+            for username in [username for username, until in users.items() if until <= now]:
+                del users[username]
+                self.change(room_id, TYPING, username, False)
+
+        # Refresh online users, so that they do not expire. Refreshing also expires
+        # users of other processes, so rooms are flushed afterwards.
+        if now - self.refreshed >= self.heartbeat:
+            self.refreshed = now
+            for room_id, users in self.connections.items():
+                for username in users:
+                    self.changes[room_id].setdefault((ONLINE, username), True)
+
+        changes, self.changes = self.changes, collections.defaultdict(collections.OrderedDict)
+        self.dirty.update(changes)
+        if not self.dirty:
+            return
+
+        diffs = await sync_to_async(self.write, thread_sensitive=False)(changes, set(self.dirty))
+        for room_id, diff in diffs.items():
+            # Room was flushed too recently, retried on next tick.
+            if diff is None:
+                continue
+            self.dirty.discard(room_id)
+            if diff:
+                frames_published.inc()
+                await self.publish(room_id, control_frame('presence_diff', room_id, **diff))
+
+    def write(self, changes, room_ids):
+        """
+        :returns: Dict of room id -> presence diff of the room, or None if it was flushed too recently.
+        """
+        if changes:
+            self.store.update(changes)
+        return self.store.flush(room_ids)
+
+
+_presence_tracker = None
+
+
+def get_presence_tracker(publish):
+    """
+    :param publish: Coroutine function sending presence frame to room's connections, called with room id and frame.
+    :returns: Process-wide presence tracker with store configured with CHAT_PRESENCE setting, or None if disabled.
+    """
+    global _presence_tracker
+    config = settings.CHAT_PRESENCE
+    if not config.get('BACKEND'):
+        return None
+    if _presence_tracker is None:
+        options = {key.lower(): value for key, value in config.items() if key not in ('BACKEND', 'HEARTBEAT')}
+        store = import_string(config['BACKEND'])(**options)
+        _presence_tracker = PresenceTracker(store, publish, config['INTERVAL'], config['HEARTBEAT'])
+    return _presence_tracker
@@ -0,0 +1,40 @@
+from api.frames import cached_message_frame, message_frame
+from api.history_cache import get_history_cache
+from api.models import Message
+from api.pagination import newer_than
+
+
+def missed_messages(room_id, last_message_id, limit):
+    """
+    Finds messages of the room newer than the last one client got, in recent messages
+    cache if it still holds that message, otherwise with a range query on
+    (room, timestamp, id) index.
+
+    :returns: List of (frame, message id) tuples, oldest first. None if client missed
+              more than limit messages or given message is not in the room.
+    """
+    cache = get_history_cache()
+    cached = cache.get(room_id) if cache is not None else None
+    if cached is not None:
+        _, items = cached   # Newest first.
+        ids = [item['id'] for item in items]
+        if last_message_id in ids:
+            missed = items[:ids.index(last_message_id)]
+            if len(missed) > limit:
+                return None
+            return [(cached_message_frame(item), item['id']) for item in reversed(missed)]
+
+    timestamp = Message.objects.filter(pk=last_message_id, room_id=room_id).values_list('timestamp', flat=True).first()
+    if timestamp is None:
+        return None
+
+    messages = list(
+        Message.objects.filter(newer_than(timestamp, last_message_id), room_id=room_id)
+        .select_related('user')
+        .only('id', 'room', 'text', 'timestamp', 'user', 'user__username')
+        .order_by('timestamp', 'id')[:limit + 1]
+    )
+    if len(messages) > limit:
+        return None
+    return [(message_frame(message, message.user.username if message.user_id else None), message.id)
+            for message in messages]
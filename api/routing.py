@@ -3,5 +3,6 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    re_path(r'ws/$', consumers.MultiplexChatConsumer.as_asgi()),
     re_path(r'ws/(?P<room_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
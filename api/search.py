@@ -0,0 +1,66 @@
+"""
+Full-text search of messages.
+
+On PostgreSQL, messages are matched against Message.search_vector, kept current by
+a trigger and indexed with GIN (see migration 0011), and ranked with ts_rank.
+Other databases (SQLite test runs) fall back to matching each word with icontains,
+newest messages first.
+"""
+import re
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Cast
+
+# Text search configuration messages are indexed with. Language-neutral, as rooms are in any language.
+# Changing it requires rewriting the trigger and search_vector of all messages.
+SEARCH_CONFIG = 'simple'
+
+# Marks wrapped around matched words in headlines. Headlines are not HTML-escaped, like message text.
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_STOP = '</mark>'
+
+# Options of headlines, i.e. snippets of message text around matched words.
+HEADLINE_OPTIONS = {'max_words': 35, 'min_words': 15, 'max_fragments': 2}
+
+
+def is_full_text_supported():
+    """
+    :returns: True if database supports full-text search of messages.
+    """
+    return connection.vendor == 'postgresql'
+
+
+def search_messages(queryset, text):
+    """
+    Filters messages matching search text, given in web search syntax on PostgreSQL
+    (e.g. 'deploy -staging "release notes"'), best matches first.
+
+    :returns: Queryset annotated with 'rank' and, on PostgreSQL, 'headline', ordered by '-rank', '-id'.
+    """
+    if not is_full_text_supported():
+        for word in text.split():
+            queryset = queryset.filter(text__icontains=word)
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField())).order_by('-rank', '-id')
+
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    return queryset.filter(search_vector=query).annotate(
+        # Double precision, so that rank read into cursor compares equal to the one in database.
+        rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+        headline=SearchHeadline('text', query, config=SEARCH_CONFIG, start_sel=HIGHLIGHT_START,
+                                stop_sel=HIGHLIGHT_STOP, **HEADLINE_OPTIONS),
+    ).order_by('-rank', '-id')
+
+
+def set_headlines(messages, text):
+    """
+    Sets 'headline' of messages found without full-text search support:
+    whole text with matched words marked the same way as on PostgreSQL.
+    """
+    if is_full_text_supported():
+        return
+    pattern = re.compile('|'.join(re.escape(word) for word in text.split()), re.IGNORECASE)
+    for message in messages:
+        message.headline = pattern.sub(lambda match: f'{HIGHLIGHT_START}{match.group(0)}{HIGHLIGHT_STOP}',
+                                       message.text)
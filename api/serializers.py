@@ -1,7 +1,16 @@
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Case, OuterRef, Prefetch, Subquery, When
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
-from .models import Room, RoomInviteKey, CustomUser, Message
+from .history_cache import message_representation
+from .invites import create_invite_keys, get_unknown_invite_keys
+from .membership import ADMINS, USERS, get_membership
+from .models import Room, RoomInviteKey, CustomUser, Message, RoomReadCursor, count_subquery
+from .pagination import newer_than
+from .services import create_message, create_room
 
 
 # class CustomUserSerializer(serializers.ModelSerializer):
@@ -20,6 +29,49 @@ from .models import Room, RoomInviteKey, CustomUser, Message
 #         lookup_field = 'username'
 
 
+class MemberRoomField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key field accepting only rooms request user has given role in.
+    Staff can pick any room.
+
+    Membership is read from request's RoomMembership cache, so a room already
+    checked by permission classes is loaded by primary key only. Otherwise room
+    is loaded and membership checked with a single EXISTS query, and the result
+    is cached for the rest of the request.
+    """
+
+    def __init__(self, role, **kwargs):
+        self.role = role
+        super(MemberRoomField, self).__init__(**kwargs)
+
+    def get_queryset(self):
+        request = self.context['request']
+        if request.user.is_staff:
+            return Room.objects.all()
+        return get_membership(request).rooms(self.role)
+
+    def to_internal_value(self, data):
+        request = self.context['request']
+        if request.user.is_staff:
+            return super(MemberRoomField, self).to_internal_value(data)
+
+        membership = get_membership(request)
+        known = membership.cached(self.role, data)
+        if known is False:
+            self.fail('does_not_exist', pk_value=data)
+
+        queryset = Room.objects.all() if known else membership.rooms(self.role)
+        try:
+            room = queryset.get(pk=data)
+        except ObjectDoesNotExist:
+            membership.remember(self.role, data, False)
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        membership.remember(self.role, room.pk)
+        return room
+
+
 class MessageSerializer(serializers.ModelSerializer):
     """
     Serializer associated with Message model.
@@ -33,10 +85,8 @@ class MessageSerializer(serializers.ModelSerializer):
         read_only=True,
         slug_field='username'
     )
-    room = serializers.PrimaryKeyRelatedField(
-        queryset=Room.objects.none(),
-        required=False,
-        # view_name='room-detail'
+    room = MemberRoomField(
+        role=USERS,
     )
 
     class Meta:
@@ -56,30 +106,37 @@ class MessageSerializer(serializers.ModelSerializer):
             for field_name in existing - allowed:
                 self.fields.pop(field_name)
 
-    def get_fields(self):
+    @staticmethod
+    def setup_eager_loading(queryset, fields):
         """
-        Overrides queryset for 'room' field.
+        Loads only columns and relations needed to serialize given fields,
+        so that listing messages takes constant number of queries.
+        Id and timestamp are always loaded, as pagination needs them.
         """
-        fields = super(MessageSerializer, self).get_fields()
-
-        # If user is admin, return all Room objects.
-        if self.context['request'].user.is_staff:
-            fields['room'].queryset = Room.objects.all()
-        # Else, return Room objects request user participate in.
-        else:
-            fields['room'].queryset = Room.objects.filter(users__in=[self.context['request'].user])
-        return fields
+        columns = ['id', 'room', 'timestamp'] + [name for name in ('text',) if name in fields]
+        if 'user' in fields:
+            queryset = queryset.select_related('user')
+            columns += ['user', 'user__username']
+        return queryset.only(*columns)
 
     def create(self, validated_data):
         """
         Overrides creation of new object.
-        Sets fields such as room and user.
+        Saves message sent by request user, which is then sent to connections of its room.
         """
-        obj = Message.objects.create(**validated_data)  # Create new object with validated data.
-        request_user = self.context['request'].user  # Get request user object.
-        obj.user = request_user  # Add request user to creator.
-        obj.save()  # Save instance.
-        return obj
+        return create_message(validated_data['room'].pk, self.context['request'].user, validated_data['text'])
+
+
+class MessageSearchSerializer(MessageSerializer):
+    """
+    Serializer of messages found with full-text search (see api.search).
+    Headline is a snippet of message text with matched words marked.
+    """
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank', 'headline']
 
 
 class RoomSerializer(serializers.ModelSerializer):
@@ -116,6 +173,14 @@ class RoomSerializer(serializers.ModelSerializer):
         read_only=True
     )
 
+    message_count = serializers.IntegerField(
+        read_only=True
+    )
+
+    last_message_at = serializers.DateTimeField(
+        read_only=True
+    )
+
     def __init__(self, *args, **kwargs):
         # Instantiate the superclass normally
         super(RoomSerializer, self).__init__(*args, **kwargs)
@@ -131,7 +196,27 @@ class RoomSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Room
-        fields = ['id', 'url', 'name', 'active', 'creator', 'timestamp', 'admins', 'users']
+        fields = ['id', 'url', 'name', 'active', 'creator', 'timestamp', 'admins', 'users',
+                  'message_count', 'last_message_at']
+
+    # Room columns loaded always and only when their field is serialized.
+    required_columns = ['id']
+    eager_columns = ['name', 'active', 'timestamp', 'message_count', 'last_message_at']
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields):
+        """
+        Loads only columns and relations needed to serialize given fields,
+        so that listing rooms takes constant number of queries.
+        """
+        columns = cls.required_columns + [name for name in cls.eager_columns if name in fields]
+        if 'creator' in fields:
+            queryset = queryset.select_related('creator')
+            columns += ['creator', 'creator__username']
+        for name in ('admins', 'users'):
+            if name in fields:
+                queryset = queryset.prefetch_related(Prefetch(name, queryset=CustomUser.objects.only('id', 'username')))
+        return queryset.only(*columns)
 
     def create(self, validated_data):
         """
@@ -142,14 +227,56 @@ class RoomSerializer(serializers.ModelSerializer):
         # room_admins = validated_data.pop('admins')    # Pop due to *-* assignment.
         # room_users = validated_data.pop('users')      # Pop due to *-* assignment.
 
-        obj = Room.objects.create(**validated_data)   # Create new object with validated data.
+        return create_room(self.context['request'].user, **validated_data)
 
-        request_user = self.context['request'].user   # Get request user object.
-        obj.creator = request_user                    # Add request user to creator.
-        obj.admins.set([request_user])                   # Add request user to admins.
-        obj.users.set([request_user])                     # Add request user to users.
-        obj.save()                                    # Save instance.
-        return obj
+
+class RoomSummarySerializer(RoomSerializer):
+    """
+    Serializer associated with Room model, extended with room activity summary:
+    last message, message count and count of messages unread by request user.
+
+    Summary fields are read from annotations added by annotate_summary().
+    Last messages are read from 'last_messages' context entry (message id -> Message object).
+    """
+    last_message = serializers.SerializerMethodField()
+
+    unread_count = serializers.IntegerField(
+        read_only=True
+    )
+
+    class Meta(RoomSerializer.Meta):
+        fields = RoomSerializer.Meta.fields + ['last_message', 'unread_count']
+
+    # Last message id is needed to look up last message.
+    required_columns = RoomSerializer.required_columns + ['last_message_id']
+
+    @staticmethod
+    def annotate_summary(queryset, user):
+        """
+        Annotates rooms with count of messages unread by given user,
+        using subqueries instead of per-room queries.
+        Messages sent by the user are never unread.
+        """
+        unread = Message.objects.filter(room=OuterRef('pk')).exclude(user=user)
+        read_cursor = RoomReadCursor.objects.filter(room=OuterRef('pk'), user=user)
+
+        return queryset.annotate(
+            read_timestamp=Subquery(read_cursor.values('last_read_timestamp')[:1]),
+            read_message_id=Subquery(read_cursor.values('last_read_message_id')[:1]),
+        ).annotate(
+            unread_count=Case(
+                # User never read anything in the room.
+                When(read_message_id__isnull=True, then=count_subquery(unread)),
+                default=count_subquery(unread.filter(
+                    newer_than(OuterRef('read_timestamp'), OuterRef('read_message_id')))),
+            )
+        )
+
+    def get_last_message(self, obj):
+        message = self.context['last_messages'].get(obj.last_message_id)
+        if message is None:
+            return None
+        return message_representation(message)
 
 
 class RoomInviteKeySerializer(serializers.ModelSerializer):
@@ -167,10 +294,9 @@ class RoomInviteKeySerializer(serializers.ModelSerializer):
         slug_field='username',
         read_only=True
     )
-    room = serializers.PrimaryKeyRelatedField(
-        queryset=Room.objects.none(),
+    room = MemberRoomField(
+        role=ADMINS,
         required=False,
-        # view_name='room-detail'
     )
     valid_due = serializers.DateTimeField(
         required=False,
@@ -187,27 +313,73 @@ class RoomInviteKeySerializer(serializers.ModelSerializer):
         model = RoomInviteKey
         fields = ['id', 'key', 'creator', 'room', 'only_for_this_user', 'valid_due', 'give_admin']
 
-    def get_fields(self):
-        """
-        Overrides queryset for 'room' field.
-        """
-        fields = super(RoomInviteKeySerializer, self).get_fields()
-
-        # If user is admin, return all Room objects.
-        if self.context['request'].user.is_staff:
-            fields['room'].queryset = Room.objects.all()
-        # Else, return Room objects request user is admin in.
-        else:
-            fields['room'].queryset = Room.objects.filter(admins__in=[self.context['request'].user])
-        return fields
-
     def create(self, validated_data):
         """
         Overrides creation of new object.
         Sets creator field.
         """
         request_user = self.context['request'].user           # Get request user object.
-        obj = RoomInviteKey.objects.create(**validated_data)  # Create new object with validated data.
-        obj.creator = request_user                            # Add request user to creator field.
-        obj.save()                                            # Save instance.
+        obj = RoomInviteKey.objects.create(creator=request_user, **validated_data)
+        get_unknown_invite_keys().discard(obj.key)            # Forget the key if it was looked up before.
         return obj
+
+
+class UsernameListField(serializers.ListField):
+    """
+    List of usernames, loaded as users with a single query, in the given order without repeats.
+    """
+    default_error_messages = {
+        'too_many': 'Ensure this field has no more than {max_items} elements.',
+        'does_not_exist': 'Users do not exist: {usernames}.',
+    }
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('child', serializers.CharField())
+        kwargs.setdefault('allow_empty', False)
+        super(UsernameListField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        usernames = list(dict.fromkeys(super(UsernameListField, self).to_internal_value(data)))
+        max_items = settings.CHAT_BULK_MAX_ITEMS
+        if len(usernames) > max_items:
+            self.fail('too_many', max_items=max_items)
+
+        users = CustomUser.objects.in_bulk(usernames, field_name='username')
+        missing = [username for username in usernames if username not in users]
+        if missing:
+            self.fail('does_not_exist', usernames=', '.join(missing[:10]))
+        return [users[username] for username in usernames]
+
+
+class RoomInviteKeyBulkSerializer(serializers.Serializer):
+    """
+    Serializer of request creating many invite keys of a room at once, a key for each of 'only_for_users'.
+    """
+    room = MemberRoomField(role=ADMINS)
+    only_for_users = UsernameListField()
+    give_admin = serializers.BooleanField(default=False)
+
+    def create(self, validated_data):
+        return create_invite_keys(validated_data['room'], self.context['request'].user,
+                                  validated_data['only_for_users'], give_admin=validated_data['give_admin'])
+
+
+class RoomMembersSerializer(serializers.Serializer):
+    """
+    Serializer of request adding or removing many users of a room at once.
+    """
+    users = UsernameListField()
+    role = serializers.ChoiceField(choices=[USERS, ADMINS], default=USERS)
+
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Token pair serializer adding 'username' claim, so that WebSocket connections
+    authenticated with access token know username without querying database.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super(ChatTokenObtainPairSerializer, cls).get_token(user)
+        token['username'] = user.username
+        return token
@@ -0,0 +1,101 @@
+"""
+Creation of messages and rooms, shared by REST API and WebSocket consumers.
+
+Each row is written once, in a single transaction with its side effects. Saved messages
+are published to connections of their room once the transaction commits, so messages
+posted through REST API reach live WebSocket connections too.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from api import metrics
+from api.frames import message_frame
+from api.history_cache import get_history_cache
+from api.membership import ADMINS, USERS, RoomMembership, invalidate_room_members
+from api.models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+messages_saved = metrics.counter('chat_messages_saved_total', 'Messages saved, one by one or in batches.', ['path'])
+group_send_duration = metrics.histogram('chat_group_send_seconds', 'Time sending message to room group takes.')
+
+
+def room_group_name(room_id):
+    """
+    :returns: Name of channel layer group of room's connections.
+    """
+    return f'room_{room_id}'
+
+
+def message_event(message, username):
+    """
+    :returns: Channel layer event delivering saved message to connections of its room,
+              already serialized to its final wire frame.
+    """
+    return {
+        'type': 'room_message',
+        'frame': message_frame(message, username),
+        'room_id': message.room_id,
+        'message_id': message.id,
+    }
+
+
+def publish_message(message, username):
+    """
+    Sends saved message to connections of its room.
+    """
+    with group_send_duration.timer():
+        async_to_sync(get_channel_layer().group_send)(room_group_name(message.room_id),
+                                                      message_event(message, username))
+
+
+def publish_saved_message(message, username):
+    """
+    Sends message to connections of its room once it's saved. Message is saved already, so
+    if channel layer fails, the failure is logged instead of failing the request that saved it,
+    which would make the client save it again.
+    """
+    try:
+        publish_message(message, username)
+    except Exception:
+        logger.exception('Publishing message %d to room %d failed.', message.id, message.room_id)
+
+
+def create_message(room_id, user, text, publish=True):
+    """
+    Saves message with a single INSERT and updates room activity counters in the same transaction.
+    Message is added to room's recent messages and, if publish is True, sent to connections
+    of the room once the transaction commits.
+
+    :param user: CustomUser object of the sender.
+    :returns: Saved Message object.
+    """
+    with transaction.atomic():
+        message = Message.objects.create(room_id=room_id, user=user, text=text)
+        Room.record_messages(room_id, 1, message)  # Update room activity counters.
+        if publish:
+            transaction.on_commit(lambda: publish_saved_message(message, user.username))
+    messages_saved.inc(path='single')
+
+    cache = get_history_cache()
+    if cache is not None:
+        cache.append(message)  # Add to room's recent messages.
+    return message
+
+
+def create_room(creator, **fields):
+    """
+    Saves room created by given user, who becomes its admin and user, with one INSERT per table.
+
+    :returns: Saved Room object.
+    """
+    with transaction.atomic():
+        room = Room.objects.create(creator=creator, **fields)
+        for role in (ADMINS, USERS):
+            through, room_field, user_field = RoomMembership.through(role)
+            through.objects.create(**{f'{room_field}_id': room.pk, f'{user_field}_id': creator.pk})
+        transaction.on_commit(lambda: invalidate_room_members(room.pk))  # Drop ids cached before room existed.
+    return room
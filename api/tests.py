@@ -0,0 +1,425 @@
+import json
+import shutil
+import tempfile
+import threading
+from io import StringIO
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.asgi import application
+from api.invites import create_invite_keys
+from api.membership import invalidate_room_members
+from api.models import CustomUser, Message, Room, RoomInviteKey
+from api.serializers import ChatTokenObtainPairSerializer
+from api.transfer import insert_messages
+
+# Recent messages cache and presence are process-wide, tests read history from database and get no presence frames.
+NO_CACHES = dict(
+    CHAT_HISTORY_CACHE=dict(settings.CHAT_HISTORY_CACHE, BACKEND=None),
+    CHAT_PRESENCE=dict(settings.CHAT_PRESENCE, BACKEND=None),
+)
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def create_room(creator, *members, name='test room'):
+    """
+    :returns: Room created by given user, with creator and given users as its members.
+    """
+    room = Room.objects.create(name=name, creator=creator)
+    room.admins.add(creator)
+    room.users.add(creator, *members)
+    # Rooms of earlier tests may have had the same id.
+    invalidate_room_members(room.pk)
+    return room
+
+
+def create_messages(room, user, count, started=None):
+    """
+    Saves messages a second apart, oldest first. Every third message shares timestamp
+    with the one before it, so that ordering by id breaks ties.
+
+    :returns: List of created messages, oldest first.
+    """
+    started = started or timezone.now() - timezone.timedelta(days=1)
+    messages = [
+        Message(room=room, user=user, text=f'Message {i}.',
+                timestamp=started + timezone.timedelta(seconds=i - (i % 3 == 2)))
+        for i in range(count)
+    ]
+    insert_messages(messages)
+    Room.rebuild_activity(Room.objects.filter(pk=room.pk))
+    return list(Message.objects.filter(room=room).order_by('timestamp', 'id'))
+
+
+@override_settings(**NO_CACHES)
+class MessageHistoryTests(TestCase):
+    """
+    Keyset and limit/offset pagination of room history.
+    """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='alice')
+        self.room = create_room(self.user)
+        self.messages = create_messages(self.room, self.user, 10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, url='/api/messages/', **params):
+        response = self.client.get(url, dict(params, room_id=self.room.pk) if params else None)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_keyset_pages_cover_history_newest_first(self):
+        newest_first = [message.id for message in reversed(self.messages)]
+
+        page = self.get_page(cursor='', limit=3)
+        self.assertIsNone(page['previous'])
+        ids = [item['id'] for item in page['results']]
+        while page['next']:
+            page = self.get_page(page['next'])
+            self.assertLessEqual(len(page['results']), 3)
+            ids += [item['id'] for item in page['results']]
+
+        self.assertEqual(ids, newest_first)
+
+    def test_previous_link_returns_newer_page(self):
+        first = self.get_page(cursor='', limit=4)
+        second = self.get_page(first['next'])
+        back = self.get_page(second['previous'])
+
+        self.assertEqual([item['id'] for item in back['results']], [item['id'] for item in first['results']])
+
+    def test_before_and_after_message(self):
+        middle = self.messages[5]
+
+        older = self.get_page(before=middle.id, limit=2)
+        self.assertEqual([item['id'] for item in older['results']], [self.messages[4].id, self.messages[3].id])
+
+        newer = self.get_page(after=middle.id, limit=2)
+        self.assertEqual([item['id'] for item in newer['results']], [self.messages[7].id, self.messages[6].id])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/messages/', {'room_id': self.room.pk, 'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_offset_pages_count_created_messages(self):
+        response = self.client.post('/api/messages/', {'room': self.room.pk, 'text': 'Hi!'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        page = self.get_page(limit=5, offset=0)
+        self.assertEqual(page['count'], 11)
+        self.assertEqual(page['results'][0]['text'], 'Hi!')
+        self.assertEqual(Room.objects.get(pk=self.room.pk).message_count, 11)
+
+
+class JoinRoomTests(TestCase):
+    """
+    Joining rooms with single use invite keys.
+    """
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create(username='alice')
+        self.user = CustomUser.objects.create(username='bob')
+        self.room = create_room(self.admin)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def join(self, invite_key):
+        return self.client.post(f'/api/rooms-join/{invite_key.key}/')
+
+    def test_join_with_key_for_user(self):
+        invite_key, = create_invite_keys(self.room, self.admin, [self.user])
+
+        response = self.join(invite_key)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['room_id'], self.room.pk)
+        self.assertTrue(self.room.users.filter(pk=self.user.pk).exists())
+        self.assertFalse(self.room.admins.filter(pk=self.user.pk).exists())
+        self.assertFalse(RoomInviteKey.objects.filter(key=invite_key.key).exists())
+
+    def test_key_is_single_use(self):
+        invite_key, = create_invite_keys(self.room, self.admin, [self.user])
+
+        self.assertEqual(self.join(invite_key).status_code, 200)
+        self.assertEqual(self.join(invite_key).status_code, 400)
+
+    def test_key_for_another_user_is_rejected(self):
+        other = CustomUser.objects.create(username='carol')
+        invite_key, = create_invite_keys(self.room, self.admin, [other])
+
+        self.assertEqual(self.join(invite_key).status_code, 403)
+        self.assertFalse(self.room.users.filter(pk=self.user.pk).exists())
+        self.assertTrue(RoomInviteKey.objects.filter(key=invite_key.key).exists())
+
+    def test_key_giving_admin(self):
+        invite_key, = create_invite_keys(self.room, self.admin, [self.user], give_admin=True)
+
+        self.assertEqual(self.join(invite_key).status_code, 200)
+        self.assertTrue(self.room.admins.filter(pk=self.user.pk).exists())
+
+    def test_expired_key_is_rejected(self):
+        invite_key, = create_invite_keys(self.room, self.admin, [self.user])
+        RoomInviteKey.objects.filter(key=invite_key.key).update(
+            valid_due=timezone.now() - timezone.timedelta(days=1))
+
+        self.assertEqual(self.join(invite_key).status_code, 400)
+        self.assertFalse(self.room.users.filter(pk=self.user.pk).exists())
+
+
+@skipUnless(connection.features.has_select_for_update, 'Concurrent joins need row locks.')
+class ConcurrentJoinTests(TransactionTestCase):
+    """
+    Invite key redeemed by concurrent requests, locked with SELECT ... FOR UPDATE.
+    """
+
+    def test_key_is_redeemed_once(self):
+        admin = CustomUser.objects.create(username='alice')
+        user = CustomUser.objects.create(username='bob')
+        room = create_room(admin)
+        invite_key, = create_invite_keys(room, admin, [user])
+
+        barrier = threading.Barrier(4)
+        statuses = []
+
+        def join():
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                statuses.append(client.post(f'/api/rooms-join/{invite_key.key}/').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=join) for _ in range(barrier.parties)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [200, 400, 400, 400])
+
+
+@override_settings(**NO_CACHES)
+class RoomDeletionTests(TestCase):
+    """
+    Soft deletion of rooms and purging them with purge_deleted_rooms command.
+    """
+
+    def setUp(self):
+        self.staff = CustomUser.objects.create(username='admin', is_staff=True)
+        self.user = CustomUser.objects.create(username='alice')
+        self.room = create_room(self.user, self.staff)
+        create_messages(self.room, self.user, 5)
+        create_invite_keys(self.room, self.user, [self.staff])
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def test_deleted_room_is_hidden(self):
+        self.assertEqual(self.client.delete(f'/api/rooms/{self.room.pk}/').status_code, 204)
+
+        room = Room.all_objects.get(pk=self.room.pk)
+        self.assertIsNotNone(room.deleted_at)
+        self.assertFalse(room.active)
+        self.assertFalse(Room.objects.filter(pk=self.room.pk).exists())
+        self.assertFalse(RoomInviteKey.objects.filter(room_id=self.room.pk).exists())
+
+        response = self.client.get('/api/messages/', {'room_id': self.room.pk, 'cursor': ''})
+        self.assertEqual(response.data['results'], [])
+        self.assertEqual(Message.objects.filter(room_id=self.room.pk).count(), 5)
+
+    def test_purge_deletes_room_and_messages(self):
+        other = create_room(self.user, name='other room')
+        create_messages(other, self.user, 3)
+        self.client.delete(f'/api/rooms/{self.room.pk}/')
+
+        call_command('purge_deleted_rooms', chunk_size=2, pause=0, stdout=StringIO())
+
+        self.assertFalse(Room.all_objects.filter(pk=self.room.pk).exists())
+        self.assertFalse(Message.objects.filter(room_id=self.room.pk).exists())
+        self.assertEqual(Message.objects.filter(room=other).count(), 3)
+
+
+@override_settings(**NO_CACHES)
+class ArchiveMessagesTests(TestCase):
+    """
+    Moving old messages to archive files with archive_messages command.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.user = CustomUser.objects.create(username='alice')
+        self.room = create_room(self.user)
+        self.old = create_messages(self.room, self.user, 4, started=timezone.now() - timezone.timedelta(days=400))
+        self.recent = create_messages(self.room, self.user, 3)[len(self.old):]
+
+    def test_archived_messages_are_not_counted(self):
+        with self.settings(CHAT_ARCHIVE=dict(settings.CHAT_ARCHIVE, DIRECTORY=self.directory)):
+            call_command('archive_messages', days=365, batch_size=3, stdout=StringIO())
+
+        room = Room.objects.get(pk=self.room.pk)
+        self.assertEqual(room.message_count, 3)
+        self.assertEqual(room.last_message_id, self.recent[-1].id)
+        self.assertEqual(list(Message.objects.filter(room=room).order_by('timestamp', 'id')), self.recent)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, **NO_CACHES)
+class ConsumerTests(TransactionTestCase):
+    """
+    Room (ws/<room_id>/) and multiplexed (ws/) WebSocket connections.
+    """
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice')
+        self.bob = CustomUser.objects.create(username='bob')
+        self.room = create_room(self.alice, self.bob)
+
+    @staticmethod
+    def connect(user, path):
+        token = ChatTokenObtainPairSerializer.get_token(user).access_token
+        separator = '&' if '?' in path else '?'
+        return WebsocketCommunicator(application, f'{path}{separator}token={token}')
+
+    def test_room_message_reaches_members(self):
+        async def run():
+            alice = self.connect(self.alice, f'/ws/{self.room.pk}/')
+            bob = self.connect(self.bob, f'/ws/{self.room.pk}/')
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+
+            await alice.send_json_to({'message': 'Hi!'})
+            for communicator in (alice, bob):
+                frame = await communicator.receive_json_from()
+                self.assertEqual(frame['type'], 'message')
+                self.assertEqual(frame['message'], 'Hi!')
+                self.assertEqual(frame['username'], 'alice')
+                self.assertEqual(frame['room_id'], self.room.pk)
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(Room.objects.get(pk=self.room.pk).message_count, 1)
+        self.assertEqual(Message.objects.get(room=self.room).text, 'Hi!')
+
+    def test_non_member_is_rejected(self):
+        carol = CustomUser.objects.create(username='carol')
+
+        async def run():
+            communicator = self.connect(carol, f'/ws/{self.room.pk}/')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(run)()
+
+    def test_resume_sends_missed_messages(self):
+        messages = create_messages(self.room, self.alice, 4)
+
+        async def run():
+            communicator = self.connect(self.bob, f'/ws/{self.room.pk}/?last_message_id={messages[1].id}')
+            self.assertTrue((await communicator.connect())[0])
+            frames = [await communicator.receive_json_from() for _ in messages[2:]]
+            self.assertEqual([frame['id'] for frame in frames], [message.id for message in messages[2:]])
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'type': 'resumed', 'room_id': self.room.pk, 'count': 2})
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_malformed_frame_keeps_connection_open(self):
+        async def run():
+            communicator = self.connect(self.alice, f'/ws/{self.room.pk}/')
+            self.assertTrue((await communicator.connect())[0])
+
+            await communicator.send_to(text_data='not json')
+            self.assertEqual((await communicator.receive_json_from())['error'], 'bad_frame')
+            await communicator.send_json_to({'type': 'read', 'message_id': 'x'})
+            self.assertEqual((await communicator.receive_json_from())['error'], 'bad_frame')
+
+            await communicator.send_json_to({'message': 'Still here.'})
+            self.assertEqual((await communicator.receive_json_from())['message'], 'Still here.')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_multiplexed_subscribe_message_and_unsubscribe(self):
+        other = create_room(self.bob, name='not alice room')
+
+        async def run():
+            alice = self.connect(self.alice, '/ws/')
+            bob = self.connect(self.bob, f'/ws/{self.room.pk}/')
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+
+            await alice.send_json_to({'type': 'message', 'room_id': self.room.pk, 'message': 'Too early.'})
+            self.assertEqual(await alice.receive_json_from(),
+                             {'type': 'error', 'room_id': self.room.pk, 'error': 'not_subscribed'})
+
+            await alice.send_json_to({'type': 'subscribe', 'room_id': other.pk})
+            self.assertEqual(await alice.receive_json_from(),
+                             {'type': 'error', 'room_id': other.pk, 'error': 'not_allowed'})
+
+            await alice.send_json_to({'type': 'subscribe', 'room_id': self.room.pk})
+            self.assertEqual(await alice.receive_json_from(), {'type': 'subscribed', 'room_id': self.room.pk})
+
+            await bob.send_json_to({'message': 'Hi Alice!'})
+            frame = await alice.receive_json_from()
+            self.assertEqual((frame['room_id'], frame['message']), (self.room.pk, 'Hi Alice!'))
+            await bob.receive_json_from()
+
+            await alice.send_json_to({'type': 'message', 'room_id': self.room.pk, 'message': 'Hi Bob!'})
+            self.assertEqual((await bob.receive_json_from())['message'], 'Hi Bob!')
+            self.assertEqual((await alice.receive_json_from())['message'], 'Hi Bob!')
+
+            await alice.send_json_to({'type': 'unsubscribe', 'room_id': self.room.pk})
+            self.assertEqual(await alice.receive_json_from(), {'type': 'unsubscribed', 'room_id': self.room.pk})
+            await bob.send_json_to({'message': 'Gone?'})
+            await bob.receive_json_from()
+            self.assertTrue(await alice.receive_nothing())
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+    def test_multiplexed_subscribe_resumes_room(self):
+        messages = create_messages(self.room, self.bob, 3)
+
+        async def run():
+            communicator = self.connect(self.alice, '/ws/')
+            self.assertTrue((await communicator.connect())[0])
+
+            await communicator.send_json_to({'type': 'subscribe', 'room_id': self.room.pk,
+                                             'last_message_id': messages[0].id})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+            frames = [await communicator.receive_json_from() for _ in messages[1:]]
+            self.assertEqual([(frame['room_id'], frame['id']) for frame in frames],
+                             [(self.room.pk, message.id) for message in messages[1:]])
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_multiplexed_malformed_frames(self):
+        async def run():
+            communicator = self.connect(self.alice, '/ws/')
+            self.assertTrue((await communicator.connect())[0])
+            await communicator.send_json_to({'type': 'subscribe', 'room_id': self.room.pk})
+            await communicator.receive_json_from()
+
+            for text_data in ('[]', json.dumps({'type': 'message', 'room_id': self.room.pk}),
+                              json.dumps({'type': 'read', 'room_id': self.room.pk, 'message_id': None})):
+                await communicator.send_to(text_data=text_data)
+                self.assertEqual((await communicator.receive_json_from())['error'], 'bad_frame')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
@@ -0,0 +1,186 @@
+"""
+Bulk export and import of room messages as JSON Lines (see export_messages and import_messages
+commands, and RoomViewSet.export).
+
+Each line is a message serialized the same way MessageSerializer does (see
+history_cache.message_representation), so archive files can be imported as well.
+Messages are read with a server-side cursor and written in batches, so memory use
+doesn't depend on the number of messages.
+"""
+import itertools
+import json
+import queue
+import threading
+from collections import OrderedDict
+
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from api.frames import encode_json, timestamp_field
+from api.models import CustomUser, Message, Room
+
+# Marks the end of chunks passed by stream_in_thread().
+END = object()
+
+
+def export_lines(queryset, chunk_size):
+    """
+    Reads messages of given queryset, oldest first, with a server-side cursor.
+
+    :returns: Iterator of JSON lines, one per message.
+    """
+    rows = queryset.order_by('timestamp', 'id').values_list('id', 'room_id', 'user__username', 'text', 'timestamp')
+    for message_id, room_id, username, text, timestamp in rows.iterator(chunk_size=chunk_size):
+        yield encode_json(OrderedDict([
+            ('id', message_id),
+            ('room', room_id),
+            ('user', username),
+            ('text', text),
+            ('timestamp', timestamp_field.to_representation(timestamp)),
+        ])) + '\n'
+
+
+def export_chunks(queryset, chunk_size):
+    """
+    :returns: Iterator of UTF-8 encoded chunks of up to chunk_size JSON lines.
+    """
+    lines = export_lines(queryset, chunk_size)
+    while True:
+        chunk = ''.join(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk.encode('utf-8')
+
+
+def stream_in_thread(chunks, buffer_size=2):
+    """
+    Iterates given chunks in a separate thread, reading up to buffer_size chunks ahead.
+
+    Django 3.2 sends streaming responses served over ASGI from the event loop, where database
+    can't be queried, so chunks read from database are produced in the thread instead, on its
+    own connection. Thread stops once the response is closed.
+
+    :returns: Iterator of chunks.
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(END)
+        except Exception as error:
+            put(error)
+        finally:
+            connection.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            chunk = buffer.get()
+            if chunk is END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stopped.set()
+
+
+def insert_messages(messages):
+    """
+    Inserts messages in as few INSERTs as database allows, keeping their timestamps.
+    Unlike bulk_create(), values are inserted raw, as loaddata does, so timestamps aren't
+    replaced with current time (Message.timestamp has auto_now_add).
+    """
+    fields = [field for field in Message._meta.concrete_fields if not field.primary_key]
+    batch_size = max(connection.ops.bulk_batch_size(fields, messages), 1)
+    for start in range(0, len(messages), batch_size):
+        Message.objects._insert(messages[start:start + batch_size], fields=fields, raw=True)
+
+
+class MessageImporter:
+    """
+    Saves messages read from JSON lines in batches, each with a single INSERT.
+
+    Messages get new ids. Rooms are remapped to room_id if given, otherwise messages
+    are saved in rooms with ids they had. Users are matched by username; messages of
+    users that don't exist are saved without user, as messages of deleted users are.
+    """
+
+    def __init__(self, batch_size, room_id=None):
+        self.batch_size = batch_size
+        self.room_id = room_id              # Room all messages are saved in, None to keep their rooms.
+        self.room_exists = {}               # Room id -> True if room exists and is not deleted.
+        self.user_ids = {}                  # Username -> user id, None if there is no such user.
+        self.rooms = set()                  # Ids of rooms messages were saved in.
+        self.saved = 0
+        self.skipped = 0                    # Messages of rooms that don't exist.
+        self.without_user = 0
+
+    def load_rooms(self, items):
+        room_ids = {self.room_id if self.room_id is not None else item['room'] for item in items}
+        room_ids -= self.room_exists.keys()
+        if not room_ids:
+            return
+        self.room_exists.update(dict.fromkeys(room_ids, False))
+        existing = Room.objects.filter(id__in=room_ids).values_list('id', flat=True)
+        self.room_exists.update(dict.fromkeys(existing, True))
+
+    def load_users(self, items):
+        usernames = {item['user'] for item in items if item['user'] is not None} - self.user_ids.keys()
+        if not usernames:
+            return
+        self.user_ids.update(dict.fromkeys(usernames))
+        self.user_ids.update(CustomUser.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+    def build(self, item):
+        """
+        :returns: Unsaved Message object of serialized message, None if its room doesn't exist.
+        """
+        room_id = self.room_id if self.room_id is not None else item['room']
+        if not self.room_exists[room_id]:
+            self.skipped += 1
+            return None
+
+        user_id = self.user_ids.get(item['user'])
+        if user_id is None:
+            self.without_user += 1
+        self.rooms.add(room_id)
+        return Message(room_id=room_id, user_id=user_id, text=item['text'], timestamp=parse_datetime(item['timestamp']))
+
+    def save(self, items):
+        """
+        Saves a batch of serialized messages in its own transaction.
+        """
+        self.load_rooms(items)
+        self.load_users(items)
+        messages = [message for message in map(self.build, items) if message is not None]
+        with transaction.atomic():
+            insert_messages(messages)
+        self.saved += len(messages)
+
+    def run(self, lines):
+        """
+        Saves messages of given JSON lines.
+
+        :returns: Iterator of number of messages saved so far, after each batch.
+        """
+        items = (json.loads(line) for line in lines if line.strip())
+        while True:
+            batch = list(itertools.islice(items, self.batch_size))
+            if not batch:
+                return
+            self.save(batch)
+            yield self.saved
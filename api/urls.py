@@ -6,6 +6,7 @@ from rest_auth.views import (
     PasswordResetView, PasswordResetConfirmView
 )
 from . import views
+from .serializers import ChatTokenObtainPairSerializer
 
 router = routers.DefaultRouter()
 # router.register(r'users', views.CustomUserViewSet)
@@ -17,7 +18,8 @@ urlpatterns = [
     path('', include('rest_framework.urls')),
     path('', include(router.urls)),
 
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/', TokenObtainPairView.as_view(serializer_class=ChatTokenObtainPairSerializer),
+         name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 
     path('accounts/registration/', include('rest_auth.registration.urls')),
@@ -1,14 +1,29 @@
-from django.db.models import Q
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from rest_framework import viewsets, permissions, status, generics
-from rest_framework.generics import get_object_or_404
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from .models import Room, RoomInviteKey, CustomUser, Message
+from . import metrics
+from .archive import get_room_archive
+from .consumers import close_room_connections
+from .history_cache import get_history_cache, message_representation
+from .invites import get_unknown_invite_keys
+from .membership import USERS, add_room_members, get_membership, invalidate_room_members, remove_room_members
+from .models import Room, RoomInviteKey, Message
+from .pagination import MessageHistoryPagination, MessageSearchPagination
 from .permissions import IsRoomAdminOrStaff, ActionBasedPermission, IsInviteKeyCreatorOrRoomAdminOrStaff, RejectAll
-from .serializers import RoomSerializer, RoomInviteKeySerializer, MessageSerializer
+from .search import search_messages, set_headlines
+from .serializers import RoomSerializer, RoomInviteKeySerializer, MessageSerializer, RoomSummarySerializer, \
+    MessageSearchSerializer, RoomInviteKeyBulkSerializer, RoomMembersSerializer
+from .transfer import export_chunks, stream_in_thread
 
 from django.utils import timezone
-import pytz
 
 
 # class CustomUserViewSet(viewsets.ModelViewSet):
@@ -48,15 +63,22 @@ class RoomViewSet(viewsets.ModelViewSet):
     serializer_class = RoomSerializer
     permission_classes = [ActionBasedPermission]
     action_permissions = {
-        permissions.IsAdminUser: ['destroy'],
+        permissions.IsAdminUser: ['destroy', 'export'],
         permissions.IsAuthenticated: ['create', 'list'],
-        IsRoomAdminOrStaff: ['update', 'partial_update', 'retrieve']
+        IsRoomAdminOrStaff: ['update', 'partial_update', 'retrieve', 'members']
+    }
+    # Values of 'ordering' list parameter. Rooms without messages go last.
+    list_orderings = {
+        'last_message_at': F('last_message_at').asc(nulls_last=True),
+        '-last_message_at': F('last_message_at').desc(nulls_last=True),
     }
 
     def list(self, request, *args, **kwargs):
         """
         Overrides list view to display rooms this user
         participate in (user is in Room's 'users' field).
+        With 'summary=true' parameter, each room also has its last message,
+        message count and count of messages unread by this user.
         """
         queryset = Room.objects.filter(users__in=[self.request.user])
 
@@ -67,10 +89,86 @@ class RoomViewSet(viewsets.ModelViewSet):
             if only_active.lower() == 'true':
                 queryset = queryset.filter(active=True)
 
+        # Check for optional parameter 'summary'.
+        # If its value equals 'true', add last message, message count and unread count of each room.
+        summary = self.request.query_params.get('summary', '').lower() == 'true'
+        serializer_class = RoomSummarySerializer if summary else RoomSerializer
+
+        # Check for optional parameter 'ordering', e.g. 'ordering=-last_message_at' for recently active first.
+        ordering = self.request.query_params.get('ordering')
+        if ordering in self.list_orderings:
+            queryset = queryset.order_by(self.list_orderings[ordering], 'id')
+
         serializer_context = {'request': request}
-        serializer = RoomSerializer(queryset, many=True, context=serializer_context)
+        fields = serializer_class(context=serializer_context).fields
+        queryset = serializer_class.setup_eager_loading(queryset, fields)
+
+        if summary:
+            queryset = list(RoomSummarySerializer.annotate_summary(queryset, request.user))
+            last_message_ids = [room.last_message_id for room in queryset if room.last_message_id is not None]
+            serializer_context['last_messages'] = Message.objects.select_related('user').in_bulk(
+                last_message_ids if 'last_message' in fields else []
+            )
+
+        serializer = serializer_class(queryset, many=True, context=serializer_context)
         return Response(serializer.data)
 
+    def perform_update(self, serializer):
+        """
+        Overrides update to drop cached room users, as room may have been deactivated.
+        """
+        super(RoomViewSet, self).perform_update(serializer)
+        invalidate_room_members(serializer.instance.pk)
+
+    def perform_destroy(self, instance):
+        """
+        Overrides deletion to only mark the room deleted, which hides and deactivates it at once,
+        to drop its recent messages from cache and to disconnect its WebSocket connections.
+        Room's messages and the room itself are deleted in the background by purge_deleted_rooms command.
+        """
+        with transaction.atomic():
+            instance.soft_delete()
+        invalidate_room_members(instance.pk)
+        cache = get_history_cache()
+        if cache is not None:
+            cache.invalidate(instance.pk)
+        close_room_connections(instance.pk)
+
+    @action(detail=True, methods=['post', 'delete'])
+    def members(self, request, *args, **kwargs):
+        """
+        Adds (POST) or removes (DELETE) many room users or admins at once, e.g.
+        {"users": ["alice", "bob"], "role": "users"}, with a single statement.
+        """
+        room = self.get_object()
+        serializer = RoomMembersSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        role = serializer.validated_data['role']
+        user_ids = [user.pk for user in serializer.validated_data['users']]
+
+        response_data = {'room_id': room.pk, 'role': role}
+        with transaction.atomic():
+            if request.method == 'POST':
+                response_data['added'] = add_room_members(room.pk, role, user_ids)
+            else:
+                response_data['removed'] = remove_room_members(room.pk, role, user_ids)
+        invalidate_room_members(room.pk)
+        return Response(response_data)
+
+    @action(detail=True)
+    def export(self, request, *args, **kwargs):
+        """
+        Streams all messages of the room as JSON lines, oldest first (staff only).
+        Messages are read with a server-side cursor while the response is sent, chunk by chunk.
+        Archived messages are not included, they are already stored as JSON lines (see api.archive).
+        """
+        room = self.get_object()
+        chunks = export_chunks(Message.objects.filter(room_id=room.pk),
+                               settings.CHAT_MESSAGE_TRANSFER['EXPORT_CHUNK_SIZE'])
+        response = StreamingHttpResponse(stream_in_thread(chunks), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="room_{room.pk}_messages.jsonl"'
+        return response
+
 
 class RoomInviteKeyViewSet(viewsets.ModelViewSet):
     """
@@ -82,7 +180,7 @@ class RoomInviteKeyViewSet(viewsets.ModelViewSet):
     action_permissions = {
         permissions.IsAdminUser: ['destroy'],
         permissions.IsAuthenticated: ['list'],
-        IsInviteKeyCreatorOrRoomAdminOrStaff: ['create', 'retrieve'],
+        IsInviteKeyCreatorOrRoomAdminOrStaff: ['create', 'bulk', 'retrieve'],
         RejectAll: ['update', 'partial_update']
     }
 
@@ -104,18 +202,33 @@ class RoomInviteKeyViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Creates many invite keys of a room with a single INSERT, one for each of given users,
+        e.g. {"room": 1, "only_for_users": ["alice", "bob"]}.
+        """
+        serializer = RoomInviteKeyBulkSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        invite_keys = serializer.save()
+        data = RoomInviteKeySerializer(invite_keys, many=True, context=self.get_serializer_context()).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
 
 class MessageViewSet(viewsets.ModelViewSet):
     """
     View for displaying and creating room messages.
     By default, it returns empty queryset. To retrieve messages, parameter 'room_id' must be passed.
+    History can be paged with 'limit'/'offset' or with 'cursor'/'before'/'after' parameters
+    (see MessageHistoryPagination). Messages can be searched with 'search' action.
     """
     queryset = Message.objects.none()
     serializer_class = MessageSerializer
+    pagination_class = MessageHistoryPagination
     permission_classes = [ActionBasedPermission]
     action_permissions = {
         permissions.IsAdminUser: ['destroy'],
-        permissions.IsAuthenticated: ['list', 'create', 'retrieve'],
+        permissions.IsAuthenticated: ['list', 'create', 'retrieve', 'search'],
         RejectAll: ['update', 'partial_update']
     }
 
@@ -126,19 +239,103 @@ class MessageViewSet(viewsets.ModelViewSet):
         room_id = self.request.query_params.get('room_id')
 
         if room_id:
-            queryset = Message.objects.filter(room_id=room_id)
+            # Messages of deleted rooms wait for purge_deleted_rooms command, they are not shown meanwhile.
+            queryset = Message.objects.filter(room_id=room_id, room__deleted_at__isnull=True)
         else:
             return Response("Parameter 'room_id' missing.", status.HTTP_400_BAD_REQUEST)
 
+        # Serve the newest page from recent messages cache, if enabled.
+        if room_id.isdigit() and self.paginator.is_newest_page_request(request):
+            page = self.paginate_recent(int(room_id), queryset)
+            if page is not None:
+                return self.get_paginated_response(self.project_fields(page))
+
+        # Keyset pages past the oldest message in database are read from archive, unless the room is deleted.
+        if room_id.isdigit():
+            archive = get_room_archive(int(room_id))
+            if archive is not None and Room.objects.filter(pk=room_id).exists():
+                self.paginator.room_archive = archive
+
+        queryset = MessageSerializer.setup_eager_loading(queryset, self.get_serializer().fields)
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            # Archived messages are already serialized, they go after messages from database.
+            serializer = self.get_serializer([item for item in page if not isinstance(item, dict)], many=True)
+            archived = self.project_fields([item for item in page if isinstance(item, dict)])
+            return self.get_paginated_response(serializer.data + archived)
 
         serializer_context = {'request': request}
         serializer = MessageSerializer(queryset, many=True, context=serializer_context)
         return Response(serializer.data)
 
+    @action(detail=False, pagination_class=MessageSearchPagination, serializer_class=MessageSearchSerializer)
+    def search(self, request, *args, **kwargs):
+        """
+        Finds messages matching 'q' parameter in rooms this user is member of, best matches first.
+        Optional 'room_id' parameter narrows search down to a single room.
+        Results are paged with 'limit' and 'cursor' parameters (see MessageSearchPagination).
+        """
+        text = self.request.query_params.get('q', '').strip()
+        if not text:
+            return Response("Parameter 'q' missing.", status.HTTP_400_BAD_REQUEST)
+
+        queryset = Message.objects.filter(room__in=get_membership(request).rooms(USERS))
+
+        room_id = self.request.query_params.get('room_id')
+        if room_id:
+            if not room_id.isdigit():
+                return Response("Parameter 'room_id' must be a number.", status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(room_id=room_id)
+
+        queryset = MessageSerializer.setup_eager_loading(queryset, self.get_serializer().fields)
+        page = self.paginate_queryset(search_messages(queryset, text))
+        set_headlines(page, text)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def paginate_recent(self, room_id, queryset):
+        """
+        Paginates the newest page of room messages out of recent messages cache, filling it on a miss.
+
+        :returns: Page of serialized messages or None if cache is disabled or can't serve the request.
+        """
+        cache = get_history_cache()
+        if cache is None:
+            return None
+
+        recent = cache.get(room_id)
+        if recent is None:
+            token = cache.begin_fill(room_id)
+            items = [message_representation(message)
+                     for message in queryset.select_related('user').order_by('-timestamp', '-id')[:cache.size]]
+            # Room's message counter is read instead of counting its messages.
+            count = Room.objects.filter(pk=room_id).values_list('message_count', flat=True).first() or 0
+            recent = (count, items)
+            cache.fill(room_id, recent[0], recent[1], token)
+
+        return self.paginator.paginate_recent(recent[0], recent[1], self.request)
+
+    def project_fields(self, page):
+        """
+        :returns: Serialized messages reduced to fields listed in optional 'fields' parameter.
+        """
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return page
+        fields = fields.split(',')
+        return [OrderedDict((name, item[name]) for name in item if name in fields) for item in page]
+
+    def perform_destroy(self, instance):
+        """
+        Overrides deletion to update room activity counters and drop room's recent messages from cache.
+        """
+        with transaction.atomic():
+            super(MessageViewSet, self).perform_destroy(instance)
+            Room.rebuild_activity(Room.objects.filter(pk=instance.room_id))
+        cache = get_history_cache()
+        if cache is not None:
+            cache.invalidate(instance.room_id)
+
 
 class JoinRoomView(generics.GenericAPIView):
     """
@@ -152,34 +349,65 @@ class JoinRoomView(generics.GenericAPIView):
         TODO: This may be an invalid request method. Anyway, it works for now.
 
         Handles invitations and joining users to specific rooms.
+        Invite key can only be used by the user it was created for, and is deleted once used.
         """
         invite_key_str = self.kwargs.get('invite_key')
         response_data = {}
+        unknown_keys = get_unknown_invite_keys()
+        invite_key_marked_for_deletion = False     # Tells whether to delete invite_key after all the operations.
 
         try:
-            invite_key = RoomInviteKey.objects.get(key=invite_key_str, valid_due__gte=timezone.now())
-            invite_key_marked_for_deletion = False     # Tells whether to delete invite_key after all the operations.
+            # Keys recently found unknown or expired are rejected without a query.
+            if invite_key_str in unknown_keys:
+                raise RoomInviteKey.DoesNotExist
+
+            # Key is locked until the join commits, so concurrent requests can't redeem a single use key twice.
+            with transaction.atomic():
+                try:
+                    invite_key = RoomInviteKey.objects.select_for_update().get(
+                        key=invite_key_str, valid_due__gte=timezone.now())
+                except RoomInviteKey.DoesNotExist:
+                    unknown_keys.add(invite_key_str)
+                    raise
+
+                # One user only logic, keys not meant for any particular user are rejected too.
+                if invite_key.only_for_this_user_id != self.request.user.pk:
+                    response_data['msg'] = "Invite key is valid for another user, not for you."
+                    return Response(data=response_data, status=status.HTTP_403_FORBIDDEN)
+                invite_key_marked_for_deletion = True
 
-            # One user only logic
-            if invite_key.only_for_this_user and invite_key.only_for_this_user == self.request.user:
                 invite_key.room.users.add(self.request.user)
-                invite_key_marked_for_deletion = True
-            else:
-                response_data['msg'] = "Invite key is valid for another user, not for you."
-                return Response(data=response_data, status=status.HTTP_403_FORBIDDEN)
 
-            # Give admin logic
-            if invite_key.give_admin:
-                invite_key.room.admins.add(self.request.user)
-                invite_key_marked_for_deletion = True
+                # Give admin logic
+                if invite_key.give_admin:
+                    invite_key.room.admins.add(self.request.user)
+                    invite_key_marked_for_deletion = True
 
-            response_data['room_id'] = invite_key.room.id
+                if invite_key_marked_for_deletion:
+                    invite_key.delete()
 
             if invite_key_marked_for_deletion:
-                invite_key.delete()
+                unknown_keys.add(invite_key_str)
+
+            # Let new member join room's WebSocket right away.
+            invalidate_room_members(invite_key.room_id)
 
+            response_data['room_id'] = invite_key.room_id
             return Response(data=response_data, status=status.HTTP_200_OK)
         except (RoomInviteKey.DoesNotExist, Room.DoesNotExist):
             response_data['msg'] = "Something went wrong. Make sure invite key is valid and it hasn't expired."
             return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
-        
\ No newline at end of file
+
+
+def metrics_view(request):
+    """
+    Serves metrics of all processes in Prometheus text format to requests carrying
+    'Authorization: Bearer <token>' header with CHAT_METRICS TOKEN setting.
+    Metrics are not served at all if the token is not set.
+    """
+    token = settings.CHAT_METRICS['TOKEN']
+    if not token:
+        raise Http404
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.render_all(), content_type='text/plain; version=0.0.4; charset=utf-8')
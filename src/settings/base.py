@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -31,6 +32,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Duration and database queries of requests, served by /metrics (api.metrics).
+    'api.metrics.MetricsMiddleware',
+
     # Django Cors Headers.
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,8 +47,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
-    # Django Rest Framework Logger.
-    'drf_api_logger.middleware.api_logger_middleware.APILoggerMiddleware',
+    # API access log (saved to Django Rest Framework Logger's table in background).
+    'api.api_logger.BufferedAPILoggerMiddleware',
 ]
 
 ROOT_URLCONF = 'src.urls'
@@ -128,21 +132,205 @@ REST_FRAMEWORK = {
 
 # Django Rest Framework Logger.
 
-DRF_API_LOGGER_DATABASE = True    # Enable logging into database table.
+# Defines drf_api_logger's log table, which api.api_logger writes to, and its admin. drf_api_logger's own
+# middleware is not installed, requests are logged once, by api.api_logger.BufferedAPILoggerMiddleware.
+DRF_API_LOGGER_DATABASE = True
+
+# API access log (api.api_logger), written into Django Rest Framework Logger's table by a background thread.
+
+CHAT_API_LOGGER = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 1.0,                             # Fraction of requests logged.
+    'ALWAYS_LOG_ERRORS': True,                      # Log responses with status 5xx even if not sampled.
+    'EXCLUDE_PATHS': ['/admin/', '/static/', '/metrics'],  # Path prefixes never logged.
+    'MAX_BODY_LENGTH': 2000,                        # Request and response bodies are truncated to this length.
+    'MAX_QUEUE_SIZE': 10000,                        # Max records waiting for insert, further ones are dropped.
+    'BATCH_SIZE': 500,                              # Max records saved with one INSERT.
+    'FLUSH_INTERVAL': 2,                            # Max seconds record waits in queue.
+    'RETENTION_DAYS': 30,                           # Age of records removed by purge_api_logs command.
+}
 
 # Django Channels.
 
 ASGI_APPLICATION = "api.asgi.application"
 
-CHANNEL_LAYERS = {
-    'default': {
+# Channel layers to choose from with CHAT_CHANNEL_LAYER environment variable:
+#   'redis'  - every message goes through Redis (default),
+#   'hybrid' - Redis, but connections of the same process get messages directly (api.channel_layers),
+#              opt-in: every process has to use it, and it requires channels_redis 3.2,
+#   'memory' - in-process only, for a single process (development, tests, load tests), no Redis needed.
+
+CHAT_CHANNEL_LAYERS = {
+    'hybrid': {
+        'BACKEND': 'api.channel_layers.HybridChannelLayer',
+        'CONFIG': {
+            "hosts": [('redis', 6379)],
+        },
+    },
+    'redis': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [('redis', 6379)],
         },
     },
+    'memory': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+CHANNEL_LAYERS = {
+    'default': CHAT_CHANNEL_LAYERS[os.environ.get('CHAT_CHANNEL_LAYER', 'redis')],
+}
+
+# Chat message persistence.
+
+CHAT_MESSAGE_PIPELINE = {
+    # Queue WebSocket messages in memory and save them in batches (api.persistence) instead of one by one.
+    'WRITE_BEHIND': False,
+
+    # When queued message is acknowledged, i.e. broadcast to the room (sender included):
+    #   'persist' - after the batch it belongs to is saved,
+    #   'enqueue' - right after it is queued; messages still queued are lost if the process crashes.
+    #               Message ids are reserved from database sequence ahead, so PostgreSQL only,
+    #               'persist' is used with other databases.
+    'DURABILITY': 'persist',
+
+    'BATCH_SIZE': 100,          # Max messages saved with one INSERT.
+    'FLUSH_INTERVAL': 0.02,     # Max seconds message waits in queue.
+    'ID_BLOCK_SIZE': 100,       # Enqueue only: message ids reserved with one query.
+}
+
+# Recent messages cache (api.history_cache), serving the newest page of room history.
+
+CHAT_HISTORY_CACHE = {
+    # None (disabled),
+    # 'api.history_cache.LocMemHistoryCache' - in-process, for single process deployments only,
+    # 'api.history_cache.RedisHistoryCache' - shared by all processes, requires redis package.
+    'BACKEND': None,
+
+    'SIZE': 50,                         # Max messages stored per room.
+    'TTL': 300,                         # Seconds room is stored for.
+    # 'MAX_BYTES': 64 * 1024 * 1024,    # LocMem only: max estimated size of all stored messages.
+    # 'LOCATION': 'redis://redis:6379/1',  # Redis only: server URL.
+}
+
+# Cache of room user ids (api.membership), checked when WebSocket connection joins a room.
+# With more than one process, CACHE has to be shared by all of them (e.g. Redis or Memcached),
+# otherwise membership changes are seen by other processes only after TTL.
+
+CHAT_ROOM_MEMBERS_CACHE = {
+    'CACHE': 'default',                 # Alias of Django cache (CACHES setting) to use.
+    'TTL': 60,                          # Seconds room's user ids are cached for.
+    'KEY_PREFIX': 'chat:room_members:',
+}
+
+# Multiplexed WebSocket connections (ws/), subscribed to many rooms at once.
+
+CHAT_MULTIPLEX = {
+    'MAX_ROOMS': 500,   # Max rooms one connection can be subscribed to.
+}
+
+# Queue of frames waiting to be sent to each WebSocket connection (api.outbox).
+
+CHAT_OUTBOX = {
+    'MAX_FRAMES': 1000,     # Max frames waiting for a client which reads slowly.
+
+    # What happens when queue is full:
+    #   'drop_oldest' - oldest frame is dropped,
+    #   'coalesce'    - queued messages are dropped, client is sent a 'gap' frame for each of their rooms,
+    #   'disconnect'  - connection is closed after sending ids of the last messages client got.
+    # Clients fetch missed messages from REST API, after ids given in 'gap' and 'overflow' frames.
+    'POLICY': 'coalesce',
 }
 
+# Resuming WebSocket connections with id of the last message client got (api.resume).
+
+CHAT_RESUME = {
+    'MAX_MESSAGES': 500,    # Max missed messages sent on resume, beyond that client fetches them from REST API.
+}
+
+# Users online and typing in rooms (api.presence), sent to WebSocket connections as
+# a 'presence' frame on joining a room and then as 'presence_diff' frames.
+
+CHAT_PRESENCE = {
+    # None (disabled),
+    # 'api.presence.LocMemPresenceStore' - in-process, for single process deployments only,
+    # 'api.presence.RedisPresenceStore' - shared by all processes, requires redis package.
+    'BACKEND': None,
+
+    'INTERVAL': 0.5,        # Min seconds between presence frames of a room, changes are batched meanwhile.
+    'HEARTBEAT': 15,        # Seconds between refreshes of users online, must be well below TTL.
+    'TTL': 45,              # Seconds user stays online without refresh, e.g. after its process crashed.
+    'TYPING_TTL': 5,        # Seconds user stays typing after their last 'typing' frame.
+    # 'LOCATION': 'redis://redis:6379/2',  # Redis only: server URL.
+}
+
+# Monthly partitions of message table on PostgreSQL (api.partitions), created by create_message_partitions command,
+# which has to run regularly, e.g. daily from cron. `manage.py check --database default` warns when it doesn't.
+
+CHAT_MESSAGE_PARTITIONS = {
+    'MONTHS_AHEAD': 3,      # Partitions are created up to this many months ahead.
+    'MIN_DAYS_AHEAD': 7,    # Check warns when partitions end sooner than this many days from now.
+}
+
+# Archive of old messages (api.archive), moved out of database by archive_messages command into
+# gzipped JSON lines files, one per room and month. Room history pages past the oldest message
+# left in database are read from archive.
+
+CHAT_ARCHIVE = {
+    'DIRECTORY': None,      # Directory of archive files, shared by all processes. None disables archiving.
+    'AFTER_DAYS': 365,      # Messages older than this are archived.
+    'BATCH_SIZE': 10000,    # Messages archived and deleted at once, when message table is not partitioned.
+}
+
+# Purging deleted rooms (purge_deleted_rooms command). Messages are deleted in chunks,
+# each in its own short transaction, so that locks are held briefly.
+
+CHAT_ROOM_PURGE = {
+    'CHUNK_SIZE': 10000,    # Max messages deleted with one DELETE.
+    'PAUSE': 0.1,           # Seconds between chunks, leaving room for other writes.
+}
+
+# Bulk export and import of room messages as JSON lines (api.transfer). Messages are read
+# with a server-side cursor and saved with bulk inserts, so memory use stays constant.
+
+CHAT_MESSAGE_TRANSFER = {
+    'EXPORT_CHUNK_SIZE': 2000,  # Messages fetched from server-side cursor and sent at once.
+    'IMPORT_BATCH_SIZE': 5000,  # Messages saved with one INSERT.
+}
+
+# Room invite keys (api.invites). Keys looked up and not found are remembered by each process
+# for a while, so repeated guesses and stale links don't reach the database. Expired keys are
+# deleted by purge_invite_keys command.
+
+CHAT_INVITE_KEYS = {
+    'UNKNOWN_CACHE_SIZE': 10000,    # Max unknown keys remembered per process.
+    'UNKNOWN_CACHE_TTL': 60,        # Seconds unknown key is remembered for.
+    'PURGE_BATCH_SIZE': 1000,       # Expired keys deleted with one DELETE.
+}
+
+# Max invite keys created, or room members added or removed, with one bulk request.
+
+CHAT_BULK_MAX_ITEMS = 10000
+
+# Metrics (api.metrics), served by /metrics endpoint in Prometheus text format.
+
+CHAT_METRICS = {
+    # 'api.metrics.LocMemMetricsStore' - metrics of the serving process only, for single process deployments,
+    # 'api.metrics.RedisMetricsStore' - metrics of all processes, merged, requires redis package.
+    'BACKEND': 'api.metrics.LocMemMetricsStore',
+
+    'INTERVAL': 5,          # Redis only: seconds between publishes of metrics of each process.
+    # /metrics requires 'Authorization: Bearer <token>' header with this token, and is not served if it isn't set.
+    'TOKEN': os.environ.get('CHAT_METRICS_TOKEN'),
+    # 'TTL': 30,            # Redis only: seconds metrics of a process are kept after its last publish.
+    # 'LOCATION': 'redis://redis:6379/3',  # Redis only: server URL.
+}
+
+# Encoder of WebSocket frames (api.frames): 'json' or 'orjson' (requires orjson package).
+
+CHAT_FRAME_ENCODER = 'json'
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 SITE_ID = 1
@@ -0,0 +1,51 @@
+# Part of settings for running benchmarks locally, e.g.
+# `DJANGO_SETTINGS_MODULE=src.settings.benchmark python manage.py migrate && ... bench_suite`.
+# Uses a SQLite file by default, or a throwaway PostgreSQL database if CHAT_BENCH_DB_HOST is set.
+# Never point it at a database you care about: benchmarks create and delete rooms and users.
+
+from .base import *
+
+SECRET_KEY = "not_secret"
+
+DEBUG = 0
+
+ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
+
+if os.environ.get('CHAT_BENCH_DB_HOST'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': os.environ.get('CHAT_BENCH_DB_NAME', 'chat_bench'),
+            'USER': os.environ.get('CHAT_BENCH_DB_USER', 'postgres'),
+            'PASSWORD': os.environ.get('CHAT_BENCH_DB_PASSWORD', 'postgres'),
+            'HOST': os.environ['CHAT_BENCH_DB_HOST'],
+            'PORT': int(os.environ.get('CHAT_BENCH_DB_PORT', 5432)),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('CHAT_BENCH_DB_NAME', str(BASE_DIR / 'benchmark.sqlite3')),
+            'OPTIONS': {
+                'timeout': 30,  # Seconds concurrent clients wait for SQLite write lock.
+            },
+        }
+    }
+
+# Channel layer of a single process, no Redis needed.
+
+CHANNEL_LAYERS = {
+    'default': CHAT_CHANNEL_LAYERS['memory'],
+}
+
+# Recent messages cache and users online, benchmarks run in a single process.
+
+CHAT_HISTORY_CACHE['BACKEND'] = 'api.history_cache.LocMemHistoryCache'
+CHAT_PRESENCE['BACKEND'] = 'api.presence.LocMemPresenceStore'
+
+# Request logging would compete with measured requests for database writes.
+
+CHAT_API_LOGGER['ENABLED'] = False
+
+ACCOUNT_EMAIL_VERIFICATION = 'none'
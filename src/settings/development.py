@@ -31,6 +31,14 @@ REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] += {
     # 'rest_framework.authentication.SessionAuthentication',
 }
 
+# Recent messages cache, development server runs in a single process.
+
+CHAT_HISTORY_CACHE['BACKEND'] = 'api.history_cache.LocMemHistoryCache'
+
+# Users online and typing, development server runs in a single process.
+
+CHAT_PRESENCE['BACKEND'] = 'api.presence.LocMemPresenceStore'
+
 # Django Cors Headers.
 
 CORS_ORIGIN_ALLOW_ALL = True    # If this is used then `CORS_ORIGIN_WHITELIST` will not have any effect.
@@ -21,6 +21,26 @@ DATABASES = {
     }
 }
 
+# Cache shared by all worker processes, so that room members cache (CHAT_ROOM_MEMBERS_CACHE)
+# invalidated by one of them is invalidated for all.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://redis:6379/4',
+    }
+}
+
+# Users online and typing, shared by all worker processes.
+
+CHAT_PRESENCE['BACKEND'] = 'api.presence.RedisPresenceStore'
+CHAT_PRESENCE['LOCATION'] = 'redis://redis:6379/2'
+
+# Metrics of all worker processes, merged by whichever of them serves /metrics.
+
+CHAT_METRICS['BACKEND'] = 'api.metrics.RedisMetricsStore'
+CHAT_METRICS['LOCATION'] = 'redis://redis:6379/3'
+
 CORS_ALLOWED_ORIGINS = [
     "https://chat-app.mszanowski.pl"
 ]
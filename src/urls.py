@@ -1,10 +1,15 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from api.views import metrics_view
+
 urlpatterns = [
     # API app urls.
     path('api/', include('api.urls')),
 
+    # Metrics of all processes, in Prometheus text format, served only if CHAT_METRICS TOKEN is set.
+    path('metrics', metrics_view),
+
     # Admin.
     path('admin/', admin.site.urls),
 